@@ -2,6 +2,7 @@ import os
 
 from celery import Celery
 from celery.schedules import crontab
+from django.conf import settings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "amocrm.settings")
 
@@ -11,8 +12,29 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    "poll-machines-every-15-minutes": {
-        "task": "monitor.tasks.poll_machines_task",
-        "schedule": crontab(minute="*/15"),
+    "rollup-metrics-every-5-minutes": {
+        "task": "monitor.tasks.rollup_metrics_task",
+        "schedule": crontab(minute="*/5"),
+    },
+    "purge-expired-daily": {
+        "task": "monitor.tasks.purge_expired_task",
+        "schedule": crontab(hour=3, minute=30),
+    },
+    "create-partitions-daily": {
+        "task": "monitor.tasks.create_partitions_task",
+        "schedule": crontab(hour=3, minute=0),
     },
 }
+
+
+@app.on_after_configure.connect
+def schedule_poll_dispatch(sender, **kwargs):
+    # Django settings are read once Celery is configured, not on import,
+    # so that amocrm/__init__.py can import this module.
+    if settings.POLL_DISPATCH:
+        # Each machine has its own next poll time, see monitor.schedule.
+        sender.add_periodic_task(
+            settings.POLL_TICK,
+            sender.signature("monitor.tasks.dispatch_polls_task"),
+            name="dispatch-polls",
+        )
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
 from environ import Env
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -67,6 +68,8 @@ CORS_ALLOWED_ORIGINS = [
 ]
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_HEADERS = True
+CORS_ALLOW_HEADERS = (*default_headers, "if-none-match", "last-event-id")
+CORS_EXPOSE_HEADERS = ["ETag"]
 CORS_ALLOW_METHODS = [
     "DELETE",
     "GET",
@@ -175,5 +178,107 @@ CELERY_BROKER_URL = env.str("CELERY_BROKER_URL", default="redis://redis:6379/0")
 CELERY_RESULT_BACKEND = env.str("CELERY_RESULT_BACKEND", default="redis://redis:6379/0")
 CELERY_TIMEZONE = TIME_ZONE
 
-CELERY_TASK_ALWAYS_EAGER = True
-CELERY_TASK_EAGER_PROPAGATES = True
\ No newline at end of file
+# Turn off to spread poll shards over the celery service replicas.
+CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", default=True)
+CELERY_TASK_EAGER_PROPAGATES = True
+
+# Agent polling
+POLL_TIMEOUT = env.float("POLL_TIMEOUT", default=5.0)
+POLL_MAX_CONNECTIONS = env.int("POLL_MAX_CONNECTIONS", default=1000)
+POLL_MAX_KEEPALIVE_CONNECTIONS = env.int("POLL_MAX_KEEPALIVE_CONNECTIONS", default=1000)
+POLL_KEEPALIVE_EXPIRY = env.float("POLL_KEEPALIVE_EXPIRY", default=60.0)
+POLL_MAX_CONNECTIONS_PER_HOST = env.int("POLL_MAX_CONNECTIONS_PER_HOST", default=10)
+POLL_HTTP2 = env.bool("POLL_HTTP2", default=False)
+POLL_POOL_SIZE = env.int("POLL_POOL_SIZE", default=16)
+POLL_CONCURRENCY = env.int("POLL_CONCURRENCY", default=200)
+POLL_DEADLINE = env.float("POLL_DEADLINE", default=10.0)
+# Larger agent responses are dropped as they are read
+POLL_MAX_RESPONSE_BYTES = env.int("POLL_MAX_RESPONSE_BYTES", default=65536)
+# Adaptive schedule, intervals in seconds
+POLL_INTERVAL = env.int("POLL_INTERVAL", default=900)
+POLL_MIN_INTERVAL = env.int("POLL_MIN_INTERVAL", default=60)
+POLL_MAX_INTERVAL = env.int("POLL_MAX_INTERVAL", default=1800)
+# Points below a threshold from which a machine is polled more often
+POLL_NEAR_THRESHOLD = env.float("POLL_NEAR_THRESHOLD", default=10.0)
+POLL_JITTER = env.float("POLL_JITTER", default=0.1)
+# Failed polls in a row that open the circuit breaker and an UNREACHABLE
+# incident, and the longest backoff of an unreachable machine in seconds
+POLL_BREAKER_THRESHOLD = env.int("POLL_BREAKER_THRESHOLD", default=3)
+POLL_BREAKER_MAX_BACKOFF = env.int("POLL_BREAKER_MAX_BACKOFF", default=21600)
+# Seconds a machine whose last poll failed gets to answer
+POLL_PROBE_TIMEOUT = env.float("POLL_PROBE_TIMEOUT", default=2.0)
+# Seconds between ticks dispatching due machines, and machines per tick
+POLL_TICK = env.float("POLL_TICK", default=30.0)
+POLL_TICK_LIMIT = env.int("POLL_TICK_LIMIT", default=5000)
+# Seconds before a claimed machine that was not rescheduled is due again,
+# longer than the longest poll cycle of a shard. Machines claimed by a
+# crashed worker wait this long, not just until the next tick.
+POLL_CLAIM_TIMEOUT = env.int("POLL_CLAIM_TIMEOUT", default=300)
+# Poll tasks per tick, machines are assigned to them by consistent hashing
+POLL_SHARDS = env.int("POLL_SHARDS", default=8)
+# Turn off when due machines are polled by `manage.py poller` instead of Celery.
+POLL_DISPATCH = env.bool("POLL_DISPATCH", default=True)
+# Index of the next poll times, queried in the database unless a Redis URL is set
+POLL_SCHEDULE_URL = env.str("POLL_SCHEDULE_URL", default=None)
+# Seconds between rebuilds of the Redis index from the database
+POLL_SCHEDULE_SYNC = env.int("POLL_SCHEDULE_SYNC", default=60)
+
+# Metric ingestion
+INGEST_BATCH_SIZE = env.int("INGEST_BATCH_SIZE", default=500)
+INGEST_FLUSH_INTERVAL = env.float("INGEST_FLUSH_INTERVAL", default=2.0)
+# Limits of a push to /api/ingest/, the body limit applies once decompressed
+INGEST_MAX_BODY_BYTES = env.int("INGEST_MAX_BODY_BYTES", default=2621440)
+INGEST_MAX_SAMPLES = env.int("INGEST_MAX_SAMPLES", default=5000)
+# Seconds after which a pushed sample is too old to be accepted
+INGEST_MAX_SAMPLE_AGE = env.int("INGEST_MAX_SAMPLE_AGE", default=86400)
+
+# Incident state cache, shared through Redis, read from the database at every evaluation without it
+INCIDENT_STATE_URL = env.str("INCIDENT_STATE_URL", default=None)
+# Cache incident state in process memory instead, only when a single process evaluates incidents
+INCIDENT_STATE_LOCAL = env.bool("INCIDENT_STATE_LOCAL", default=False)
+INCIDENT_STATE_TTL = env.int("INCIDENT_STATE_TTL", default=86400)
+# Share of samples in the MEM/DISK duration window that must exceed the threshold
+INCIDENT_WINDOW_BREACH_RATIO = env.float("INCIDENT_WINDOW_BREACH_RATIO", default=1.0)
+
+# Incident event stream, kept in process memory unless a Redis URL is set
+INCIDENT_EVENTS_URL = env.str("INCIDENT_EVENTS_URL", default=None)
+# Events kept for clients resuming with Last-Event-ID
+INCIDENT_EVENTS_BACKLOG = env.int("INCIDENT_EVENTS_BACKLOG", default=10000)
+INCIDENT_EVENTS_KEEPALIVE = env.float("INCIDENT_EVENTS_KEEPALIVE", default=15.0)
+
+# Cache of API responses, shared through Redis, off without it
+RESPONSE_CACHE_URL = env.str("RESPONSE_CACHE_URL", default=None)
+# Cache responses in process memory instead, only when one process serves the API and writes
+RESPONSE_CACHE_LOCAL = env.bool("RESPONSE_CACHE_LOCAL", default=False)
+# Seconds a response is kept, 0 disables the cache
+RESPONSE_CACHE_TTL = env.int("RESPONSE_CACHE_TTL", default=300)
+# Seconds /api/machines/ is cached, latest samples and poll outcomes are this stale at most
+RESPONSE_CACHE_STATUS_TTL = env.int("RESPONSE_CACHE_STATUS_TTL", default=10)
+# Seconds a request waits for the same response computed by another one
+RESPONSE_CACHE_LOCK_TIMEOUT = env.float("RESPONSE_CACHE_LOCK_TIMEOUT", default=5.0)
+# Largest response body cached, bigger responses are streamed uncached
+RESPONSE_CACHE_MAX_ENTRY_BYTES = env.int("RESPONSE_CACHE_MAX_ENTRY_BYTES", default=1024 * 1024)
+# Bytes of response bodies kept by the in-memory cache
+RESPONSE_CACHE_MAX_BYTES = env.int("RESPONSE_CACHE_MAX_BYTES", default=64 * 1024 * 1024)
+
+# Metric rollups
+# Seconds after a bucket ends before it is rolled up
+ROLLUP_DELAY = env.int("ROLLUP_DELAY", default=60)
+# Seconds of metrics rolled up per transaction, and transactions per run
+ROLLUP_STEP = env.int("ROLLUP_STEP", default=86400)
+ROLLUP_MAX_STEPS = env.int("ROLLUP_MAX_STEPS", default=24)
+ROLLUP_MACHINE_CHUNK = env.int("ROLLUP_MACHINE_CHUNK", default=500)
+
+# Retention, in days, 0 keeps rows forever. Hourly and daily rollups are always kept.
+METRIC_RETENTION_DAYS = env.int("METRIC_RETENTION_DAYS", default=30)
+INCIDENT_RETENTION_DAYS = env.int("INCIDENT_RETENTION_DAYS", default=365)
+MINUTE_ROLLUP_RETENTION_DAYS = env.int("MINUTE_ROLLUP_RETENTION_DAYS", default=30)
+# Rows deleted per statement, pause between statements in seconds and
+# time limit of a scheduled purge in seconds
+PURGE_CHUNK_SIZE = env.int("PURGE_CHUNK_SIZE", default=5000)
+PURGE_SLEEP = env.float("PURGE_SLEEP", default=0.1)
+PURGE_TIME_LIMIT = env.int("PURGE_TIME_LIMIT", default=3600)
+
+# Partitions of the metric table, once converted with `manage.py partition_metrics convert`
+METRIC_PARTITION_PERIOD = env.str("METRIC_PARTITION_PERIOD", default="daily")
+METRIC_PARTITIONS_AHEAD = env.int("METRIC_PARTITIONS_AHEAD", default=7)
@@ -24,5 +24,14 @@ urlpatterns = [
     path("api/register/", views.api_register, name="api_register"),
     path("api/login/", views.api_login, name="api_login"),
     path("api/logout/", views.api_logout, name="api_logout"),
+    path("api/ingest/", views.api_ingest, name="api_ingest"),
     path("api/incidents/", views.api_incidents, name="api_incidents"),
+    path("api/machines/", views.api_machines, name="api_machines"),
+    path("api/cache/", views.api_cache, name="api_cache"),
+    path("api/metrics/", views.api_metrics, name="api_metrics"),
+    path(
+        "api/incidents/stream/",
+        views.api_incidents_stream,
+        name="api_incidents_stream",
+    ),
 ]
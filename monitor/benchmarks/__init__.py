@@ -0,0 +1,20 @@
+"""Scenarios of the benchmark command, one module each with a ``run(command, options)``.
+
+Scenarios that write to the database run in a throwaway test database,
+see utils.throwaway_database, so they never touch the configured one.
+"""
+
+SCENARIOS = [
+    "client",
+    "scheduler",
+    "poller",
+    "cycle",
+    "dark",
+    "parse",
+    "push",
+    "history",
+    "feed",
+    "incidents",
+    "stream",
+    "load",
+]
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import httpx
+from django.conf import settings
+
+from monitor.benchmarks.utils import fleets, report
+from monitor.poll import build_client, fetch_sample
+
+
+def run(command, options):
+    async def bench():
+        async for fleet, machines in fleets(options):
+            await bench_client(command, fleet, machines, options["cycles"])
+
+    asyncio.run(bench())
+
+
+async def bench_client(command, fleet, machines, cycles):
+    """Compare one client per machine against one shared pooled client."""
+
+    async def per_machine(machine):
+        async with httpx.AsyncClient(timeout=settings.POLL_TIMEOUT) as client:
+            return await fetch_sample(client, machine)
+
+    report(
+        command,
+        "per-machine client",
+        fleet,
+        machines,
+        await timed_cycles(command, fleet, cycles, lambda: map(per_machine, machines)),
+    )
+
+    async with build_client() as client:
+        report(
+            command,
+            "shared client",
+            fleet,
+            machines,
+            await timed_cycles(
+                command,
+                fleet,
+                cycles,
+                lambda: (fetch_sample(client, machine) for machine in machines),
+            ),
+        )
+
+
+async def timed_cycles(command, fleet, cycles, make_tasks):
+    """Run poll cycles and return their wall-clock durations."""
+    fleet.reset()
+    durations = []
+    for _ in range(cycles):
+        started = time.perf_counter()
+        samples = await asyncio.gather(*make_tasks())
+        durations.append(time.perf_counter() - started)
+        failed = samples.count(None)
+        if failed:
+            command.stderr.write(f"{failed} requests failed")
+    return durations
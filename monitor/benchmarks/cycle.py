@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from monitor.benchmarks.utils import (
+    add_machines,
+    count_queries,
+    fleets,
+    git_commit,
+    peak_rss_mb,
+    throwaway_database,
+)
+from monitor.models import Incident
+from monitor.poll import PollStats, build_client, poll_due_machines
+
+
+def run(command, options):
+    async def bench():
+        return [
+            await bench_cycle(command, fleet, machines, options["cycles"])
+            async for fleet, machines in fleets(options)
+        ]
+
+    with throwaway_database():
+        results = asyncio.run(bench())
+    if options["json"]:
+        write_json(command, options, results)
+
+
+async def bench_cycle(command, fleet, machines, cycles):
+    """Run full poll cycles against the database.
+
+    A cycle polls every due machine like a poll task, with one client
+    kept between cycles: claim, fetch, save the samples, evaluate
+    incidents and reschedule. Incidents are only evaluated within the
+    cycle with CELERY_TASK_ALWAYS_EAGER, the default. Returns the
+    results of the fleet size.
+    """
+    count = len(machines)
+    machines = await add_machines(machines)
+
+    def make_due():
+        machines.update(next_poll_at=timezone.now() - timedelta(seconds=1))
+
+    def incident_counts():
+        incidents = Incident.objects.filter(machine__in=machines)
+        return incidents.count(), incidents.filter(end_time__isnull=False).count()
+
+    # Failed fetches of --failure-rate log an error each.
+    for name in ("monitor", "celery"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    results = []
+    try:
+        async with build_client() as client:
+            for _ in range(cycles):
+                await sync_to_async(make_due)()
+                opened, closed = await sync_to_async(incident_counts)()
+                fleet.reset()
+                stats = PollStats()
+                with count_queries() as counter:
+                    started = time.perf_counter()
+                    # POLL_TICK_LIMIT machines at a time.
+                    while tick := await poll_due_machines(client):
+                        stats.latencies += tick.latencies
+                        stats.failed += tick.failed
+                    wall_time = time.perf_counter() - started
+                total_opened, total_closed = await sync_to_async(incident_counts)()
+
+                polled = len(stats.latencies)
+                results.append(
+                    {
+                        "wall_time": round(wall_time, 4),
+                        "polled": polled,
+                        "failed": stats.failed,
+                        "samples_per_second": round((polled - stats.failed) / wall_time, 1),
+                        "fetch_p50_ms": round(stats.percentile(50) * 1000, 1),
+                        "fetch_p99_ms": round(stats.percentile(99) * 1000, 1),
+                        "queries": counter["queries"],
+                        "queries_per_machine": round(counter["queries"] / max(polled, 1), 2),
+                        "incidents_opened": total_opened - opened,
+                        "incidents_closed": total_closed - closed,
+                        "sockets_opened": fleet.connections_opened,
+                    }
+                )
+    finally:
+        await sync_to_async(machines.delete)()
+
+    result = {"machines": count, "cycles": results, "peak_rss_mb": peak_rss_mb()}
+    for cycle in results:
+        command.stdout.write(
+            f"cycle N={count:<6} wall: {cycle['wall_time']:.2f}s  "
+            f"{cycle['samples_per_second']:,.0f} samples/s  "
+            f"failed: {cycle['failed']}  "
+            f"fetch p50/p99: {cycle['fetch_p50_ms']:.0f}/{cycle['fetch_p99_ms']:.0f}ms  "
+            f"queries: {cycle['queries']} ({cycle['queries_per_machine']}/machine)  "
+            f"incidents +{cycle['incidents_opened']}/-{cycle['incidents_closed']}"
+        )
+    if result["peak_rss_mb"] is not None:
+        command.stdout.write(f"cycle N={count:<6} peak RSS: {result['peak_rss_mb']:.0f}MB")
+    return result
+
+
+def write_json(command, options, results):
+    """Write results with what they were measured on, to compare them across commits."""
+    report = {
+        "scenario": options["scenario"],
+        "commit": git_commit(),
+        "time": timezone.now().isoformat(),
+        "database": connection.vendor,
+        "fleet": {
+            "latency": options["latency"],
+            "distribution": options["distribution"],
+            "failure_rate": options["failure_rate"],
+        },
+        "settings": {
+            name: getattr(settings, name)
+            for name in (
+                "POLL_CONCURRENCY",
+                "POLL_MAX_CONNECTIONS",
+                "POLL_TICK_LIMIT",
+                "INGEST_BATCH_SIZE",
+                "CELERY_TASK_ALWAYS_EAGER",
+            )
+        },
+        "results": results,
+    }
+    if options["json"] == "-":
+        command.stdout.write(json.dumps(report, indent=2))
+        return
+    with open(options["json"], "w") as f:
+        json.dump(report, f, indent=2)
+    command.stdout.write(f"Results written to {options['json']}")
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.test import override_settings
+from django.utils import timezone
+
+from monitor.benchmarks.utils import add_machines, fleets, throwaway_database
+from monitor.models import Incident
+from monitor.poller import Poller
+
+
+def run(command, options):
+    async def bench():
+        async for fleet, machines in fleets(options, dark_rate=options["dark"]):
+            await bench_dark(command, fleet, machines, options["cycles"])
+
+    with throwaway_database():
+        asyncio.run(bench())
+
+
+async def bench_dark(command, fleet, machines, cycles):
+    """Poll a fleet with dark agents with and without the circuit breaker.
+
+    Every cycle moves the schedule POLL_MAX_INTERVAL plus jitter ahead,
+    which makes every healthy machine due, while machines backed off
+    for longer by the breaker are skipped. Without the breaker, dark
+    machines are retried every cycle with the full timeout.
+    """
+    count = len(machines)
+    machines = await add_machines(machines)
+    step = timedelta(seconds=settings.POLL_MAX_INTERVAL * (1 + settings.POLL_JITTER))
+
+    def reset():
+        machines.update(
+            next_poll_at=timezone.now() - timedelta(seconds=1), consecutive_failures=0
+        )
+
+    def advance():
+        machines.update(next_poll_at=F("next_poll_at") - step)
+
+    async def run(label):
+        await sync_to_async(reset)()
+        results = []
+        async with Poller() as poller:
+            for cycle in range(cycles):
+                if cycle:
+                    await sync_to_async(advance)()
+                started = time.perf_counter()
+                stats = await poller.cycle()
+                duration = time.perf_counter() - started
+                polled = len(stats.latencies) if stats else 0
+                failed = stats.failed if stats else 0
+                results.append(f"{duration:.2f}s/{polled}/{failed}")
+        unreachable = await Incident.objects.filter(
+            machine__in=machines, type="UNREACHABLE", end_time__isnull=True
+        ).acount()
+        command.stdout.write(
+            f"{label:<20} N={count:<6} "
+            f"dark={len(fleet.dark):<5} cycles (time/polled/failed): "
+            f"{', '.join(results)}  open UNREACHABLE: {unreachable}"
+        )
+
+    # Every dark fetch logs an error.
+    for name in ("monitor", "celery"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    try:
+        with override_settings(
+            POLL_BREAKER_THRESHOLD=2**31, POLL_PROBE_TIMEOUT=settings.POLL_DEADLINE
+        ):
+            await run("no breaker")
+        await run("breaker")
+    finally:
+        await sync_to_async(machines.delete)()
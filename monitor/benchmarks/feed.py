@@ -0,0 +1,60 @@
+import time
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from monitor.benchmarks.utils import read_body
+from monitor.cache import get_cache
+from monitor.views import api_incidents
+
+
+def run(command, options):
+    for tabs in options["tabs"]:
+        bench_feed(command, tabs, options["polls"])
+
+
+def bench_feed(command, tabs, polls):
+    """Compare full, conditional and cached polling of /api/incidents/ by many tabs."""
+    factory = RequestFactory()
+    get_cache().clear()
+    for label, conditional, cached in [
+        ("unconditional", False, False),
+        ("conditional", True, False),
+        ("cached", True, True),
+    ]:
+        etags = {}
+        sent = queries = not_modified = 0
+        db_time = 0.0
+        started = time.perf_counter()
+        for _ in range(polls):
+            for tab in range(tabs):
+                headers = {}
+                if conditional and tab in etags:
+                    headers["If-None-Match"] = etags[tab]
+                request = factory.get(
+                    "/api/incidents/", {"limit": 50}, headers=headers
+                )
+                with (
+                    # One process, so the in-memory cache is safe here.
+                    override_settings(
+                        RESPONSE_CACHE_TTL=settings.RESPONSE_CACHE_TTL if cached else 0,
+                        RESPONSE_CACHE_LOCAL=True,
+                    ),
+                    CaptureQueriesContext(connection) as captured,
+                ):
+                    response = async_to_sync(api_incidents)(request)
+                    body = read_body(response)
+                etags[tab] = response.get("ETag")
+                sent += len(body)
+                not_modified += response.status_code == 304
+                queries += len(captured)
+                db_time += sum(float(query["time"]) for query in captured)
+        elapsed = time.perf_counter() - started
+        command.stdout.write(
+            f"{label:<14} tabs={tabs} polls={polls}  "
+            f"wall: {elapsed:.2f}s  bytes sent: {sent}  304s: {not_modified}  "
+            f"queries: {queries}  db time: {db_time * 1000:.0f}ms"
+        )
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import random
+
+
+class StubAgentFleet:
+    """Local HTTP server that answers as any number of monitoring agents.
+
+    Every machine gets its own loopback address (127.x.y.z) on a shared
+    port, so HTTP clients see each machine as a distinct host, just like a
+    real fleet. The server counts the TCP connections it accepts, which is
+    the number of sockets the poller had to open. A ``dark_rate`` share of
+    the machines, spread evenly, accept connections but never answer, like
+    a hung host.
+
+    Response times follow ``distribution`` around a mean of ``latency``:
+    ``fixed``, ``uniform`` between 0 and twice the mean, or ``exponential``
+    for a long tail of slow agents.
+    """
+
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential")
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        dark_rate: float = 0.0,
+        distribution: str = "fixed",
+    ):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.dark_rate = dark_rate
+        self.dark: set[str] = set()
+        self.connections_opened = 0
+        self.connections_open = 0
+        self.peak_connections = 0
+        self.requests = 0
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, host="0.0.0.0", port=0, backlog=4096
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def url(self, index: int) -> str:
+        """Return the agent URL of the machine with the given index."""
+        # Skip 127.0.0.0 itself, everything else in 127/8 routes to loopback.
+        n = index + 1
+        address = f"127.{(n >> 16) & 0xFF}.{(n >> 8) & 0xFF}.{n & 0xFF}"
+        if int(n * self.dark_rate) != int(index * self.dark_rate):
+            self.dark.add(address)
+        return f"http://{address}:{self.port}/metrics"
+
+    def reset(self):
+        self.connections_opened = 0
+        self.peak_connections = 0
+        self.requests = 0
+
+    def delay(self) -> float:
+        """Response time of one request, in seconds."""
+        if not self.latency or self.distribution == "fixed":
+            return self.latency
+        if self.distribution == "uniform":
+            return random.uniform(0, 2 * self.latency)
+        return random.expovariate(1 / self.latency)
+
+    def payload(self) -> bytes:
+        return json.dumps(
+            {
+                "cpu": f"{random.uniform(0, 100):.1f}",
+                "mem": f"{random.uniform(0, 100):.1f}%",
+                "disk": f"{random.uniform(0, 100):.1f}%",
+                "uptime": f"{random.randint(1, 30)}d {random.randint(0, 23)}h",
+            }
+        ).encode()
+
+    async def _handle(self, reader, writer):
+        self.connections_opened += 1
+        self.connections_open += 1
+        self.peak_connections = max(self.peak_connections, self.connections_open)
+        try:
+            if writer.get_extra_info("sockname")[0] in self.dark:
+                # Read until the client gives up and closes the connection.
+                await reader.read()
+                return
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                keep_alive = b"connection: close" not in request.lower()
+
+                if self.latency:
+                    await asyncio.sleep(self.delay())
+
+                if random.random() < self.failure_rate:
+                    status, body = b"500 Internal Server Error", b"{}"
+                else:
+                    status, body = b"200 OK", self.payload()
+
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    + (b"" if keep_alive else b"Connection: close\r\n")
+                    + b"\r\n"
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections_open -= 1
+            writer.close()
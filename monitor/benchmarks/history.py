@@ -0,0 +1,108 @@
+import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import RequestFactory
+from django.utils import timezone
+
+from monitor.benchmarks.fleet import StubAgentFleet
+from monitor.benchmarks.utils import count_queries, read_body, throwaway_database
+from monitor.models import Machine, Metric, MetricRollup
+from monitor.rollup import RESOLUTIONS, bucket_start, summarize
+from monitor.views import api_metrics
+
+
+def run(command, options):
+    with throwaway_database():
+        bench_history(command, options["days"], options["points"])
+
+
+def bench_history(command, days, points):
+    """Compare /api/metrics/ against reading a machine's raw metrics.
+
+    A machine with one sample a minute for ``days`` days is added to
+    the throwaway database, rolled up except for its last half hour,
+    and deleted afterwards. The naive read serialises every raw row of
+    the range with Metric.to_dict.
+    """
+    machine = Machine.objects.create(
+        name="bench-history", url="http://bench-history.invalid/metrics"
+    )
+    fleet = StubAgentFleet()
+    until = timezone.now().replace(second=0, microsecond=0)
+    start = until - timedelta(days=days)
+    metrics = []
+    for minute in range(days * 24 * 60):
+        sample = json.loads(fleet.payload())
+        metrics.append(
+            Metric(
+                machine=machine,
+                cpu=float(sample["cpu"]),
+                mem=float(sample["mem"].rstrip("%")),
+                disk=float(sample["disk"].rstrip("%")),
+                uptime=sample["uptime"],
+                timestamp=start + timedelta(minutes=minute),
+            )
+        )
+    rolled_up = until - timedelta(minutes=30)
+    rollups = []
+    for resolution, size in RESOLUTIONS.items():
+        buckets = defaultdict(list)
+        for metric in metrics:
+            bucket = bucket_start(metric.timestamp, resolution)
+            if bucket + size <= rolled_up:
+                buckets[bucket].append((metric.cpu, metric.mem, metric.disk))
+        rollups += [
+            summarize(machine.id, resolution, bucket, rows)
+            for bucket, rows in buckets.items()
+        ]
+    Metric.objects.bulk_create(metrics, batch_size=settings.INGEST_BATCH_SIZE)
+    MetricRollup.objects.bulk_create(rollups, batch_size=settings.INGEST_BATCH_SIZE)
+
+    def naive(since):
+        rows = Metric.objects.filter(
+            machine=machine, timestamp__gte=since, timestamp__lt=until
+        ).order_by("timestamp")
+        return json.dumps(
+            [
+                {**metric.to_dict(), "timestamp": metric.timestamp.isoformat()}
+                for metric in rows
+            ]
+        ).encode()
+
+    def downsampled(since):
+        request = RequestFactory().get(
+            "/api/metrics/",
+            {
+                "machine": machine.id,
+                "since": since.isoformat(),
+                "until": until.isoformat(),
+                "points": points,
+            },
+        )
+        return read_body(async_to_sync(api_metrics)(request))
+
+    def best_of(read, since, runs=3):
+        timings = []
+        for _ in range(runs):
+            with count_queries() as counter:
+                started = time.perf_counter()
+                body = read(since)
+                timings.append(time.perf_counter() - started)
+        return min(timings), counter["queries"], len(body)
+
+    try:
+        for span in [timedelta(hours=1), timedelta(days=1), timedelta(days=7)] + [
+            timedelta(days=days)
+        ]:
+            for label, read in [("raw rows", naive), (f"points={points}", downsampled)]:
+                elapsed, queries, size = best_of(read, until - span)
+                command.stdout.write(
+                    f"{str(span):<18} {label:<12} {elapsed * 1000:8.1f}ms  "
+                    f"{size / 1024:9.1f}KB  queries: {queries}"
+                )
+    finally:
+        machine.delete()
@@ -0,0 +1,80 @@
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+
+from monitor.benchmarks.utils import join_chunks, throwaway_database
+from monitor.models import Incident, Machine
+from monitor.payload import orjson
+from monitor.views import incident_chunks
+
+
+def run(command, options):
+    with throwaway_database():
+        for count in options["incidents"]:
+            bench_incidents(command, count)
+
+
+def bench_incidents(command, count):
+    """Compare listing ``count`` incidents from models against streaming them.
+
+    The incidents are added to the throwaway database for one machine
+    and deleted afterwards. The model path is the former api_incidents:
+    instances with select_related, Incident.to_dict and JsonResponse.
+    The streamed path is incident_chunks, with json and with orjson
+    when it is installed. Memory is the peak allocated while listing.
+    """
+    machine = Machine.objects.create(
+        name="bench-incidents", url="http://bench-incidents.invalid/metrics"
+    )
+    start = timezone.now()
+    Incident.objects.bulk_create(
+        (
+            Incident(
+                machine=machine,
+                type=Incident.INCIDENT_TYPES[i % 3][0],
+                value=90 + i % 1000 / 100,
+                start_time=start - timedelta(seconds=i),
+                end_time=start if i % 2 else None,
+            )
+            for i in range(count)
+        ),
+        batch_size=settings.INGEST_BATCH_SIZE,
+    )
+    incidents = Incident.objects.filter(machine=machine)
+
+    def models():
+        rows = incidents.order_by("-start_time", "-id").select_related("machine")
+        return JsonResponse(
+            {"results": [incident.to_dict() for incident in rows], "next": None}
+        ).content
+
+    def streamed():
+        return join_chunks(incident_chunks(incidents, count))
+
+    paths = [("models", models, None), ("values+json", streamed, None)]
+    if orjson is not None:
+        paths.append(("values+orjson", streamed, orjson))
+    try:
+        for label, read, encoder in paths:
+            with patch("monitor.payload.orjson", encoder):
+                timings = []
+                for _ in range(3):
+                    started = time.perf_counter()
+                    body = read()
+                    timings.append(time.perf_counter() - started)
+                tracemalloc.start()
+                read()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            command.stdout.write(
+                f"incidents={count:<7} {label:<14} {min(timings) * 1000:8.1f}ms  "
+                f"{count / min(timings):10,.0f} incidents/s  "
+                f"{len(body) / 1024:9.1f}KB  peak memory: {peak / 1024 / 1024:.1f}MB"
+            )
+    finally:
+        machine.delete()
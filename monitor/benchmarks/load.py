@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import httpx
+
+from monitor.poll import PollStats
+
+
+def run(command, options):
+    asyncio.run(
+        bench_load(
+            command, options["url"], options["tabs"], options["duration"], options["streams"]
+        )
+    )
+
+
+async def bench_load(command, url, tab_counts, duration, streams):
+    """Load a running server with dashboard tabs for ``duration`` seconds.
+
+    Each tab requests /api/incidents/ conditionally, like the dashboard,
+    and /api/machines/, back to back. With ``streams`` every tab also
+    holds /api/incidents/stream/ open, as an open dashboard does. The
+    server is started beforehand in the mode to measure, gunicorn with
+    sync or with uvicorn workers.
+    """
+    for tabs in tab_counts:
+        latencies = PollStats()
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(
+            base_url=url, limits=limits, timeout=duration
+        ) as client:
+
+            async def stream():
+                timeout = httpx.Timeout(duration, read=None)
+                try:
+                    async with client.stream(
+                        "GET", "/api/incidents/stream/", timeout=timeout
+                    ) as response:
+                        async for _ in response.aiter_bytes():
+                            pass
+                except httpx.HTTPError:
+                    pass
+
+            async def tab(deadline):
+                etag = None
+                while time.monotonic() < deadline:
+                    for path in ("/api/incidents/", "/api/machines/"):
+                        headers = {}
+                        if etag and path == "/api/incidents/":
+                            headers["If-None-Match"] = etag
+                        started = time.perf_counter()
+                        try:
+                            response = await client.get(path, headers=headers)
+                            ok = response.status_code in (200, 304)
+                            if path == "/api/incidents/":
+                                etag = response.headers.get("ETag", etag)
+                        except httpx.HTTPError:
+                            ok = False
+                        latencies.record(time.perf_counter() - started, ok)
+
+            streaming = [
+                asyncio.create_task(stream()) for _ in range(tabs if streams else 0)
+            ]
+            # Let the streams connect first.
+            await asyncio.sleep(1 if streams else 0)
+            started = time.perf_counter()
+            deadline = time.monotonic() + duration
+            await asyncio.gather(*(tab(deadline) for _ in range(tabs)))
+            elapsed = time.perf_counter() - started
+            for task in streaming:
+                task.cancel()
+            await asyncio.gather(*streaming, return_exceptions=True)
+
+        requests = len(latencies.latencies)
+        command.stdout.write(
+            f"{'load':<8} tabs={tabs} streams={len(streaming)}  wall: {elapsed:.2f}s  "
+            f"{requests / elapsed:,.0f} requests/s  "
+            f"latency p50={latencies.percentile(50) * 1000:.1f}ms "
+            f"p99={latencies.percentile(99) * 1000:.1f}ms "
+            f"max={max(latencies.latencies, default=0) * 1000:.1f}ms  "
+            f"failed: {latencies.failed}"
+        )
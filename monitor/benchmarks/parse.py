@@ -0,0 +1,50 @@
+import json
+import time
+
+from monitor.benchmarks.fleet import StubAgentFleet
+from monitor.payload import orjson, parse_payload
+
+
+def run(command, options):
+    bench_parse(command, options["payloads"])
+
+
+def bench_parse(command, count):
+    """Time the parsing of agent payloads with each decoder."""
+    fleet = StubAgentFleet()
+    bodies = [fleet.payload() for _ in range(count // 2)]
+    # Agents sending plain numbers.
+    bodies += [
+        json.dumps({**json.loads(body), "cpu": 45, "mem": 45.0}).encode()
+        for body in bodies
+    ]
+
+    def ad_hoc(body):
+        # The conversions done before monitor.payload, without validation.
+        data = json.loads(body)
+        return {
+            "cpu": float(data["cpu"]),
+            "mem": float(str(data["mem"]).rstrip("%")),
+            "disk": float(data["disk"].rstrip("%")),
+            "uptime": data["uptime"],
+        }
+
+    parsers = [
+        ("ad hoc", ad_hoc),
+        ("schema + json", lambda body: parse_payload(body, json.loads)),
+    ]
+    if orjson is not None:
+        parsers.append(("schema + orjson", lambda body: parse_payload(body, orjson.loads)))
+    else:
+        command.stderr.write("orjson is not installed, skipping it")
+
+    for label, parse in parsers:
+        started = time.perf_counter()
+        for body in bodies:
+            parse(body)
+        elapsed = time.perf_counter() - started
+        command.stdout.write(
+            f"{label:<20} payloads={len(bodies)}  wall: {elapsed:.2f}s  "
+            f"{elapsed / len(bodies) * 1e6:.2f}us/payload  "
+            f"{len(bodies) / elapsed:,.0f} payloads/s"
+        )
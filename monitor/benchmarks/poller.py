@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from monitor.benchmarks.utils import add_machines, count_queries, fleets, throwaway_database
+from monitor.models import Machine
+from monitor.poll import build_client, poll_due_machines
+from monitor.poller import Poller
+
+
+def run(command, options):
+    async def bench():
+        async for fleet, machines in fleets(options):
+            await bench_poller(command, fleet, machines, options["cycles"])
+
+    with throwaway_database():
+        asyncio.run(bench())
+
+
+async def bench_poller(command, fleet, machines, cycles):
+    """Compare a poll task running asyncio.run() per cycle against the poller.
+
+    Every cycle polls the whole fleet from the database schedule, saves
+    the samples and evaluates incidents. The idle cycle has nothing due
+    and shows the fixed cost of a cycle.
+    """
+    ids = await sync_to_async(list)(
+        (await add_machines(machines)).values_list("id", flat=True)
+    )
+
+    def make_due():
+        Machine.objects.filter(id__in=ids).update(
+            next_poll_at=timezone.now() - timedelta(seconds=1)
+        )
+
+    async def task_cycle():
+        # What poll_shard_task does in a Celery worker thread.
+        await asyncio.to_thread(asyncio.run, poll_due_machines())
+
+    async def task_startup():
+        async def start():
+            async with build_client():
+                pass
+
+        await asyncio.to_thread(asyncio.run, start())
+
+    async def timed(run_cycle, due=True):
+        if due:
+            await sync_to_async(make_due)()
+        with count_queries() as counter:
+            started = time.perf_counter()
+            await run_cycle()
+            return time.perf_counter() - started, counter["queries"]
+
+    for name in ("monitor", "celery"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    try:
+        fleet.reset()
+        startup, _ = await timed(task_startup, due=False)
+        results = [await timed(task_cycle) for _ in range(cycles)]
+        idle = await timed(task_cycle, due=False)
+        report_poller(
+            command,
+            "task per cycle", fleet, len(ids), startup, results, idle, per_cycle=True
+        )
+
+        fleet.reset()
+        started = time.perf_counter()
+        async with Poller() as poller:
+            startup = time.perf_counter() - started
+            results = [await timed(poller.cycle) for _ in range(cycles)]
+            idle = await timed(poller.cycle, due=False)
+        report_poller(command, "poller", fleet, len(ids), startup, results, idle)
+    finally:
+        await sync_to_async(Machine.objects.filter(id__in=ids).delete)()
+
+
+def report_poller(command, label, fleet, count, startup, results, idle, per_cycle=False):
+    cycles = ", ".join(f"{duration:.2f}s/{queries}q" for duration, queries in results)
+    command.stdout.write(
+        f"{label:<20} N={count:<6} "
+        f"startup: {startup * 1000:.1f}ms {'per cycle' if per_cycle else 'once'}  "
+        f"cycles: {cycles}  idle cycle: {idle[0] * 1000:.1f}ms/{idle[1]}q  "
+        f"sockets opened: {fleet.connections_opened}"
+    )
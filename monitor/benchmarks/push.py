@@ -0,0 +1,78 @@
+import gzip
+import json
+import logging
+import time
+
+from django.test import RequestFactory
+
+from monitor.benchmarks.fleet import StubAgentFleet
+from monitor.benchmarks.utils import count_queries, throwaway_database
+from monitor.models import Machine
+from monitor.push import issue_token
+from monitor.views import api_ingest
+
+
+def run(command, options):
+    with throwaway_database():
+        bench_push(command, options["payloads"], options["batch"])
+
+
+def bench_push(command, count, batches):
+    """Push samples to /api/ingest/ in requests of several sizes.
+
+    Each request is authenticated, saved and checked for incidents as
+    it would be by a gunicorn worker, minus the HTTP parsing. The
+    machine is added to the throwaway database and deleted afterwards.
+    """
+    for name in ("monitor", "celery"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    machine = Machine.objects.create(
+        name="bench-push", url="http://bench-push.invalid/metrics"
+    )
+    headers = {"Authorization": f"Bearer {issue_token(machine)}"}
+    factory = RequestFactory()
+    fleet = StubAgentFleet()
+
+    try:
+        for batch in batches:
+            for label, compressed in [("json", False), ("gzip ndjson", True)]:
+                bodies = []
+                for _ in range(max(1, count // batch)):
+                    samples = [json.loads(fleet.payload()) for _ in range(batch)]
+                    if compressed:
+                        bodies.append(
+                            gzip.compress(
+                                b"\n".join(json.dumps(s).encode() for s in samples)
+                            )
+                        )
+                    else:
+                        bodies.append(json.dumps(samples).encode())
+
+                with count_queries() as counter:
+                    started = time.perf_counter()
+                    for body in bodies:
+                        request = factory.post(
+                            "/api/ingest/",
+                            body,
+                            content_type=(
+                                "application/x-ndjson" if compressed else "application/json"
+                            ),
+                            headers=(
+                                {**headers, "Content-Encoding": "gzip"}
+                                if compressed
+                                else headers
+                            ),
+                        )
+                        response = api_ingest(request)
+                        if response.status_code != 202:
+                            raise RuntimeError(response.content.decode())
+                    elapsed = time.perf_counter() - started
+                command.stdout.write(
+                    f"{label:<12} batch={batch:<5} requests={len(bodies):<6} "
+                    f"wall: {elapsed:.2f}s  "
+                    f"{len(bodies) * batch / elapsed:,.0f} samples/s  "
+                    f"{len(bodies) / elapsed:,.0f} requests/s  "
+                    f"queries/request: {counter['queries'] / len(bodies):.1f}"
+                )
+    finally:
+        machine.delete()
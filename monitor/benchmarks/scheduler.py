@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from monitor.benchmarks.utils import fleets, report
+from monitor.poll import PollStats, build_client, fetch_sample, stream_samples
+
+
+def run(command, options):
+    async def bench():
+        async for fleet, machines in fleets(options):
+            await bench_scheduler(
+                command, fleet, machines, options["cycles"], options["concurrency"]
+            )
+
+    asyncio.run(bench())
+
+
+async def bench_scheduler(command, fleet, machines, cycles, concurrency):
+    """Compare an unbounded gather against the bounded streaming scheduler."""
+
+    async def timed(client, machine):
+        started = time.perf_counter()
+        sample = await fetch_sample(client, machine)
+        return machine, sample, time.perf_counter() - started
+
+    async def gather_cycle(client):
+        return await asyncio.gather(*(timed(client, machine) for machine in machines))
+
+    async def stream_cycle(client):
+        return [
+            result
+            async for result in stream_samples(client, machines, concurrency)
+        ]
+
+    for label, run_cycle in [("gather", gather_cycle), ("bounded stream", stream_cycle)]:
+        fleet.reset()
+        durations = []
+        stats = PollStats()
+        async with build_client() as client:
+            for _ in range(cycles):
+                started = time.perf_counter()
+                for _, sample, latency in await run_cycle(client):
+                    stats.record(latency, ok=isinstance(sample, dict))
+                durations.append(time.perf_counter() - started)
+        report(command, label, fleet, machines, durations)
+        command.stdout.write(f"{'':<20} {stats}")
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import time
+
+from django.test import AsyncRequestFactory
+
+from monitor.benchmarks.utils import count_queries
+from monitor.events import get_broker, get_hub
+from monitor.poll import PollStats
+from monitor.views import api_incidents_stream
+
+
+def run(command, options):
+    asyncio.run(bench_stream(command, options["tabs"], options["polls"]))
+
+
+async def bench_stream(command, tab_counts, events):
+    """Push events to many open /api/incidents/stream/ connections."""
+    factory = AsyncRequestFactory()
+    broker = get_broker()
+    hub = get_hub()
+
+    async def tab(latencies):
+        request = factory.get("/api/incidents/stream/")
+        messages = aiter((await api_incidents_stream(request)).streaming_content)
+        received = 0
+        try:
+            while received < events:
+                message = (await anext(messages)).decode()
+                if "\nevent: opened\n" in message:
+                    data = json.loads(message.split("data: ", 1)[1])
+                    latencies.record(time.perf_counter() - data["sent"], ok=True)
+                    received += 1
+        finally:
+            await messages.aclose()
+
+    for tabs in tab_counts:
+        latencies = PollStats()
+        with count_queries() as counter:
+            started = time.perf_counter()
+            tasks = [asyncio.create_task(tab(latencies)) for _ in range(tabs)]
+            while len(hub.subscribers) < tabs:
+                await asyncio.sleep(0.01)
+            for i in range(events):
+                event = {
+                    "action": "opened",
+                    "incident": {"id": i, "sent": time.perf_counter()},
+                }
+                await asyncio.to_thread(broker.publish, [event])
+                await asyncio.sleep(0.05)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+        command.stdout.write(
+            f"{'stream':<14} tabs={tabs} events={events}  wall: {elapsed:.2f}s  "
+            f"delivery p50={latencies.percentile(50) * 1000:.1f}ms "
+            f"p99={latencies.percentile(99) * 1000:.1f}ms  "
+            f"queries: {counter['queries']}  "
+            f"(polling every 5s: {tabs / 5:.0f}+ queries/s)"
+        )
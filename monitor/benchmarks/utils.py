@@ -0,0 +1,117 @@
+import subprocess
+import sys
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+from monitor.benchmarks.fleet import StubAgentFleet
+from monitor.models import Machine
+
+
+@contextmanager
+def throwaway_database():
+    """Run the block against a new test database, destroyed afterwards.
+
+    Pollers claim every due machine of the database they run against, so
+    scenarios that poll or write must never run against the configured
+    one, which would poll real agents and mix benchmark rows with real
+    ones. The database user needs the right to create databases.
+    """
+    name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(name, verbosity=0)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries run by any thread while the block runs."""
+    counter = {"queries": 0}
+    execute = CursorWrapper.execute
+
+    def counting_execute(self, *args, **kwargs):
+        counter["queries"] += 1
+        return execute(self, *args, **kwargs)
+
+    CursorWrapper.execute = counting_execute
+    try:
+        yield counter
+    finally:
+        CursorWrapper.execute = execute
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process so far, in MB."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def join_chunks(chunks) -> bytes:
+    """Join the chunks of a streamed body, consuming async ones from sync code."""
+    if not hasattr(chunks, "__aiter__"):
+        return b"".join(chunks)
+
+    async def join():
+        return b"".join([chunk async for chunk in chunks])
+
+    return async_to_sync(join)()
+
+
+def read_body(response) -> bytes:
+    return join_chunks(response.streaming_content) if response.streaming else response.content
+
+
+def git_commit() -> str | None:
+    """The checked out commit, if this is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=settings.BASE_DIR,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def fleets(options, dark_rate: float = 0.0):
+    """Yield a stub agent fleet with unsaved machines for each of the --machines sizes."""
+    async with StubAgentFleet(
+        latency=options["latency"],
+        failure_rate=options["failure_rate"],
+        dark_rate=dark_rate,
+        distribution=options["distribution"],
+    ) as fleet:
+        for count in options["machines"]:
+            yield fleet, [
+                Machine(id=i + 1, name=f"agent-{i}", url=fleet.url(i)) for i in range(count)
+            ]
+
+
+async def add_machines(machines):
+    """Save the fleet's machines to the throwaway database, return them as a queryset."""
+    for machine in machines:
+        machine.id = None
+    await sync_to_async(Machine.objects.bulk_create)(machines, batch_size=1000)
+    # The throwaway database holds no other machine.
+    return Machine.objects.all()
+
+
+def report(command, label, fleet, machines, durations):
+    cycles = ", ".join(f"{duration:.2f}s" for duration in durations)
+    command.stdout.write(
+        f"{label:<20} N={len(machines):<6} cycles: {cycles}  "
+        f"sockets opened: {fleet.connections_opened}  "
+        f"peak open: {fleet.peak_connections}"
+    )
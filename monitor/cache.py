@@ -0,0 +1,491 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+# Headers kept with a cached body.
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Cache-Control")
+# Request headers the cache answers itself, see cache_response.
+CONDITIONAL_HEADERS = ("HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE")
+# Seconds between checks for a response being computed by another request.
+WAIT_INTERVAL = 0.01
+
+
+class CachedResponse:
+    """A ready-to-send response body and the headers it is served with."""
+
+    def __init__(self, body: bytes, headers: dict[str, str]):
+        self.body = body
+        self.headers = headers
+
+    @classmethod
+    def from_response(cls, response, body: bytes | None = None) -> "CachedResponse":
+        return cls(
+            response.content if body is None else body,
+            {name: response[name] for name in CACHED_HEADERS if response.has_header(name)},
+        )
+
+    def dump(self) -> bytes:
+        return json.dumps(self.headers).encode() + b"\n" + self.body
+
+    @classmethod
+    def load(cls, data: bytes) -> "CachedResponse":
+        headers, _, body = data.partition(b"\n")
+        return cls(body, json.loads(headers))
+
+    def conditional(self, request, response):
+        """``response``, or 304 when the request's validators still match."""
+        last_modified = self.headers.get("Last-Modified")
+        return get_conditional_response(
+            request,
+            etag=self.headers.get("ETag"),
+            last_modified=last_modified and parse_http_date_safe(last_modified),
+            response=response,
+        )
+
+    def response(self, request):
+        """The response to serve, or 304 when the request's validators still match."""
+        response = HttpResponse(self.body)
+        for name, value in self.headers.items():
+            response[name] = value
+        return self.conditional(request, response)
+
+
+class BoundedBody:
+    """Chunks of a streamed body, dropped as soon as they exceed ``max_bytes``."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.chunks: list[bytes] | None = []
+
+    def append(self, chunk: bytes):
+        if self.chunks is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            self.chunks = None
+        else:
+            self.chunks.append(chunk)
+
+    def join(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+class LocalResponseCache:
+    """Responses held in the memory of the current process.
+
+    Only invalidated by writes of the same process, so only used when
+    RESPONSE_CACHE_LOCAL says the API runs in a single process that also
+    does every write, use the Redis cache otherwise. The least recently
+    used entries are dropped once the bodies held exceed ``max_bytes``.
+    """
+
+    def __init__(self, ttl: float, lock_timeout: float, max_bytes: int):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[CachedResponse, float]] = OrderedDict()
+        self._size = 0
+        self._generations: dict[str, int] = {}
+        # Keys being computed, until when and by whom.
+        self._computing: dict[str, tuple[float, str]] = {}
+        self._stats: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generations(self, namespaces) -> list[int]:
+        with self._lock:
+            return [self._generations.get(namespace, 0) for namespace in namespaces]
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[1] < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, entry: CachedResponse, ttl: float | None = None):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (entry, time.monotonic() + (ttl or self.ttl))
+            self._size += len(entry.body)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._size -= len(item[0].body)
+
+    def lock(self, key: str) -> str | None:
+        """Take the right to compute ``key``, None if another request has it.
+
+        Returns the token to unlock it with.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._computing.get(key, (0,))[0] > now:
+                return None
+            token = uuid.uuid4().hex
+            self._computing[key] = (now + self.lock_timeout, token)
+            return token
+
+    def unlock(self, key: str, token: str | None):
+        """Release ``key`` if it is still locked with ``token``."""
+        with self._lock:
+            if token is not None and self._computing.get(key, (0, None))[1] == token:
+                del self._computing[key]
+
+    def invalidate(self, namespaces):
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] = self._generations.get(namespace, 0) + 1
+                name = f"invalidations:{namespace}"
+                self._stats[name] = self._stats.get(name, 0) + 1
+
+    def count(self, name: str):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._generations.clear()
+            self._computing.clear()
+            self._stats.clear()
+
+
+class RedisResponseCache:
+    """Responses shared by every API process through Redis.
+
+    A namespace's generation is a counter bumped by every write the
+    namespace's responses depend on. Keys embed the generations, so an
+    invalidation makes every dependent entry unreachable at once and
+    entries computed from data read before it are never served after it.
+    """
+
+    PREFIX = "response-cache"
+
+    # Deletes KEYS[1] only if it holds ARGV[1].
+    UNLOCK = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, ttl: float, lock_timeout: float):
+        import redis
+
+        self.ttl = int(ttl)
+        self.lock_timeout = lock_timeout
+        self.client = redis.Redis.from_url(url)
+        self._unlock = self.client.register_script(self.UNLOCK)
+
+    def generations(self, namespaces) -> list[int]:
+        values = self.client.mget([f"{self.PREFIX}:gen:{namespace}" for namespace in namespaces])
+        return [int(value or 0) for value in values]
+
+    def get(self, key: str) -> CachedResponse | None:
+        data = self.client.get(f"{self.PREFIX}:{key}")
+        return CachedResponse.load(data) if data is not None else None
+
+    def set(self, key: str, entry: CachedResponse, ttl: float | None = None):
+        self.client.set(f"{self.PREFIX}:{key}", entry.dump(), ex=int(ttl or self.ttl))
+
+    def lock(self, key: str) -> str | None:
+        """Take the right to compute ``key``, None if another request has it.
+
+        Returns the token to unlock it with, so that a request whose lock
+        expired never releases the lock taken by the next one.
+        """
+        token = uuid.uuid4().hex
+        taken = self.client.set(
+            f"{self.PREFIX}:lock:{key}", token, nx=True, px=int(self.lock_timeout * 1000)
+        )
+        return token if taken else None
+
+    def unlock(self, key: str, token: str | None):
+        """Release ``key`` if it is still locked with ``token``."""
+        if token is not None:
+            self._unlock(keys=[f"{self.PREFIX}:lock:{key}"], args=[token])
+
+    def invalidate(self, namespaces):
+        pipeline = self.client.pipeline(transaction=False)
+        for namespace in namespaces:
+            pipeline.incr(f"{self.PREFIX}:gen:{namespace}")
+            pipeline.hincrby(f"{self.PREFIX}:stats", f"invalidations:{namespace}", 1)
+        pipeline.execute()
+
+    def count(self, name: str):
+        self.client.hincrby(f"{self.PREFIX}:stats", name, 1)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            name.decode(): int(value)
+            for name, value in self.client.hgetall(f"{self.PREFIX}:stats").items()
+        }
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.PREFIX}:*"):
+            self.client.delete(key)
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the response cache configured by RESPONSE_CACHE_URL.
+
+    Responses are only cached in process memory when RESPONSE_CACHE_LOCAL
+    is set, see cache_enabled.
+    """
+    global _cache
+    if _cache is None:
+        if settings.RESPONSE_CACHE_URL:
+            _cache = RedisResponseCache(
+                settings.RESPONSE_CACHE_URL,
+                settings.RESPONSE_CACHE_TTL,
+                settings.RESPONSE_CACHE_LOCK_TIMEOUT,
+            )
+        else:
+            _cache = LocalResponseCache(
+                settings.RESPONSE_CACHE_TTL,
+                settings.RESPONSE_CACHE_LOCK_TIMEOUT,
+                settings.RESPONSE_CACHE_MAX_BYTES,
+            )
+    return _cache
+
+
+def cache_enabled() -> bool:
+    """Whether responses are cached at all.
+
+    Writes by Celery workers and other API processes never reach the
+    in-memory cache of this one, so without Redis the cache is off unless
+    RESPONSE_CACHE_LOCAL says this process is the only one.
+    """
+    return bool(settings.RESPONSE_CACHE_TTL) and bool(
+        settings.RESPONSE_CACHE_URL or settings.RESPONSE_CACHE_LOCAL
+    )
+
+
+def invalidate(*namespaces: str):
+    """Drop the cached responses depending on ``namespaces``."""
+    get_cache().invalidate(namespaces)
+    # Again once committed, in case a reader cached the old rows meanwhile.
+    transaction.on_commit(lambda: get_cache().invalidate(namespaces))
+
+
+def cache_key(name: str, generations: list[int], request) -> str:
+    query = sorted(request.GET.lists())
+    digest = hashlib.md5(json.dumps([request.method, query]).encode()).hexdigest()
+    return f"{name}:{'.'.join(map(str, generations))}:{digest}"
+
+
+def cache_response(*namespaces: str, ttl: float | None = None):
+    """Cache the 200 responses of a GET view until one of ``namespaces`` is invalidated.
+
+    Entries expire after ``ttl`` seconds, RESPONSE_CACHE_TTL by default,
+    which bounds how stale data written without invalidation gets. One
+    entry is kept per query string. Bodies over
+    RESPONSE_CACHE_MAX_ENTRY_BYTES are not cached, so a streamed response
+    is buffered only up to that size and cached once it has been sent
+    whole, a larger one is passed on without being kept. Concurrent
+    misses of the same entry are computed once: the first request
+    computes it and the others wait for it, up to
+    RESPONSE_CACHE_LOCK_TIMEOUT, or compute theirs as soon as it turns
+    out not to be cacheable or the computing request fails. The cache
+    answers conditional requests from the entry's ETag and Last-Modified
+    itself, the view is always called without them so that its full
+    response can be cached. Responses carry ``X-Cache`` (hit, miss or
+    coalesced) and are counted per view, see /api/cache/.
+
+    Async views are supported, the cache is then used from a thread so
+    that Redis round trips never block the event loop.
+    """
+
+    def decorator(view):
+        name = view.__name__
+
+        def cacheable(request) -> bool:
+            return cache_enabled() and request.method in ("GET", "HEAD")
+
+        def lookup(request) -> tuple[str, CachedResponse | None, str | None]:
+            """The key of a request, its entry, and a lock token if the request computes it."""
+            cache = get_cache()
+            key = cache_key(name, cache.generations(namespaces), request)
+            entry = cache.get(key)
+            return key, entry, cache.lock(key) if entry is None else None
+
+        def poll(key) -> tuple[CachedResponse | None, bool]:
+            """The entry computed by another request, and whether that request gave up.
+
+            The computing request releases the lock without an entry when
+            its response is not cacheable, every waiter then computes its
+            own rather than queueing for the lock one after the other.
+            """
+            cache = get_cache()
+            if (entry := cache.get(key)) is not None:
+                return entry, False
+            token = cache.lock(key)
+            if token is None:
+                return None, False
+            cache.unlock(key, token)
+            # Cached between both reads.
+            entry = cache.get(key)
+            return entry, entry is None
+
+        @contextmanager
+        def unconditional(request):
+            conditional = {
+                header: request.META.pop(header)
+                for header in CONDITIONAL_HEADERS
+                if header in request.META
+            }
+            try:
+                yield
+            finally:
+                request.META.update(conditional)
+
+        def store(request, key, token, response):
+            """Cache the response of the view, return the response to send."""
+            cache = get_cache()
+            if response.status_code != 200:
+                cache.unlock(key, token)
+                return response
+            if not response.streaming:
+                entry = CachedResponse.from_response(response)
+                if len(entry.body) <= settings.RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                    cache.set(key, entry, ttl)
+                cache.unlock(key, token)
+                return served(request, entry, "miss")
+
+            validators = CachedResponse.from_response(response, b"")
+            if (not_modified := validators.conditional(request, response)) is not response:
+                response.close()
+                cache.unlock(key, token)
+                return not_modified
+            cache.count(f"{name}:miss")
+            filling = afilling if response.is_async else sfilling
+            response.streaming_content = filling(
+                key, token, response, response.streaming_content
+            )
+            response["X-Cache"] = "miss"
+            return response
+
+        def sfilling(key, token, response, content):
+            """Pass the chunks of a streamed response on, then cache them if small enough."""
+            body = BoundedBody(settings.RESPONSE_CACHE_MAX_ENTRY_BYTES)
+            try:
+                for chunk in content:
+                    body.append(chunk)
+                    yield chunk
+                if body.chunks is not None:
+                    entry = CachedResponse.from_response(response, body.join())
+                    get_cache().set(key, entry, ttl)
+            finally:
+                get_cache().unlock(key, token)
+
+        async def afilling(key, token, response, content):
+            body = BoundedBody(settings.RESPONSE_CACHE_MAX_ENTRY_BYTES)
+            try:
+                async for chunk in content:
+                    body.append(chunk)
+                    yield chunk
+                if body.chunks is not None:
+                    entry = CachedResponse.from_response(response, body.join())
+                    await asyncio.to_thread(get_cache().set, key, entry, ttl)
+            finally:
+                await asyncio.to_thread(get_cache().unlock, key, token)
+
+        def served(request, entry, outcome):
+            get_cache().count(f"{name}:{outcome}")
+            response = entry.response(request)
+            response["X-Cache"] = outcome
+            return response
+
+        if iscoroutinefunction(view):
+
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if not cacheable(request):
+                    return await view(request, *args, **kwargs)
+
+                key, entry, token = await asyncio.to_thread(lookup, request)
+                if entry is not None:
+                    return await asyncio.to_thread(served, request, entry, "hit")
+                if token is None:
+                    deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_TIMEOUT
+                    while time.monotonic() < deadline:
+                        await asyncio.sleep(WAIT_INTERVAL)
+                        entry, released = await asyncio.to_thread(poll, key)
+                        if entry is not None:
+                            return await asyncio.to_thread(served, request, entry, "coalesced")
+                        if released:
+                            break
+                    else:
+                        # The computing request is too slow, compute it here.
+                        token = await asyncio.to_thread(get_cache().lock, key)
+
+                try:
+                    with unconditional(request):
+                        response = await view(request, *args, **kwargs)
+                except BaseException:
+                    await asyncio.to_thread(get_cache().unlock, key, token)
+                    raise
+                return await asyncio.to_thread(store, request, key, token, response)
+
+        else:
+
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not cacheable(request):
+                    return view(request, *args, **kwargs)
+
+                key, entry, token = lookup(request)
+                if entry is not None:
+                    return served(request, entry, "hit")
+                if token is None:
+                    deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_TIMEOUT
+                    while time.monotonic() < deadline:
+                        time.sleep(WAIT_INTERVAL)
+                        entry, released = poll(key)
+                        if entry is not None:
+                            return served(request, entry, "coalesced")
+                        if released:
+                            break
+                    else:
+                        # The computing request is too slow, compute it here.
+                        token = get_cache().lock(key)
+
+                try:
+                    with unconditional(request):
+                        response = view(request, *args, **kwargs)
+                except BaseException:
+                    get_cache().unlock(key, token)
+                    raise
+                return store(request, key, token, response)
+
+        return wrapper
+
+    return decorator
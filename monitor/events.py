@@ -0,0 +1,272 @@
+import asyncio
+import json
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Seconds a broker read blocks before the hub polls it again.
+READ_TIMEOUT = 5.0
+# Events buffered for one client before its stream is closed as too slow.
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+RESET = {"action": "reset"}
+# First event of a new stream, once it is subscribed.
+READY = {"action": "ready"}
+
+
+def opened_event(incident) -> dict:
+    return {"action": "opened", "incident": incident.to_dict()}
+
+
+def resolved_event(incident_id: int, machine_name: str, type_: str, end_time) -> dict:
+    return {
+        "action": "resolved",
+        "incident": {
+            "id": incident_id,
+            "machine": machine_name,
+            "type": type_,
+            "end_time": end_time.isoformat(),
+        },
+    }
+
+
+def publish(events: list[dict]):
+    """Publish incident events once the current transaction commits.
+
+    Publishing is best effort: clients that miss an event catch up from
+    the database when they reconnect.
+    """
+    if events:
+        transaction.on_commit(lambda: _publish(events))
+
+
+def _publish(events):
+    try:
+        get_broker().publish(events)
+    except Exception as e:
+        logger.error(f"Failed to publish {len(events)} incident events: {e}")
+
+
+class LocalEventBroker:
+    """Incident events kept in the memory of the current process.
+
+    Only reaches clients served by the process that evaluated the
+    incidents, use the Redis broker when Celery workers and the web server
+    are separate processes.
+    """
+
+    def __init__(self, backlog: int):
+        self._events: deque[tuple[int, dict]] = deque(maxlen=backlog)
+        self._last_id = 0
+        self._changed = threading.Condition()
+
+    @staticmethod
+    def parse_id(event_id: str) -> int:
+        return int(event_id)
+
+    def publish(self, events: list[dict]) -> None:
+        with self._changed:
+            for event in events:
+                self._last_id += 1
+                self._events.append((self._last_id, event))
+            self._changed.notify_all()
+
+    def latest_id(self) -> str:
+        with self._changed:
+            return str(self._last_id)
+
+    def read(self, after: str, timeout: float) -> list[tuple[str, dict]]:
+        """Return the events after ``after``, waiting up to ``timeout`` for one."""
+        after = self.parse_id(after)
+        with self._changed:
+            self._changed.wait_for(lambda: self._last_id > after, timeout)
+            return [(str(id_), event) for id_, event in self._events if id_ > after]
+
+    def backlog(self, after: str) -> list[tuple[str, dict]] | None:
+        """Return the events after ``after``, or None if some are no longer kept."""
+        after = self.parse_id(after)
+        with self._changed:
+            first_id = self._events[0][0] if self._events else self._last_id + 1
+            if after > self._last_id or after < first_id - 1:
+                return None
+            return [(str(id_), event) for id_, event in self._events if id_ > after]
+
+
+class RedisEventBroker:
+    """Incident events shared by every process through a Redis stream.
+
+    The stream is capped at about ``backlog`` entries, which is how far
+    back a reconnecting client can resume.
+    """
+
+    KEY = "incident-events"
+
+    def __init__(self, url: str, backlog: int):
+        import redis
+
+        self.backlog_size = backlog
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def parse_id(event_id: str) -> tuple[int, int]:
+        milliseconds, _, sequence = event_id.partition("-")
+        return int(milliseconds), int(sequence or 0)
+
+    @staticmethod
+    def _load(entries) -> list[tuple[str, dict]]:
+        return [(id_, json.loads(fields["d"])) for id_, fields in entries]
+
+    def publish(self, events: list[dict]) -> None:
+        pipeline = self.client.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(
+                self.KEY, {"d": json.dumps(event)}, maxlen=self.backlog_size, approximate=True
+            )
+        pipeline.execute()
+
+    def latest_id(self) -> str:
+        entries = self.client.xrevrange(self.KEY, count=1)
+        return entries[0][0] if entries else "0-0"
+
+    def read(self, after: str, timeout: float) -> list[tuple[str, dict]]:
+        self.parse_id(after)
+        streams = self.client.xread({self.KEY: after}, block=int(timeout * 1000))
+        return self._load(streams[0][1]) if streams else []
+
+    def backlog(self, after: str) -> list[tuple[str, dict]] | None:
+        # The entry the client saw last must still be there, otherwise the
+        # entries right after it may have been trimmed.
+        after_key = self.parse_id(after)
+        first = self.client.xrange(self.KEY, count=1)
+        if first and after_key < self.parse_id(first[0][0]):
+            return None
+        if after_key > self.parse_id(self.latest_id()):
+            return None
+        return self._load(self.client.xrange(self.KEY, min=f"({after}", max="+"))
+
+
+_broker = None
+
+
+def get_broker():
+    """Return the incident event broker configured by INCIDENT_EVENTS_URL."""
+    global _broker
+    if _broker is None:
+        if settings.INCIDENT_EVENTS_URL:
+            _broker = RedisEventBroker(
+                settings.INCIDENT_EVENTS_URL, settings.INCIDENT_EVENTS_BACKLOG
+            )
+        else:
+            _broker = LocalEventBroker(settings.INCIDENT_EVENTS_BACKLOG)
+    return _broker
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue[tuple[str, dict]] = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, event_id: str, event: dict):
+        try:
+            self.queue.put_nowait((event_id, event))
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class EventHub:
+    """Fans the broker's events out to every stream served by this process.
+
+    One reader task waits on the broker however many clients are
+    connected, so clients cost neither database queries nor broker reads.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscribers: set[Subscriber] = set()
+        self._reader: asyncio.Task | None = None
+
+    def _start(self, after: str):
+        # A reader left over from another event loop, as in tests, is dead.
+        if (
+            self._reader is None
+            or self._reader.done()
+            or self._reader.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._reader = asyncio.create_task(self._read(after))
+
+    async def _read(self, after: str):
+        while True:
+            try:
+                events = await asyncio.to_thread(self.broker.read, after, READ_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Failed to read incident events: {e}")
+                await asyncio.sleep(1)
+                continue
+            for event_id, event in events:
+                after = event_id
+                for subscriber in list(self.subscribers):
+                    subscriber.put(event_id, event)
+
+    async def stream(self, last_event_id: str | None = None, keepalive: float | None = None):
+        """Yield ``(event_id, event)`` pairs as incidents open and resolve.
+
+        With ``last_event_id`` the events published since are replayed
+        first. If some of them are no longer kept a reset event tells the
+        client to reload the list instead. Without it a ready event comes
+        first, once every later event is sure to be streamed, so a client
+        loads the list after it and misses nothing. ``(None, None)`` is
+        yielded when nothing happened for ``keepalive`` seconds.
+
+        The stream ends if the client falls too far behind, it resumes
+        from the last event it received when it reconnects.
+        """
+        keepalive = keepalive or settings.INCIDENT_EVENTS_KEEPALIVE
+        subscriber = Subscriber()
+        # Subscribe before reading the backlog so that no event falls in
+        # between, duplicates are skipped by id.
+        self.subscribers.add(subscriber)
+        try:
+            position = await asyncio.to_thread(self.broker.latest_id)
+            self._start(position)
+
+            if not last_event_id:
+                yield position, READY
+            else:
+                try:
+                    backlog = await asyncio.to_thread(self.broker.backlog, last_event_id)
+                except ValueError:
+                    backlog = None
+                if backlog is None:
+                    yield position, RESET
+                else:
+                    for event_id, event in backlog:
+                        yield event_id, event
+                        position = event_id
+
+            seen = self.broker.parse_id(position)
+            while not subscriber.overflowed:
+                try:
+                    event_id, event = await asyncio.wait_for(subscriber.queue.get(), keepalive)
+                except TimeoutError:
+                    yield None, None
+                    continue
+                if self.broker.parse_id(event_id) > seen:
+                    seen = self.broker.parse_id(event_id)
+                    yield event_id, event
+        finally:
+            self.subscribers.discard(subscriber)
+
+
+_hub = None
+
+
+def get_hub() -> EventHub:
+    global _hub
+    if _hub is None:
+        _hub = EventHub(get_broker())
+    return _hub
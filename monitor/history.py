@@ -0,0 +1,150 @@
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+
+from monitor.models import Metric, MetricRollup, RollupWatermark
+from monitor.rollup import FIELDS, RESOLUTIONS, bucket_start
+
+# Columns of a downsampled series besides its bucket times.
+COLUMNS = ("samples", *(f"{field}_{agg}" for field in FIELDS for agg in ("min", "avg", "max")))
+# Longest range read from raw metrics, so a missing watermark or steps
+# under a minute never scan days of them.
+RAW_MAX_RANGE = timedelta(hours=6)
+
+
+def pick_resolution(step: int) -> str | None:
+    """The coarsest rollup resolution no longer than a step of ``step`` seconds.
+
+    None means buckets are smaller than a minute and are built from raw
+    metrics.
+    """
+    for resolution in ("1d", "1h", "1m"):
+        if RESOLUTIONS[resolution].total_seconds() <= step:
+            return resolution
+    return None
+
+
+class Bucket:
+    """Running count, min, max and sum of each field over one bucket."""
+
+    __slots__ = ("samples", "mins", "maxs", "sums")
+
+    def __init__(self):
+        self.samples = 0
+        self.mins = [math.inf] * len(FIELDS)
+        self.maxs = [-math.inf] * len(FIELDS)
+        self.sums = [0.0] * len(FIELDS)
+
+    def add(self, samples: int, mins, maxs, avgs):
+        self.samples += samples
+        for i in range(len(FIELDS)):
+            self.mins[i] = min(self.mins[i], mins[i])
+            self.maxs[i] = max(self.maxs[i], maxs[i])
+            self.sums[i] += avgs[i] * samples
+
+    def row(self) -> list:
+        row = [self.samples]
+        for i in range(len(FIELDS)):
+            row += [
+                round(self.mins[i], 2),
+                round(self.sums[i] / self.samples, 2),
+                round(self.maxs[i], 2),
+            ]
+        return row
+
+
+def downsample(
+    machine_ids: list[int], since: datetime, until: datetime, points: int
+) -> tuple[int, str, dict[int, dict[str, list]]]:
+    """Downsample the history of machines over ``[since, until)`` to about ``points`` buckets.
+
+    Buckets are ``step`` seconds long, aligned on the epoch so a refreshed
+    chart keeps its buckets, and hold the sample count and the min, avg
+    and max of each field. They are built from the coarsest rollups that
+    fit in a step, so a month costs hundreds of rows per machine rather
+    than tens of thousands, and from raw metrics past the last rollup of
+    each machine, which is not rolled up yet. Raw metrics are never read
+    further back than one bucket before the rollup watermark, or than
+    RAW_MAX_RANGE before ``until`` when nothing was rolled up yet, so a
+    machine whose rollups are missing or lag behind costs no full scan:
+    the range without rollups is a gap. Steps are under a minute, and
+    built from raw metrics only, for ranges up to RAW_MAX_RANGE. Empty
+    buckets are left out.
+
+    Returns the step, the source (a rollup resolution or ``raw``) and a
+    columnar series per machine: ``t`` (bucket start, epoch seconds) and
+    COLUMNS, one list each, and ``gaps``, the ``[start, end)`` ranges in
+    epoch seconds that have no rollups and were not read from raw metrics.
+    """
+    step = max(math.ceil((until - since).total_seconds() / points), 1)
+    if until - since > RAW_MAX_RANGE:
+        step = max(step, int(RESOLUTIONS["1m"].total_seconds()))
+    resolution = pick_resolution(step)
+    buckets = {machine_id: defaultdict(Bucket) for machine_id in machine_ids}
+    gaps = {machine_id: [] for machine_id in machine_ids}
+
+    raw_since = dict.fromkeys(machine_ids, since)
+    if resolution is not None:
+        size = RESOLUTIONS[resolution]
+        columns = [f"{field}_{agg}" for agg in ("min", "max", "avg") for field in FIELDS]
+        rollups = (
+            MetricRollup.objects.filter(
+                machine_id__in=machine_ids,
+                resolution=resolution,
+                bucket__gte=bucket_start(since, resolution),
+                bucket__lt=until,
+            )
+            .order_by("machine_id", "bucket")
+            .values_list("machine_id", "bucket", "samples", *columns)
+        )
+        n = len(FIELDS)
+        for machine_id, bucket, samples, *values in rollups.iterator(chunk_size=5000):
+            buckets[machine_id][int(bucket.timestamp()) // step].add(
+                samples, values[:n], values[n : 2 * n], values[2 * n :]
+            )
+            if bucket > raw_since[machine_id]:
+                gaps[machine_id].append((raw_since[machine_id], bucket))
+            raw_since[machine_id] = max(raw_since[machine_id], bucket + size)
+
+        rolled_up = (
+            RollupWatermark.objects.filter(resolution=resolution)
+            .values_list("position", flat=True)
+            .first()
+        )
+        if rolled_up is None:
+            floor = until - RAW_MAX_RANGE
+        else:
+            floor = min(rolled_up - size, until)
+        for machine_id, start in raw_since.items():
+            if start < floor:
+                gaps[machine_id].append((start, floor))
+                raw_since[machine_id] = floor
+
+    if raw_since:
+        tails = Q()
+        for start in set(raw_since.values()):
+            ids = [machine_id for machine_id, since_ in raw_since.items() if since_ == start]
+            tails |= Q(machine_id__in=ids, timestamp__gte=start)
+        raw = Metric.objects.filter(tails, timestamp__lt=until).values_list(
+            "machine_id", "timestamp", *FIELDS
+        )
+        for machine_id, timestamp, *values in raw.iterator(chunk_size=5000):
+            buckets[machine_id][int(timestamp.timestamp()) // step].add(
+                1, values, values, values
+            )
+
+    series = {}
+    for machine_id, machine_buckets in buckets.items():
+        indexes = sorted(machine_buckets)
+        rows = [machine_buckets[index].row() for index in indexes]
+        series[machine_id] = {
+            "t": [index * step for index in indexes],
+            **{column: [row[i] for row in rows] for i, column in enumerate(COLUMNS)},
+            "gaps": [
+                [int(start.timestamp()), int(end.timestamp())]
+                for start, end in gaps[machine_id]
+            ],
+        }
+    return step, resolution or "raw", series
@@ -1,12 +1,25 @@
 import logging
+import time
+from collections import defaultdict, deque
 from datetime import timedelta
 
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from monitor.models import THRESHOLDS, Incident, Metric
+from monitor.cache import invalidate
+from monitor.events import opened_event, publish, resolved_event
+from monitor.models import THRESHOLDS, Incident, Machine, Metric
+from monitor.state import StateConflict, StateEntry, StateKey, StatePending, get_store
+from monitor.window import SlidingWindow, get_window, sync_windows
 
 logger = logging.getLogger(__name__)
 
+METRIC_FIELDS = {"CPU": "cpu", "MEM": "mem", "DISK": "disk"}
+# Incident types whose state is kept in the state store.
+STATE_TYPES = [*METRIC_FIELDS, "UNREACHABLE"]
+
 
 def check_cpu(metric: Metric) -> Incident | None:
     """Check CPU threshold for a single metric."""
@@ -33,6 +46,7 @@ def check_cpu(metric: Metric) -> Incident | None:
 def check_mem(metric: Metric) -> Incident | None:
     """Check memory threshold for a single metric."""
     since = timezone.now() - timedelta(minutes=THRESHOLDS["MEM"]["duration"])
+    window = record_sample(metric, "MEM")
 
     if float(metric.mem) > THRESHOLDS["MEM"]["value"]:
         recent_incident = (
@@ -40,7 +54,7 @@ def check_mem(metric: Metric) -> Incident | None:
             .filter(machine=metric.machine, type="MEM", start_time__gte=since)
             .first()
         )
-        if not recent_incident:
+        if not recent_incident and window.sustained(metric.timestamp):
             incident = get_or_create_incident(metric.machine, "MEM", metric.mem)
             if incident:
                 logger.info(
@@ -63,6 +77,7 @@ def check_mem(metric: Metric) -> Incident | None:
 def check_disk(metric: Metric) -> Incident | None:
     """Check disk threshold for a single metric."""
     since = timezone.now() - timedelta(minutes=THRESHOLDS["DISK"]["duration"])
+    window = record_sample(metric, "DISK")
 
     if float(metric.disk) > THRESHOLDS["DISK"]["value"]:
         recent_incident = (
@@ -70,7 +85,7 @@ def check_disk(metric: Metric) -> Incident | None:
             .filter(machine=metric.machine, type="DISK", start_time__gte=since)
             .first()
         )
-        if not recent_incident:
+        if not recent_incident and window.sustained(metric.timestamp):
             incident = get_or_create_incident(metric.machine, "DISK", metric.disk)
             if incident:
                 logger.info(
@@ -90,6 +105,71 @@ def check_disk(metric: Metric) -> Incident | None:
     return None
 
 
+def record_sample(metric: Metric, type_: str) -> SlidingWindow:
+    """Push a metric into the sliding window of its machine and incident type."""
+    sync_windows(get_store().count_evaluations([metric.machine_id]))
+    load_window_history([metric])
+    window = get_window(metric.machine_id, type_)
+    window.push(metric.id, metric.timestamp, getattr(metric, METRIC_FIELDS[type_]))
+    return window
+
+
+def load_window_history(metrics: list[Metric]):
+    """Load older samples into windows too short to decide on an incident.
+
+    Only windows of a metric over its threshold that do not reach back a
+    whole duration are filled, with one query for all of them. Once the
+    process has been evaluating a machine for longer than the duration its
+    windows are complete and this costs nothing, until another process
+    evaluates the machine and sync_windows drops them.
+    """
+    needed = {}
+    for metric in metrics:
+        for type_, field in METRIC_FIELDS.items():
+            threshold = THRESHOLDS[type_]
+            if not threshold["duration"] or float(getattr(metric, field)) <= threshold["value"]:
+                continue
+            key = (metric.machine_id, type_)
+            if get_window(*key).covers(metric.timestamp):
+                continue
+            # Twice the duration, to also find the sample before the window start.
+            start = metric.timestamp - 2 * timedelta(minutes=threshold["duration"])
+            needed[key] = min(needed.get(key, start), start)
+    if not needed:
+        return
+
+    # Only samples taken before the batch, so that every metric is
+    # evaluated against the samples that came before it.
+    before = {}
+    for metric in metrics:
+        before[metric.machine_id] = min(
+            before.get(metric.machine_id, metric.timestamp), metric.timestamp
+        )
+
+    history = defaultdict(list)
+    rows = (
+        Metric.objects.filter(
+            machine_id__in={machine_id for machine_id, _ in needed},
+            timestamp__gte=min(needed.values()),
+            timestamp__lt=max(before.values()),
+        )
+        .order_by("id")
+        .values_list("id", "machine_id", "timestamp", *METRIC_FIELDS.values())
+    )
+    for id_, machine_id, timestamp, *values in rows:
+        if timestamp < before[machine_id]:
+            history[machine_id].append((id_, timestamp, dict(zip(METRIC_FIELDS, values))))
+
+    for (machine_id, type_), start in needed.items():
+        get_window(machine_id, type_).extend(
+            [
+                (id_, timestamp, values[type_])
+                for id_, timestamp, values in history[machine_id]
+                if timestamp >= start
+            ]
+        )
+
+
 def get_or_create_incident(machine, type_, value):
     """Create a new incident if one doesn't already exist."""
     if not Incident.objects.filter(
@@ -101,3 +181,289 @@ def get_or_create_incident(machine, type_, value):
             value=value,
         )
     return None
+
+
+INCIDENT_STATE_ATTEMPTS = 3
+# Seconds to wait for pending incident state before the next attempt.
+INCIDENT_STATE_PENDING_WAIT = 0.05
+
+
+def state_horizon(now):
+    """Incidents started before this time no longer affect any threshold."""
+    return now - timedelta(
+        minutes=max(threshold["duration"] for threshold in THRESHOLDS.values())
+    )
+
+
+def load_incident_state(machine_ids, since) -> dict[StateKey, StateEntry]:
+    """Read the incident state of machines from the database with one query."""
+    open_ids = defaultdict(list)
+    last_start = {}
+    incidents = (
+        Incident.objects.filter(
+            Q(end_time__isnull=True) | Q(start_time__gte=since),
+            machine_id__in=machine_ids,
+        )
+        .order_by("id")
+        .values_list("id", "machine_id", "type", "start_time", "end_time")
+    )
+    for id_, machine_id, type_, start_time, end_time in incidents:
+        key = (machine_id, type_)
+        if end_time is None:
+            open_ids[key].append(id_)
+        if key not in last_start or start_time > last_start[key]:
+            last_start[key] = start_time
+
+    return {
+        (machine_id, type_): (
+            tuple(open_ids[(machine_id, type_)]),
+            last_start.get((machine_id, type_)),
+        )
+        for machine_id in machine_ids
+        for type_ in STATE_TYPES
+    }
+
+
+def warm_incident_state():
+    """Load the incident state of every machine into the state store."""
+    machine_ids = list(Machine.objects.values_list("id", flat=True))
+    try:
+        get_store().populate(load_incident_state(machine_ids, state_horizon(timezone.now())))
+    except StatePending:
+        # The other keys are stored, pending ones are written by their claimer.
+        pass
+    logger.info(f"Warmed incident state for {len(machine_ids)} machines")
+
+
+def evaluate_metrics(metrics: list[Metric]) -> tuple[list[Incident], list[int]]:
+    """Check CPU, memory and disk thresholds for a batch of metrics at once.
+
+    Gives the same result as running check_cpu, check_mem and check_disk on
+    every metric in order. Which incidents are open and when the last one
+    started comes from the incident state store, and whether MEM and DISK
+    stayed over their threshold for the whole duration comes from the
+    sliding windows, so a batch of healthy machines costs no queries at
+    all. State missing from the store is loaded from the database with one
+    query. Changes are published to the incident event stream on commit.
+    Returns the opened incidents and the ids of the closed ones.
+    """
+    if not metrics:
+        return [], []
+    return _with_retries(_evaluate_metrics, metrics)
+
+
+def evaluate_reachability(
+    results: list[tuple[Machine, int]],
+) -> tuple[list[Incident], list[int]]:
+    """Open and close UNREACHABLE incidents from the outcome of polls.
+
+    ``results`` holds each polled machine with its consecutive failed
+    polls. An incident opens once a machine has failed
+    POLL_BREAKER_THRESHOLD polls in a row and closes at its first
+    successful poll. State is kept and written like evaluate_metrics'.
+    Returns the opened incidents and the ids of the closed ones.
+    """
+    if not results:
+        return [], []
+    return _with_retries(_evaluate_reachability, results)
+
+
+def _with_retries(evaluate, items):
+    store = get_store()
+    for attempt in range(1, INCIDENT_STATE_ATTEMPTS + 1):
+        try:
+            return evaluate(items, store)
+        except StatePending as e:
+            if attempt == INCIDENT_STATE_ATTEMPTS:
+                raise
+            # Claimed by another evaluation, whose transaction is about to commit.
+            time.sleep(INCIDENT_STATE_PENDING_WAIT * attempt)
+            if attempt < INCIDENT_STATE_ATTEMPTS - 1:
+                logger.info(f"{e}, re-evaluating once written")
+            else:
+                # Its transaction rolled back or takes too long, drop the claim.
+                logger.warning(f"{e}, re-evaluating from the database")
+                store.invalidate(e.keys)
+        except StateConflict as e:
+            if attempt == INCIDENT_STATE_ATTEMPTS:
+                raise
+            logger.warning(f"{e}, re-evaluating from the database")
+            store.invalidate(e.keys)
+
+
+class IncidentChanges:
+    """Incidents opened and closed by one evaluation, written by ``commit``.
+
+    Which incidents are open and when the last one started is read from
+    the state store, or from the database with one query for the keys
+    missing from the store.
+    """
+
+    def __init__(self, store, keys: set[StateKey], now):
+        self.store = store
+        self.now = now
+        self.state = store.get_many(keys)
+        missing = keys - self.state.keys()
+        if missing:
+            loaded = load_incident_state(
+                {machine_id for machine_id, _ in missing}, state_horizon(now)
+            )
+            self.state.update(store.populate({key: loaded[key] for key in missing}))
+
+        # Open incidents are ids, or Incident objects for the ones opened here.
+        self.open_incidents = {key: list(entry[0]) for key, (_, entry) in self.state.items()}
+        self.last_start = {key: entry[1] for key, (_, entry) in self.state.items()}
+        self.opened, self.closed_ids, self.resolved, self.changed = [], [], [], set()
+
+    def open(self, machine: Machine, type_: str, value: float):
+        key = (machine.id, type_)
+        incident = Incident(machine=machine, type=type_, value=value, start_time=self.now)
+        self.open_incidents[key].append(incident)
+        self.last_start[key] = self.now
+        self.opened.append(incident)
+        self.changed.add(key)
+
+    def close(self, machine: Machine, type_: str):
+        key = (machine.id, type_)
+        incident = self.open_incidents[key].pop(0)
+        if isinstance(incident, Incident):
+            incident.end_time = self.now
+        else:
+            self.closed_ids.append(incident)
+            self.resolved.append(resolved_event(incident, machine.name, type_, self.now))
+        self.changed.add(key)
+
+    def commit(self) -> tuple[list[Incident], list[int]]:
+        """Write the changes and publish them in one transaction."""
+        if not self.changed:
+            return [], []
+
+        try:
+            with transaction.atomic():
+                Incident.objects.bulk_create(self.opened)
+                if self.opened and not connection.features.can_return_rows_from_bulk_insert:
+                    read_back_ids(self.opened, self.now)
+                if self.closed_ids:
+                    Incident.objects.filter(id__in=self.closed_ids).update(end_time=self.now)
+                publish([opened_event(incident) for incident in self.opened] + self.resolved)
+                invalidate("incidents")
+
+                # Last step of the transaction, so a conflict rolls the writes back.
+                claimed = self.store.claim({key: self.state[key][0] for key in self.changed})
+                transaction.on_commit(lambda: self.write_state(claimed))
+        except StateConflict:
+            raise
+        except Exception:
+            self.store.invalidate(self.changed)
+            raise
+
+        return self.opened, self.closed_ids
+
+    def write_state(self, claimed: dict[StateKey, str]):
+        """Store the committed state of the changed keys.
+
+        Until then they are pending and evaluations of them wait. Keys
+        written meanwhile by another worker are dropped instead, and read
+        from the database again by the next evaluation.
+        """
+        try:
+            self.store.compare_and_set(
+                {
+                    key: (
+                        version,
+                        (
+                            tuple(
+                                incident.id if isinstance(incident, Incident) else incident
+                                for incident in self.open_incidents[key]
+                            ),
+                            self.last_start[key],
+                        ),
+                    )
+                    for key, version in claimed.items()
+                }
+            )
+        except StateConflict as e:
+            self.store.invalidate(e.keys)
+
+
+def _evaluate_metrics(metrics, store):
+    now = timezone.now()
+    since = {
+        type_: now - timedelta(minutes=threshold["duration"])
+        for type_, threshold in THRESHOLDS.items()
+    }
+
+    sync_windows(store.count_evaluations({metric.machine_id for metric in metrics}))
+    load_window_history(metrics)
+
+    changes = IncidentChanges(
+        store,
+        {(metric.machine_id, type_) for metric in metrics for type_ in METRIC_FIELDS},
+        now,
+    )
+    for metric in sorted(metrics, key=lambda metric: (metric.timestamp, metric.id)):
+        for type_, field in METRIC_FIELDS.items():
+            key = (metric.machine_id, type_)
+            value = getattr(metric, field)
+            window = None
+            if THRESHOLDS[type_]["duration"]:
+                window = get_window(*key)
+                window.push(metric.id, metric.timestamp, value)
+
+            if float(value) > THRESHOLDS[type_]["value"]:
+                last_start = changes.last_start[key]
+                if (
+                    THRESHOLDS[type_]["duration"]
+                    and last_start is not None
+                    and last_start >= since[type_]
+                ):
+                    continue
+                if window and not window.sustained(metric.timestamp):
+                    continue
+                if not changes.open_incidents[key]:
+                    changes.open(metric.machine, type_, value)
+                    logger.info(
+                        f"{type_} incident triggered for {metric.machine.name} at {value}%"
+                    )
+            elif changes.open_incidents[key]:
+                changes.close(metric.machine, type_)
+                logger.info(f"{type_} incident resolved for {metric.machine.name}")
+
+    return changes.commit()
+
+
+def _evaluate_reachability(results, store):
+    changes = IncidentChanges(
+        store, {(machine.id, "UNREACHABLE") for machine, _ in results}, timezone.now()
+    )
+    for machine, failures in results:
+        key = (machine.id, "UNREACHABLE")
+        if failures >= settings.POLL_BREAKER_THRESHOLD:
+            if not changes.open_incidents[key]:
+                changes.open(machine, "UNREACHABLE", failures)
+                logger.info(
+                    f"UNREACHABLE incident triggered for {machine.name} "
+                    f"after {failures} failed polls"
+                )
+        elif failures == 0 and changes.open_incidents[key]:
+            changes.close(machine, "UNREACHABLE")
+            logger.info(f"UNREACHABLE incident resolved for {machine.name}")
+
+    return changes.commit()
+
+
+def read_back_ids(incidents: list[Incident], start_time):
+    """Set the ids of incidents bulk inserted on a backend that cannot return them."""
+    ids = defaultdict(deque)
+    rows = (
+        Incident.objects.filter(
+            start_time=start_time,
+            machine_id__in={incident.machine_id for incident in incidents},
+        )
+        .order_by("id")
+        .values_list("id", "machine_id", "type")
+    )
+    for id_, machine_id, type_ in rows:
+        ids[(machine_id, type_)].append(id_)
+    for incident in incidents:
+        incident.id = ids[(incident.machine_id, incident.type)].popleft()
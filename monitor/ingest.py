@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from collections.abc import Callable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from monitor.models import Machine, MachineStatus, Metric
+
+logger = logging.getLogger(__name__)
+
+
+SAMPLE_STATUS_FIELDS = ["cpu", "mem", "disk", "uptime", "sampled_at"]
+POLL_STATUS_FIELDS = ["polled_at", "poll_ok"]
+
+
+def upsert_statuses(statuses: list[MachineStatus], fields: list[str]):
+    """Insert the status rows of machines, or update their ``fields`` only."""
+    # MySQL upserts on any unique key and does not take the fields.
+    unique_fields = (
+        ["machine"] if connection.features.supports_update_conflicts_with_target else None
+    )
+    # Rows locked in the same order by every writer cannot deadlock.
+    MachineStatus.objects.bulk_create(
+        sorted(statuses, key=lambda status: status.machine_id),
+        batch_size=settings.INGEST_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=fields,
+    )
+
+
+def update_latest_samples(metrics: list[Metric], backfilled: set[int]):
+    """Make each machine's newest metric of a batch its latest sample.
+
+    Metrics of the machines in ``backfilled`` carry the agent's own
+    timestamp and may be older than the stored sample, which is then kept.
+    """
+    latest = {}
+    for metric in metrics:
+        current = latest.get(metric.machine_id)
+        if current is None or metric.timestamp >= current.timestamp:
+            latest[metric.machine_id] = metric
+
+    if backfilled:
+        stored = MachineStatus.objects.filter(
+            machine_id__in=backfilled, sampled_at__isnull=False
+        ).values_list("machine_id", "sampled_at")
+        for machine_id, sampled_at in stored:
+            if latest[machine_id].timestamp < sampled_at:
+                del latest[machine_id]
+
+    upsert_statuses(
+        [
+            MachineStatus(
+                machine_id=metric.machine_id,
+                cpu=metric.cpu,
+                mem=metric.mem,
+                disk=metric.disk,
+                uptime=metric.uptime,
+                sampled_at=metric.timestamp,
+            )
+            for metric in latest.values()
+        ],
+        SAMPLE_STATUS_FIELDS,
+    )
+
+
+def save_metrics(samples: list[tuple[Machine, dict]]) -> list[Metric]:
+    """Save fetched samples with bulk inserts inside one transaction.
+
+    Samples without a ``timestamp`` share the current time. The returned
+    metrics have their primary keys set. MySQL cannot return the ids of a
+    bulk insert, so there they are read back by machine and timestamp,
+    which must not match rows saved before. The latest sample of each
+    machine is updated in the same transaction.
+    """
+    now = timezone.now()
+    metrics = [
+        Metric(machine=machine, **{"timestamp": now, **sample})
+        for machine, sample in samples
+    ]
+    backfilled = {machine.id for machine, sample in samples if "timestamp" in sample}
+
+    with transaction.atomic():
+        Metric.objects.bulk_create(metrics, batch_size=settings.INGEST_BATCH_SIZE)
+        update_latest_samples(metrics, backfilled)
+
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # Rows of one INSERT get increasing ids in insertion order, which
+            # also holds when a machine appears more than once in a batch.
+            ids = defaultdict(deque)
+            rows = (
+                Metric.objects.filter(
+                    timestamp__in={metric.timestamp for metric in metrics},
+                    machine_id__in={metric.machine_id for metric in metrics},
+                )
+                .order_by("id")
+                .values_list("id", "machine_id", "timestamp")
+            )
+            for id_, machine_id, timestamp in rows:
+                ids[machine_id, timestamp].append(id_)
+            for metric in metrics:
+                metric.id = ids[metric.machine_id, metric.timestamp].popleft()
+
+    return metrics
+
+
+class MetricWriter:
+    """Buffers fetched samples and saves them in batches.
+
+    A batch is flushed once it holds ``batch_size`` samples or its oldest
+    sample has waited ``flush_interval`` seconds. ``on_flush`` is called
+    with the saved metrics in the same worker thread as the insert, so it
+    may use the ORM.
+    """
+
+    def __init__(
+        self,
+        batch_size: int | None = None,
+        flush_interval: float | None = None,
+        on_flush: Callable[[list[Metric]], None] | None = None,
+    ):
+        self.batch_size = batch_size or settings.INGEST_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.INGEST_FLUSH_INTERVAL
+        self.on_flush = on_flush
+        self.saved = 0
+        self._buffer: list[tuple[Machine, dict]] = []
+        self._buffered_at = None
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    async def __aenter__(self):
+        self._timer = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._timer.cancel()
+        await asyncio.gather(self._timer, return_exceptions=True)
+        await self.flush()
+
+    async def add(self, machine: Machine, sample: dict):
+        if not self._buffer:
+            self._buffered_at = time.monotonic()
+        self._buffer.append((machine, sample))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await sync_to_async(self._save)(batch)
+            except Exception as e:
+                logger.error(f"Failed to save a batch of {len(batch)} metrics: {e}")
+
+    def _save(self, batch):
+        metrics = save_metrics(batch)
+        self.saved += len(metrics)
+        if self.on_flush:
+            try:
+                self.on_flush(metrics)
+            except Exception as e:
+                logger.error(f"Failed to process a batch of {len(metrics)} metrics: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval / 2)
+            if (
+                self._buffer
+                and time.monotonic() - self._buffered_at >= self.flush_interval
+            ):
+                await self.flush()
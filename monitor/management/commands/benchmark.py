@@ -0,0 +1,144 @@
+import logging
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+
+from monitor.benchmarks import SCENARIOS
+from monitor.benchmarks.fleet import StubAgentFleet
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the poller against a local stub agent fleet, or the "
+        "incidents feed and event stream against the configured database, "
+        "or load a running server with dashboard tabs. "
+        "Scenarios that poll or write run in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario",
+            choices=SCENARIOS,
+            default="client",
+            help="What to benchmark (default: client)",
+        )
+        parser.add_argument(
+            "--machines",
+            type=int,
+            nargs="+",
+            default=[1000, 5000],
+            help="Fleet sizes to benchmark (default: 1000 5000)",
+        )
+        parser.add_argument(
+            "--cycles",
+            type=int,
+            default=2,
+            help="Poll cycles per fleet size (default: 2)",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Simulated agent response time in seconds (default: 0)",
+        )
+        parser.add_argument(
+            "--distribution",
+            choices=StubAgentFleet.DISTRIBUTIONS,
+            default="fixed",
+            help="Distribution of agent response times around --latency (default: fixed)",
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0.0,
+            help="Share of agent responses that are HTTP 500 errors (default: 0)",
+        )
+        parser.add_argument(
+            "--dark",
+            type=float,
+            default=0.2,
+            help="Share of agents that never answer in the dark scenario (default: 0.2)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=None,
+            help="Fetches in flight for the scheduler scenario (default: POLL_CONCURRENCY)",
+        )
+        parser.add_argument(
+            "--payloads",
+            type=int,
+            default=100000,
+            help=(
+                "Agent payloads parsed per decoder in the parse scenario, "
+                "samples pushed per batch size in the push scenario (default: 100000)"
+            ),
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            nargs="+",
+            default=[1, 100, 1000],
+            help="Samples per request of the push scenario (default: 1 100 1000)",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            help="Days of one-minute samples in the history scenario (default: 30)",
+        )
+        parser.add_argument(
+            "--points",
+            type=int,
+            default=500,
+            help="Buckets per series in the history scenario (default: 500)",
+        )
+        parser.add_argument(
+            "--incidents",
+            type=int,
+            nargs="+",
+            default=[10000, 100000],
+            help="Incidents listed in the incidents scenario (default: 10000 100000)",
+        )
+        parser.add_argument(
+            "--tabs",
+            type=int,
+            nargs="+",
+            default=[200],
+            help="Dashboard tabs of the feed, stream and load scenarios (default: 200)",
+        )
+        parser.add_argument(
+            "--polls",
+            type=int,
+            default=10,
+            help=(
+                "Polls per tab in the feed scenario, events published in the "
+                "stream scenario (default: 10)"
+            ),
+        )
+        parser.add_argument(
+            "--url",
+            default="http://localhost:8000",
+            help="Server loaded by the load scenario (default: http://localhost:8000)",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=10.0,
+            help="Seconds each tab count of the load scenario runs (default: 10)",
+        )
+        parser.add_argument(
+            "--streams",
+            action="store_true",
+            help="Also hold an event stream open per tab in the load scenario",
+        )
+
+        parser.add_argument(
+            "--json",
+            metavar="PATH",
+            help="Also write the results of the cycle scenario as JSON, - for stdout",
+        )
+
+    def handle(self, *args, **options):
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        import_module(f"monitor.benchmarks.{options['scenario']}").run(self, options)
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from monitor.partitions import (
+    PERIODS,
+    convert_table,
+    create_future_partitions,
+    drop_partitions_before,
+    is_partitioned,
+)
+from monitor.retention import metric_cutoff
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage the RANGE partitions of the metric table on MySQL: convert the "
+        "table online, or create future partitions and drop expired ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action",
+            choices=["convert", "maintain"],
+            help=(
+                "convert: move the metric table to a partitioned copy, "
+                "maintain: create future partitions and drop expired ones"
+            ),
+        )
+        parser.add_argument(
+            "--period",
+            choices=list(PERIODS),
+            default=None,
+            help="Partition size (default: METRIC_PARTITION_PERIOD)",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=None,
+            help="Future partitions to keep ready (default: METRIC_PARTITIONS_AHEAD)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=None,
+            help="Rows copied per statement by convert (default: PURGE_CHUNK_SIZE)",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=None,
+            help="Pause between copy statements in seconds (default: PURGE_SLEEP)",
+        )
+
+    def handle(self, *args, **options):
+        if options["action"] == "convert":
+            self.convert(options)
+        else:
+            self.maintain(options)
+
+    def convert(self, options):
+        def progress(copied, last):
+            self.stdout.write(f"Copied rows up to id {copied} of {last}")
+
+        try:
+            old = convert_table(
+                period=options["period"],
+                ahead=options["ahead"],
+                chunk_size=options["chunk_size"],
+                sleep=options["sleep"],
+                progress=progress,
+            )
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        if old is None:
+            raise CommandError("The metric table is already partitioned")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"The metric table is partitioned. The old table is kept as {old}, "
+                "drop it once the new one has been checked."
+            )
+        )
+
+    def maintain(self, options):
+        if not is_partitioned():
+            raise CommandError("The metric table is not partitioned, run convert first")
+        try:
+            created = create_future_partitions(options["period"], options["ahead"])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        dropped = 0
+        if cutoff := metric_cutoff(timezone.now(), settings.METRIC_RETENTION_DAYS):
+            dropped = drop_partitions_before(cutoff)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {len(created)} partitions, dropped about {dropped} expired rows."
+            )
+        )
@@ -0,0 +1,44 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from monitor.poller import Poller
+
+
+class Command(BaseCommand):
+    help = (
+        "Poll due machines from a long-running event loop, instead of the "
+        "Celery poll tasks. Stops on SIGINT or SIGTERM after the current cycle."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--shard",
+            type=int,
+            default=None,
+            help="Only poll the machines of this shard (default: all shards)",
+        )
+        parser.add_argument(
+            "--tick",
+            type=float,
+            default=None,
+            help="Seconds between cycles (default: POLL_TICK)",
+        )
+        parser.add_argument(
+            "--cycles",
+            type=int,
+            default=None,
+            help="Stop after this many cycles (default: run until stopped)",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        poller = Poller(shard=options["shard"], tick=options["tick"])
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, poller.stop)
+        await poller.run(options["cycles"])
+        self.stdout.write(self.style.SUCCESS(f"Stopped after {poller.cycles} cycles."))
@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from monitor.retention import purge_expired
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete raw metrics, resolved incidents and minute rollups older than their "
+        "retention, in small primary key ranged chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--metric-days",
+            type=int,
+            default=None,
+            help="Days of raw metrics to keep, 0 keeps all (default: METRIC_RETENTION_DAYS)",
+        )
+        parser.add_argument(
+            "--incident-days",
+            type=int,
+            default=None,
+            help=(
+                "Days of resolved incidents to keep, 0 keeps all "
+                "(default: INCIDENT_RETENTION_DAYS)"
+            ),
+        )
+        parser.add_argument(
+            "--minute-rollup-days",
+            type=int,
+            default=None,
+            help=(
+                "Days of minute rollups to keep, 0 keeps all "
+                "(default: MINUTE_ROLLUP_RETENTION_DAYS)"
+            ),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=None,
+            help="Rows deleted per statement (default: PURGE_CHUNK_SIZE)",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=None,
+            help="Pause between statements in seconds (default: PURGE_SLEEP)",
+        )
+        parser.add_argument(
+            "--time-limit",
+            type=float,
+            default=None,
+            help="Stop after this many seconds (default: no limit)",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"] or settings.PURGE_CHUNK_SIZE
+        reported = {}
+
+        def progress(model, deleted, last_id):
+            # Report every 100 chunks or so.
+            name = model._meta.verbose_name_plural
+            if deleted - reported.get(name, 0) >= chunk_size * 100:
+                reported[name] = deleted
+                self.stdout.write(f"{name}: {deleted} deleted, reached id {last_id}")
+
+        deleted = purge_expired(
+            metric_days=options["metric_days"],
+            incident_days=options["incident_days"],
+            minute_rollup_days=options["minute_rollup_days"],
+            chunk_size=chunk_size,
+            sleep=options["sleep"],
+            time_limit=options["time_limit"],
+            progress=progress,
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {deleted['metrics']} metrics, "
+                f"{deleted['incidents']} resolved incidents "
+                f"and {deleted['rollups']} minute rollups."
+            )
+        )
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from monitor.models import Machine
+from monitor.push import issue_token
+
+
+class Command(BaseCommand):
+    help = (
+        "Issue the token a machine's agent uses to push its metrics to "
+        "/api/ingest/, replacing any previous token."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("machine", help="Machine id or name")
+        parser.add_argument(
+            "--revoke",
+            action="store_true",
+            help="Remove the machine's token instead of issuing one",
+        )
+
+    def handle(self, *args, **options):
+        machine = options["machine"]
+        machines = Machine.objects.filter(
+            id=int(machine) if machine.isdigit() else None
+        ) | Machine.objects.filter(name=machine)
+        if machines.count() != 1:
+            raise CommandError(f"Expected one machine matching {machine!r}")
+        machine = machines.get()
+
+        if options["revoke"]:
+            machine.push_token_hash = None
+            machine.save(update_fields=["push_token_hash"])
+            self.stdout.write(self.style.SUCCESS(f"Revoked the token of {machine}."))
+            return
+        self.stdout.write(issue_token(machine))
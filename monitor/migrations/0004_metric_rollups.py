@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0003_incident_end_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2, primary_key=True, serialize=False)),
+                ('position', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('bucket', models.DateTimeField()),
+                ('samples', models.PositiveIntegerField()),
+                ('cpu_min', models.FloatField()),
+                ('cpu_max', models.FloatField()),
+                ('cpu_avg', models.FloatField()),
+                ('cpu_p95', models.FloatField()),
+                ('mem_min', models.FloatField()),
+                ('mem_max', models.FloatField()),
+                ('mem_avg', models.FloatField()),
+                ('mem_p95', models.FloatField()),
+                ('disk_min', models.FloatField()),
+                ('disk_max', models.FloatField()),
+                ('disk_avg', models.FloatField()),
+                ('disk_p95', models.FloatField()),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='monitor.machine')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('machine', 'resolution', 'bucket'), name='rollup_mach_res_bucket_uniq')],
+            },
+        ),
+    ]
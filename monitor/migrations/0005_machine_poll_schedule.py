@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0004_metric_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='next_poll_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='poll_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0005_machine_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='push_token_hash',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
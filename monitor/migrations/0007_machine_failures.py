@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0006_machine_push_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='incident',
+            name='type',
+            field=models.CharField(choices=[('CPU', 'CPU'), ('MEM', 'Memory'), ('DISK', 'Disk'), ('UNREACHABLE', 'Unreachable')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_latest_samples(apps, schema_editor):
+    """Start each machine's status from its newest metric, one index lookup per machine."""
+    Machine = apps.get_model("monitor", "Machine")
+    Metric = apps.get_model("monitor", "Metric")
+    MachineStatus = apps.get_model("monitor", "MachineStatus")
+    statuses = []
+    for machine_id in Machine.objects.values_list("id", flat=True).iterator():
+        metric = (
+            Metric.objects.filter(machine_id=machine_id).order_by("-timestamp").first()
+        )
+        if metric is not None:
+            statuses.append(
+                MachineStatus(
+                    machine_id=machine_id,
+                    cpu=metric.cpu,
+                    mem=metric.mem,
+                    disk=metric.disk,
+                    uptime=metric.uptime,
+                    sampled_at=metric.timestamp,
+                )
+            )
+    MachineStatus.objects.bulk_create(statuses, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0007_machine_failures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MachineStatus',
+            fields=[
+                ('machine', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='status', serialize=False, to='monitor.machine')),
+                ('cpu', models.FloatField(blank=True, null=True)),
+                ('mem', models.FloatField(blank=True, null=True)),
+                ('disk', models.FloatField(blank=True, null=True)),
+                ('uptime', models.CharField(blank=True, max_length=50, null=True)),
+                ('sampled_at', models.DateTimeField(blank=True, null=True)),
+                ('polled_at', models.DateTimeField(blank=True, null=True)),
+                ('poll_ok', models.BooleanField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_latest_samples, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0008_machine_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='poll_shard',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='machine',
+            index=models.Index(fields=['poll_shard', 'next_poll_at'], name='machine_shard_poll_idx'),
+        ),
+    ]
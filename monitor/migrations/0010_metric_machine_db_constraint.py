@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0009_machine_poll_shard'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='metric',
+            name='machine',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='monitor.machine'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0010_metric_machine_db_constraint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeleteGeneration',
+            fields=[
+                ('table', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('deletes', models.PositiveBigIntegerField(default=0)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
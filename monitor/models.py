@@ -11,18 +11,41 @@ THRESHOLDS = {
 class Machine(models.Model):
     name = models.CharField(max_length=100)
     url = models.URLField(unique=True)
+    # Adaptive polling schedule, see monitor.schedule.
+    next_poll_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    poll_interval = models.PositiveIntegerField(null=True, blank=True)
+    # Failed polls in a row, backing the machine off, see schedule.failure_backoff.
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    # SHA-256 of the token of an agent pushing its own metrics, see monitor.push.
+    push_token_hash = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Poll shard of the machine, see monitor.schedule.assign_shards.
+    poll_shard = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Due machines of a shard, and machines without a shard yet.
+            models.Index(fields=["poll_shard", "next_poll_at"], name="machine_shard_poll_idx"),
+        ]
 
     def __str__(self):
         return self.name
 
 
 class Metric(models.Model):
-    machine = models.ForeignKey(Machine, on_delete=models.CASCADE)
+    # Partitioned tables cannot have foreign keys, see monitor.partitions.
+    # There, the primary key is also (id, timestamp), ids staying unique.
+    machine = models.ForeignKey(Machine, on_delete=models.CASCADE, db_constraint=False)
     cpu = models.FloatField()
     mem = models.FloatField()
     disk = models.FloatField()
     uptime = models.CharField(max_length=50)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # History of a machine over a time range.
+            models.Index(fields=["machine", "timestamp"], name="metric_mach_timestamp_idx"),
+        ]
 
     def __str__(self):
         return f"{self.machine.name}: {self.cpu}/{self.mem}%/{self.disk}%"
@@ -36,18 +59,145 @@ class Metric(models.Model):
         }
 
 
+class MachineStatus(models.Model):
+    """Latest sample and last poll outcome of a machine, kept by upserts.
+
+    Spares reading the newest metric of every machine to show the fleet,
+    see monitor.ingest.upsert_statuses.
+    """
+
+    machine = models.OneToOneField(
+        Machine, on_delete=models.CASCADE, primary_key=True, related_name="status"
+    )
+    cpu = models.FloatField(null=True, blank=True)
+    mem = models.FloatField(null=True, blank=True)
+    disk = models.FloatField(null=True, blank=True)
+    uptime = models.CharField(max_length=50, null=True, blank=True)
+    sampled_at = models.DateTimeField(null=True, blank=True)
+    polled_at = models.DateTimeField(null=True, blank=True)
+    poll_ok = models.BooleanField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Status of {self.machine.name}"
+
+
+class MetricRollup(models.Model):
+    """Aggregates of the metrics of a machine over one time bucket."""
+
+    RESOLUTIONS = [
+        ("1m", "1 minute"),
+        ("1h", "1 hour"),
+        ("1d", "1 day"),
+    ]
+
+    machine = models.ForeignKey(Machine, on_delete=models.CASCADE)
+    resolution = models.CharField(max_length=2, choices=RESOLUTIONS)
+    bucket = models.DateTimeField()
+    samples = models.PositiveIntegerField()
+    cpu_min = models.FloatField()
+    cpu_max = models.FloatField()
+    cpu_avg = models.FloatField()
+    cpu_p95 = models.FloatField()
+    mem_min = models.FloatField()
+    mem_max = models.FloatField()
+    mem_avg = models.FloatField()
+    mem_p95 = models.FloatField()
+    disk_min = models.FloatField()
+    disk_max = models.FloatField()
+    disk_avg = models.FloatField()
+    disk_p95 = models.FloatField()
+
+    class Meta:
+        constraints = [
+            # Also the index of a machine's history at one resolution.
+            models.UniqueConstraint(
+                fields=["machine", "resolution", "bucket"], name="rollup_mach_res_bucket_uniq"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.machine.name} {self.resolution} rollup at {self.bucket}"
+
+
+class RollupWatermark(models.Model):
+    """End of the range already rolled up at a resolution."""
+
+    resolution = models.CharField(
+        max_length=2, choices=MetricRollup.RESOLUTIONS, primary_key=True
+    )
+    position = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.resolution} rolled up to {self.position}"
+
+
 class Incident(models.Model):
     INCIDENT_TYPES = [
         ("CPU", "CPU"),
         ("MEM", "Memory"),
         ("DISK", "Disk"),
+        # Value is the number of failed polls in a row when opened.
+        ("UNREACHABLE", "Unreachable"),
     ]
 
     machine = models.ForeignKey(Machine, on_delete=models.CASCADE)
-    type = models.CharField(max_length=10, choices=INCIDENT_TYPES)
+    type = models.CharField(max_length=16, choices=INCIDENT_TYPES)
     value = models.FloatField()
     start_time = models.DateTimeField(default=timezone.now)
     end_time = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Open incidents of a machine (end_time IS NULL). MySQL has no
+            # partial indexes, but InnoDB indexes NULLs, so the lookup is
+            # still a single index range.
+            models.Index(
+                fields=["machine", "type", "end_time"], name="incident_mach_type_end_idx"
+            ),
+            # Incidents of a machine started since a point in time.
+            models.Index(
+                fields=["machine", "type", "start_time"], name="incident_mach_type_start_idx"
+            ),
+            # Newest first listing of /api/incidents/.
+            models.Index(fields=["start_time"], name="incident_start_time_idx"),
+            # Latest resolution, part of the /api/incidents/ ETag.
+            models.Index(fields=["end_time"], name="incident_end_time_idx"),
+        ]
+
     def __str__(self):
         return f"{self.type} Incident on {self.machine.name}"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "machine": self.machine.name,
+            "type": self.type,
+            "value": self.value,
+            "start_time": self.start_time.isoformat(),
+            "end_time": self.end_time.isoformat() if self.end_time else None,
+        }
+
+
+class DeleteGeneration(models.Model):
+    """Deletes of a table's rows, which its latest rows cannot tell about.
+
+    Part of the /api/incidents/ ETag and Last-Modified, so that purged or
+    deleted incidents change them too.
+    """
+
+    table = models.CharField(max_length=50, primary_key=True)
+    deletes = models.PositiveBigIntegerField(default=0)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def bump(cls, table: str, deletes: int = 1):
+        now = timezone.now()
+        if not cls.objects.filter(table=table).update(
+            deletes=models.F("deletes") + deletes, deleted_at=now
+        ):
+            cls.objects.get_or_create(
+                table=table, defaults={"deletes": deletes, "deleted_at": now}
+            )
+
+    def __str__(self):
+        return f"{self.deletes} deletes from {self.table}"
@@ -0,0 +1,280 @@
+import logging
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from monitor.models import Machine, Metric
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+
+TABLE = Metric._meta.db_table
+# Catches rows past the last partition, kept empty by creating partitions ahead.
+MAXVALUE_PARTITION = "pmax"
+# MySQL named lock held while the table is converted or its rows purged.
+LOCK_NAME = f"{TABLE}_partitions"
+
+
+def period_start(day: date, period: str) -> date:
+    """First day of the partition holding day, weeks starting on Monday."""
+    if period == "weekly":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def partition_name(start: date) -> str:
+    return f"p{start:%Y%m%d}"
+
+
+def partition_plan(start: date, end: date, period: str) -> list[tuple[str, date]]:
+    """Partitions covering the days from start to end, as ``(name, upper bound)``."""
+    plan = []
+    day = period_start(start, period)
+    while day <= end:
+        upper = day + PERIODS[period]
+        plan.append((partition_name(day), upper))
+        day = upper
+    return plan
+
+
+def partition_definitions(plan: list[tuple[str, date]]) -> str:
+    """SQL of the partitions of a plan followed by the MAXVALUE partition.
+
+    Bounds are UTC midnights, which is how Django stores datetimes on MySQL.
+    """
+    definitions = [
+        f"PARTITION {name} VALUES LESS THAN ('{upper:%Y-%m-%d} 00:00:00')"
+        for name, upper in plan
+    ]
+    definitions.append(f"PARTITION {MAXVALUE_PARTITION} VALUES LESS THAN (MAXVALUE)")
+    return ", ".join(definitions)
+
+
+def existing_partitions() -> list[tuple[str, datetime | None, int]]:
+    """Partitions of the Metric table as ``(name, upper bound, estimated rows)``.
+
+    Empty unless the table is partitioned, which needs MySQL.
+    """
+    if connection.vendor != "mysql":
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+            """,
+            [TABLE],
+        )
+        return [
+            (
+                name,
+                None
+                if description == "MAXVALUE"
+                else datetime.fromisoformat(description.strip("'")),
+                rows or 0,
+            )
+            for name, description, rows in cursor.fetchall()
+        ]
+
+
+def is_partitioned() -> bool:
+    return bool(existing_partitions())
+
+
+@contextmanager
+def partition_lock(timeout: float = -1):
+    """Hold the lock serializing the conversion of the Metric table and its purges.
+
+    Yields whether the lock was taken within ``timeout`` seconds, a
+    negative timeout waits for it. The lock is a MySQL named lock, so it
+    holds across processes, other databases have no partitions and always
+    get it.
+    """
+    if connection.vendor != "mysql":
+        yield True
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", [LOCK_NAME, timeout])
+        locked = cursor.fetchone()[0] == 1
+    try:
+        yield locked
+    finally:
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", [LOCK_NAME])
+
+
+def create_future_partitions(
+    period: str | None = None, ahead: int | None = None, today: date | None = None
+) -> list[str]:
+    """Split partitions for the next ``ahead`` periods off the MAXVALUE partition.
+
+    The MAXVALUE partition is empty while partitions are created ahead of
+    time, so reorganizing it moves no rows. When the last partition does
+    not end on a boundary of ``period``, after METRIC_PARTITION_PERIOD
+    changed, a shorter partition first fills the gap up to the next
+    boundary. Returns the created partitions.
+    """
+    period = period or settings.METRIC_PARTITION_PERIOD
+    ahead = settings.METRIC_PARTITIONS_AHEAD if ahead is None else ahead
+    today = today or timezone.now().date()
+    if period not in PERIODS:
+        raise RuntimeError(f"Unknown partition period {period!r}")
+
+    partitions = existing_partitions()
+    if not partitions:
+        return []
+    if partitions[-1][1] is not None:
+        raise RuntimeError(f"{TABLE} has no {MAXVALUE_PARTITION} partition to split")
+    last = max(upper for _, upper, _ in partitions if upper is not None).date()
+
+    plan = []
+    start = period_start(last, period)
+    if start != last:
+        start += PERIODS[period]
+        plan.append((partition_name(last), start))
+    plan += partition_plan(start, today + PERIODS[period] * ahead, period)
+    if not plan:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {TABLE} REORGANIZE PARTITION {MAXVALUE_PARTITION} "
+            f"INTO ({partition_definitions(plan)})"
+        )
+    names = [name for name, _ in plan]
+    logger.info(f"Created metric partitions {', '.join(names)}")
+    return names
+
+
+def drop_partitions_before(cutoff: datetime) -> int:
+    """Drop the partitions holding only rows older than cutoff.
+
+    A metadata-only operation, however many rows the partitions hold.
+    Returns the estimated number of rows dropped.
+    """
+    # Partition bounds are naive UTC.
+    if timezone.is_aware(cutoff):
+        cutoff = timezone.make_naive(cutoff, dt_timezone.utc)
+    expired = [
+        (name, rows)
+        for name, upper, rows in existing_partitions()
+        if upper is not None and upper <= cutoff
+    ]
+    if not expired:
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {TABLE} DROP PARTITION {', '.join(name for name, _ in expired)}"
+        )
+    logger.info(f"Dropped metric partitions {', '.join(name for name, _ in expired)}")
+    return sum(rows for _, rows in expired)
+
+
+def convert_table(
+    period: str | None = None,
+    ahead: int | None = None,
+    chunk_size: int | None = None,
+    sleep: float | None = None,
+    progress: Callable[[int, int], None] | None = None,
+) -> str | None:
+    """Move the Metric table to a partitioned copy without a long lock.
+
+    1. An empty partitioned copy of the table is created. Every unique key
+       of a partitioned table must include the partitioning column, so the
+       copy's primary key is (id, timestamp), and it cannot have foreign
+       keys, which the Metric model does not declare in the database.
+    2. Rows are copied by primary key range, PURGE_CHUNK_SIZE at a time,
+       until the copy has caught up with the inserts.
+    3. Both tables are write locked, which holds back inserts only while
+       the rows inserted since are copied, then swapped by RENAME TABLE.
+    4. Metrics of machines deleted during the copy are deleted again.
+
+    The whole conversion holds partition_lock, so purges wait for it and
+    two conversions cannot run at once. Run by ``manage.py
+    partition_metrics convert``. The old table is kept and its name
+    returned, drop it once the new one has been checked. Returns None when
+    the table is already partitioned.
+    """
+    period = period or settings.METRIC_PARTITION_PERIOD
+    ahead = settings.METRIC_PARTITIONS_AHEAD if ahead is None else ahead
+    chunk_size = chunk_size or settings.PURGE_CHUNK_SIZE
+    sleep = settings.PURGE_SLEEP if sleep is None else sleep
+    if connection.vendor != "mysql":
+        raise RuntimeError("Partitioning the metric table needs MySQL")
+    if period not in PERIODS:
+        raise RuntimeError(f"Unknown partition period {period!r}")
+
+    with partition_lock() as locked, connection.cursor() as cursor:
+        if not locked:
+            raise RuntimeError(f"Could not take the {LOCK_NAME} lock")
+        if is_partitioned():
+            return None
+
+        new, old = f"{TABLE}_partitioned", f"{TABLE}_unpartitioned"
+        machines = Machine._meta.db_table
+        cursor.execute(f"SELECT id FROM {machines}")
+        machine_ids = {id_ for id_, in cursor.fetchall()}
+        cursor.execute(f"SELECT timestamp FROM {TABLE} ORDER BY id LIMIT 1")
+        first = cursor.fetchone()
+        today = timezone.now().date()
+        plan = partition_plan(
+            first[0].date() if first else today, today + PERIODS[period] * ahead, period
+        )
+
+        cursor.execute(f"DROP TABLE IF EXISTS {new}")
+        # LIKE copies the columns and indexes, not the foreign keys.
+        cursor.execute(f"CREATE TABLE {new} LIKE {TABLE}")
+        cursor.execute(
+            f"ALTER TABLE {new} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {new} PARTITION BY RANGE COLUMNS(timestamp) "
+            f"({partition_definitions(plan)})"
+        )
+
+        def copy(after, pause):
+            """Copy the rows with ids after ``after``, return the last id copied."""
+            while True:
+                cursor.execute(f"SELECT MAX(id) FROM {TABLE}")
+                last = cursor.fetchone()[0] or 0
+                if after >= last:
+                    return after
+                upper = min(after + chunk_size, last)
+                cursor.execute(
+                    f"INSERT INTO {new} SELECT * FROM {TABLE} WHERE id > %s AND id <= %s",
+                    [after, upper],
+                )
+                after = upper
+                if progress:
+                    progress(after, last)
+                time.sleep(pause)
+
+        copied = copy(0, sleep)
+        cursor.execute(f"LOCK TABLES {TABLE} WRITE, {new} WRITE")
+        try:
+            copy(copied, 0)
+            cursor.execute(f"RENAME TABLE {TABLE} TO {old}, {new} TO {TABLE}")
+        finally:
+            cursor.execute("UNLOCK TABLES")
+
+        cursor.execute(f"SELECT id FROM {machines}")
+        deleted = machine_ids - {id_ for id_, in cursor.fetchall()}
+        if deleted:
+            cursor.execute(
+                f"DELETE FROM {TABLE} WHERE machine_id IN "
+                f"({', '.join(str(id_) for id_ in deleted)})"
+            )
+
+    logger.info(f"Partitioned {TABLE}, the old table is kept as {old}")
+    return old
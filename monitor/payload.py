@@ -0,0 +1,115 @@
+import json
+import logging
+import math
+from collections.abc import Callable
+from datetime import datetime
+
+from monitor.models import Metric
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+class PayloadError(ValueError):
+    """Raised for an agent response that is not a valid metrics payload."""
+
+
+class PayloadTooLarge(PayloadError):
+    pass
+
+
+UPTIME_MAX_LENGTH = Metric._meta.get_field("uptime").max_length
+
+
+def loads(body: bytes):
+    """Decode JSON with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def isoformat(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(data) -> bytes:
+    """Encode JSON compactly, with orjson when it is installed.
+
+    Datetimes are encoded in ISO 8601 either way.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), default=isoformat).encode()
+
+
+def percent(value) -> float:
+    """A percentage given as 45, 45.0, "45", "45.0" or "45%".
+
+    Values over 100, as agents rounding or summing per-core usage report,
+    are clamped to 100.
+    """
+    if isinstance(value, str):
+        # float() also takes "1_0", and "nan" or "inf" which fail isfinite().
+        if "_" in value:
+            raise ValueError(f"not a percentage: {value!r}")
+        number = float(value.strip().removesuffix("%"))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = float(value)
+    else:
+        raise ValueError(f"not a percentage: {value!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"not a percentage: {value!r}")
+    if number < 0:
+        raise ValueError(f"out of range: {value!r}")
+    if number > 100:
+        logger.info(f"Clamped percentage {value!r} to 100")
+        return 100.0
+    return number
+
+
+def uptime(value) -> str:
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"not an uptime: {value!r}")
+    value = value.strip()
+    if len(value) > UPTIME_MAX_LENGTH:
+        raise ValueError(f"longer than {UPTIME_MAX_LENGTH} characters")
+    return value
+
+
+# Field of the agent payload and its converter, fields are saved under the same name.
+SCHEMA = (("cpu", percent), ("mem", percent), ("disk", percent), ("uptime", uptime))
+
+
+def parse_sample(data) -> dict:
+    """Validate a decoded agent payload into a sample.
+
+    Fields other than the schema's are ignored. Raises PayloadError naming
+    the offending field.
+    """
+    if not isinstance(data, dict):
+        raise PayloadError(f"expected an object, got {type(data).__name__}")
+
+    sample = {}
+    for field, convert in SCHEMA:
+        if field not in data:
+            raise PayloadError(f"missing {field}")
+        try:
+            sample[field] = convert(data[field])
+        except ValueError as e:
+            raise PayloadError(f"{field}: {e}") from None
+    return sample
+
+
+def parse_payload(body: bytes, decode: Callable[[bytes], object] = loads) -> dict:
+    """Validate an agent response body into a sample, see parse_sample."""
+    try:
+        data = decode(body)
+    except ValueError as e:
+        raise PayloadError(f"invalid JSON: {e}") from None
+    return parse_sample(data)
@@ -1,60 +1,319 @@
 import asyncio
+import importlib.util
 import logging
+import math
+import ssl
+import time
+from urllib.parse import urlsplit
 
+import certifi
 import httpx
 from asgiref.sync import sync_to_async
+from django.conf import settings
 
+from monitor.ingest import MetricWriter, save_metrics
 from monitor.models import Machine, Metric
+from monitor.payload import PayloadError, PayloadTooLarge, parse_payload
+from monitor.schedule import claim_due_machines, reschedule
 
 logger = logging.getLogger(__name__)
 
 
-async def fetch_metrics(machine: Machine) -> Metric | None:
-    """Fetch metrics from a machine and save them to the database."""
+class PollClient:
+    """Long-lived pooled HTTP client shared by every request of a poll cycle.
+
+    httpcore scans its whole connection pool on every request, so a single
+    pool holding thousands of keep-alive connections makes a cycle
+    quadratic in the fleet size. Hosts are therefore spread over several
+    small pools which share one TLS context. Hosts are assigned to pools
+    round-robin on first use so that every pool gets its share of the
+    connection limits.
+    """
+
+    def __init__(self):
+        http2 = settings.POLL_HTTP2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("POLL_HTTP2 is enabled but h2 is not installed, using HTTP/1.1")
+            http2 = False
+
+        shards = max(1, math.ceil(settings.POLL_MAX_CONNECTIONS / settings.POLL_POOL_SIZE))
+        limits = httpx.Limits(
+            max_connections=math.ceil(settings.POLL_MAX_CONNECTIONS / shards),
+            max_keepalive_connections=math.ceil(
+                settings.POLL_MAX_KEEPALIVE_CONNECTIONS / shards
+            ),
+            keepalive_expiry=settings.POLL_KEEPALIVE_EXPIRY,
+        )
+        # Waiting for a free connection is not the agent's fault, so only
+        # the network phases are bounded by POLL_TIMEOUT.
+        timeout = httpx.Timeout(settings.POLL_TIMEOUT, pool=None)
+        verify = ssl.create_default_context(cafile=certifi.where())
+        self._clients = [
+            httpx.AsyncClient(timeout=timeout, limits=limits, http2=http2, verify=verify)
+            for _ in range(shards)
+        ]
+        self._routes: dict[str, httpx.AsyncClient] = {}
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        host = urlsplit(url).netloc
+        if host not in self._routes:
+            self._routes[host] = self._clients[len(self._routes) % len(self._clients)]
+        return self._routes[host]
+
+    async def get(self, url: str) -> httpx.Response:
+        return await self.client_for(url).get(url)
+
+    def stream(self, method: str, url: str):
+        return self.client_for(url).stream(method, url)
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+def build_client() -> PollClient:
+    """Build the pooled HTTP client used to poll agents."""
+    return PollClient()
+
+
+class HostLimiter:
+    """Caps the number of in-flight requests to a single host."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.limit)
+        return self._semaphores[host]
+
+
+class PollStats:
+    """Per-cycle fetch counters and latency percentiles."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.failed = 0
+
+    def record(self, latency: float, ok: bool):
+        self.latencies.append(latency)
+        if not ok:
+            self.failed += 1
+
+    def percentile(self, q: float) -> float:
+        """Nearest-rank percentile of the fetch latencies, in seconds."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+    def __str__(self):
+        return (
+            f"{len(self.latencies) - self.failed} ok, {self.failed} failed, "
+            f"fetch latency p50={self.percentile(50) * 1000:.0f}ms "
+            f"p99={self.percentile(99) * 1000:.0f}ms"
+        )
+
+
+async def read_body(client: PollClient, url: str, max_bytes: int | None = None) -> bytes:
+    """GET url and return its body, refusing bodies over POLL_MAX_RESPONSE_BYTES.
+
+    The body is read as it arrives and dropped once over the limit, so a
+    misbehaving agent cannot fill the worker's memory. The limit applies
+    to the decompressed body.
+    """
+    max_bytes = max_bytes or settings.POLL_MAX_RESPONSE_BYTES
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        length = response.headers.get("content-length", "")
+        if length.isdigit() and int(length) > max_bytes:
+            raise PayloadTooLarge(f"response of {length} bytes over {max_bytes}")
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) > max_bytes:
+                raise PayloadTooLarge(f"response over {max_bytes} bytes")
+    return bytes(body)
+
+
+async def fetch_sample(
+    client: PollClient,
+    machine: Machine,
+    host_limiter: HostLimiter | None = None,
+    deadline: float | None = None,
+) -> dict | PayloadError | None:
+    """Fetch and parse the agent payload of a machine without saving it.
+
+    ``deadline`` bounds the whole fetch, including the wait for a free
+    connection, so one slow host cannot hold up the cycle. Returns None
+    when the machine could not be fetched, and the PayloadError when its
+    agent answered with an invalid payload, so that it is not taken for
+    unreachable.
+    """
 
     try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            logger.debug(f"Making HTTP request to {machine.url}")
-
-            response = await client.get(machine.url)
-            response.raise_for_status()
-            data = await response.json()
-
-            cpu = float(data["cpu"])
-            mem = float(data["mem"].rstrip("%"))
-            disk = float(data["disk"].rstrip("%"))
-            uptime = data["uptime"]
-
-            metric = await sync_to_async(Metric.objects.create)(
-                machine=machine,
-                cpu=cpu,
-                mem=mem,
-                disk=disk,
-                uptime=uptime,
-            )
+        logger.debug(f"Making HTTP request to {machine.url}")
 
-            return metric
+        async with asyncio.timeout(deadline):
+            if host_limiter is None:
+                body = await read_body(client, machine.url)
+            else:
+                async with host_limiter(machine.url):
+                    body = await read_body(client, machine.url)
+        return parse_payload(body)
 
+    except PayloadError as e:
+        logger.error(f"Invalid metrics from {machine.name}: {e}")
+        return e
+    except TimeoutError:
+        logger.error(f"Timed out fetching metrics from {machine.name} after {deadline}s")
     except Exception as e:
         logger.error(f"Failed to fetch metrics from {machine.name}: {e}")
 
 
-async def poll_machines():
-    """Poll all machines for metrics."""
-    logger.info("Starting to poll all machines for metrics")
+async def stream_samples(
+    client: PollClient,
+    machines: list[Machine],
+    concurrency: int | None = None,
+    deadline: float | None = None,
+):
+    """Fetch machines with bounded concurrency, yielding results as they complete.
+
+    At most ``concurrency`` fetches are in flight at any time. Workers stop
+    taking new machines while the consumer lags behind, so a slow consumer
+    throttles the fetches instead of piling up results.
+
+    Machines whose last poll failed only get POLL_PROBE_TIMEOUT, so dark
+    hosts hold a fetch slot for a bounded time.
+
+    Yields ``(machine, sample, latency)`` tuples, ``sample`` being what
+    fetch_sample returned.
+    """
+    concurrency = concurrency or settings.POLL_CONCURRENCY
+    deadline = deadline or settings.POLL_DEADLINE
+    probe_deadline = min(deadline, settings.POLL_PROBE_TIMEOUT)
+    host_limiter = HostLimiter(settings.POLL_MAX_CONNECTIONS_PER_HOST)
+    pending = iter(machines)
+    results = asyncio.Queue(maxsize=concurrency)
+
+    async def worker():
+        for machine in pending:
+            started = time.perf_counter()
+            sample = await fetch_sample(
+                client,
+                machine,
+                host_limiter,
+                probe_deadline if machine.consecutive_failures else deadline,
+            )
+            await results.put((machine, sample, time.perf_counter() - started))
+
+    workers = [
+        asyncio.create_task(worker()) for _ in range(min(concurrency, len(machines)))
+    ]
+    try:
+        for _ in range(len(machines)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def fetch_metrics(
+    machine: Machine,
+    client: PollClient | None = None,
+    host_limiter: HostLimiter | None = None,
+) -> Metric | None:
+    """Fetch metrics from a machine and save them to the database."""
 
-    machines = await sync_to_async(list)(Machine.objects.all())
+    if client is None:
+        async with build_client() as client:
+            return await fetch_metrics(machine, client, host_limiter)
+
+    sample = await fetch_sample(client, machine, host_limiter)
+    if not isinstance(sample, dict):
+        return None
+
+    try:
+        [metric] = await sync_to_async(save_metrics)([(machine, sample)])
+        return metric
+    except Exception as e:
+        logger.error(f"Failed to save metrics from {machine.name}: {e}")
+
+
+async def poll_into(
+    client: PollClient, machines: list[Machine], writer: MetricWriter
+) -> tuple[PollStats, list[tuple[Machine, dict | PayloadError | None]]]:
+    """Fetch machines and hand their samples to ``writer`` as they arrive.
+
+    Returns the fetch stats and the ``(machine, sample)`` pairs to
+    reschedule, ``sample`` being what fetch_sample returned.
+    """
+    stats = PollStats()
+    results = []
+    async for machine, sample, latency in stream_samples(client, machines):
+        stats.record(latency, ok=isinstance(sample, dict))
+        results.append((machine, sample))
+        if isinstance(sample, dict):
+            await writer.add(machine, sample)
+    return stats, results
+
+
+async def poll_machines(
+    client: PollClient | None = None, machines: list[Machine] | None = None
+) -> PollStats | None:
+    """Poll machines for metrics, all of them unless ``machines`` is given.
+
+    A single pooled client is shared by every request of the cycle. Callers
+    that outlive one cycle can pass their own client to keep connections
+    alive between cycles. Samples are saved in batches as their fetches
+    complete rather than after the whole fleet has answered, and each
+    saved batch is handed to one incident check task right away, while
+    slower machines are still being fetched. Every polled machine is then
+    rescheduled from its sample.
+    """
+    if client is None:
+        async with build_client() as client:
+            return await poll_machines(client, machines)
+
+    if machines is None:
+        logger.info("Starting to poll all machines for metrics")
+        machines = await sync_to_async(list)(Machine.objects.all())
     if not machines:
         logger.warning("No machines configured for polling")
         return
 
-    tasks = [fetch_metrics(machine) for machine in machines]
-    metrics = await asyncio.gather(*tasks)
+    from monitor.tasks import run_batch_checks_task
+
+    def dispatch_checks(metrics):
+        if metrics:
+            run_batch_checks_task.delay([metric.id for metric in metrics])
+
+    async with MetricWriter(on_flush=dispatch_checks) as writer:
+        stats, results = await poll_into(client, machines, writer)
 
-    from monitor.tasks import run_checks_task
+    await sync_to_async(reschedule)(results)
 
-    for metric in metrics:
-        if metric:
-            run_checks_task.delay(metric.id)
+    logger.info(f"Polled {len(machines)} machines: {stats}")
+    return stats
 
-    logger.info(f"Polled {len(machines)} machines")
+
+async def poll_due_machines(
+    client: PollClient | None = None, shard: int | None = None
+) -> PollStats | None:
+    """Poll the machines of a shard, or of the fleet, whose next poll is due.
+
+    See monitor.schedule and monitor.shards.
+    """
+    machines = await sync_to_async(claim_due_machines)(shard=shard)
+    if not machines:
+        return None
+    return await poll_machines(client, machines)
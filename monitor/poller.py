@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from monitor.incident import evaluate_metrics
+from monitor.ingest import MetricWriter
+from monitor.poll import PollStats, build_client, poll_into
+from monitor.schedule import claim_due_machines, reschedule, schedule_new_machines
+
+logger = logging.getLogger(__name__)
+
+
+class Poller:
+    """Polls due machines every POLL_TICK from one long-lived event loop.
+
+    Unlike the Celery poll tasks, which start an event loop and an HTTP
+    client per run, the loop, the connection pool, the metric writer and
+    the database connection are set up once and reused by every cycle.
+    Incidents are evaluated by the writer as batches are saved instead of
+    by a separate task. Any number of pollers may run, each claims its own
+    due machines, see claim_due_machines.
+    """
+
+    def __init__(self, shard: int | None = None, tick: float | None = None):
+        self.shard = shard
+        self.tick = tick or settings.POLL_TICK
+        self.cycles = 0
+        self._stopping = asyncio.Event()
+
+    async def __aenter__(self):
+        self._resources = AsyncExitStack()
+        self.client = await self._resources.enter_async_context(build_client())
+        self.writer = await self._resources.enter_async_context(
+            MetricWriter(on_flush=self._evaluate)
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._resources.__aexit__(*exc_info)
+
+    async def run(self, cycles: int | None = None):
+        """Run cycles every tick until ``stop`` is called or ``cycles`` have run."""
+        async with self:
+            while not self._stopping.is_set():
+                if cycles is not None and self.cycles >= cycles:
+                    break
+                started = time.monotonic()
+                try:
+                    await self.cycle()
+                except Exception as e:
+                    logger.error(f"Poll cycle failed: {e}", exc_info=True)
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(),
+                        max(0.0, self.tick - (time.monotonic() - started)),
+                    )
+                except TimeoutError:
+                    pass
+
+    def stop(self):
+        self._stopping.set()
+
+    async def cycle(self) -> PollStats | None:
+        """Poll the machines due now and reschedule them."""
+        self.cycles += 1
+        machines = await sync_to_async(self._claim)()
+        if not machines:
+            return None
+
+        stats, results = await poll_into(self.client, machines, self.writer)
+        # Incidents opened by this cycle shorten the next poll interval.
+        await self.writer.flush()
+        await sync_to_async(reschedule)(results)
+        logger.info(f"Polled {len(machines)} machines: {stats}")
+        return stats
+
+    def _claim(self):
+        # The connection is kept between cycles, replace it once the
+        # database has closed it, e.g. after MySQL's wait_timeout.
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+        schedule_new_machines()
+        return claim_due_machines(shard=self.shard)
+
+    @staticmethod
+    def _evaluate(metrics):
+        opened, closed = evaluate_metrics(metrics)
+        if opened or closed:
+            logger.info(f"{len(opened)} incidents opened, {len(closed)} closed")
@@ -0,0 +1,185 @@
+import hashlib
+import secrets
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from monitor.incident import evaluate_reachability
+from monitor.ingest import save_metrics
+from monitor.models import Machine, Metric
+from monitor.payload import PayloadError, PayloadTooLarge, loads, parse_sample
+from monitor.rollup import bucket_start
+from monitor.schedule import get_schedule
+
+# Tolerated clock skew of agents, in seconds.
+MAX_CLOCK_SKEW = 60
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_token(machine: Machine) -> str:
+    """Give a machine a new push token, replacing any previous one.
+
+    Only the hash of the token is stored, the token itself is returned
+    once.
+    """
+    token = secrets.token_urlsafe(32)
+    machine.push_token_hash = hash_token(token)
+    machine.save(update_fields=["push_token_hash"])
+    return token
+
+
+def authenticate_machine(authorization: str) -> Machine | None:
+    """The machine whose token is given as ``Authorization: Bearer <token>``."""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return (
+        Machine.objects.filter(push_token_hash=hash_token(token.strip()))
+        .only("id", "name", "consecutive_failures")
+        .first()
+    )
+
+
+def decompress(body: bytes, encoding: str | None) -> bytes:
+    """Undo a gzip Content-Encoding, refusing bodies over INGEST_MAX_BODY_BYTES.
+
+    Decompression stops at the limit, so a small body inflating to
+    gigabytes costs no more than the limit.
+    """
+    max_bytes = settings.INGEST_MAX_BODY_BYTES
+    if encoding and encoding.strip().lower() == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise PayloadError(f"invalid gzip body: {e}") from None
+        if not decompressor.eof and len(body) <= max_bytes:
+            raise PayloadError("truncated gzip body")
+    elif encoding and encoding.strip().lower() != "identity":
+        raise PayloadError(f"unsupported Content-Encoding: {encoding}")
+    if len(body) > max_bytes:
+        raise PayloadTooLarge(f"body over {max_bytes} bytes")
+    return body
+
+
+def parse_timestamp(value, now: datetime) -> datetime:
+    """A sample time given as epoch seconds or an ISO datetime, UTC if naive.
+
+    Samples must be at most INGEST_MAX_SAMPLE_AGE seconds old and not in
+    the future beyond MAX_CLOCK_SKEW.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            timestamp = datetime.fromtimestamp(value, dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError(f"not a timestamp: {value!r}") from None
+    elif isinstance(value, str) and (timestamp := parse_datetime(value)) is not None:
+        if timezone.is_naive(timestamp):
+            timestamp = timestamp.replace(tzinfo=dt_timezone.utc)
+    else:
+        raise ValueError(f"not a timestamp: {value!r}")
+
+    if timestamp > now + timedelta(seconds=MAX_CLOCK_SKEW):
+        raise ValueError("in the future")
+    if timestamp < now - timedelta(seconds=settings.INGEST_MAX_SAMPLE_AGE):
+        raise ValueError(f"older than {settings.INGEST_MAX_SAMPLE_AGE}s")
+    return timestamp
+
+
+def parse_push(body: bytes, content_type: str, now: datetime) -> list[dict]:
+    """Samples of a push request body.
+
+    The body is either JSON, one sample object or an array of them, or
+    NDJSON (``application/x-ndjson``), one sample object per line. Each
+    sample is an agent payload with an optional ``timestamp``. Raises
+    PayloadError naming the offending sample.
+    """
+    try:
+        if content_type == "application/x-ndjson":
+            items = [loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = loads(body)
+            if not isinstance(items, list):
+                items = [items]
+    except ValueError as e:
+        raise PayloadError(f"invalid JSON: {e}") from None
+
+    if not items:
+        raise PayloadError("no samples")
+    if len(items) > settings.INGEST_MAX_SAMPLES:
+        raise PayloadTooLarge(f"over {settings.INGEST_MAX_SAMPLES} samples")
+
+    samples = []
+    for i, item in enumerate(items):
+        try:
+            sample = parse_sample(item)
+            if "timestamp" in item:
+                try:
+                    sample["timestamp"] = parse_timestamp(item["timestamp"], now)
+                except ValueError as e:
+                    raise PayloadError(f"timestamp: {e}") from None
+        except PayloadError as e:
+            raise PayloadError(f"sample {i}: {e}") from None
+        samples.append(sample)
+    return samples
+
+
+def ingest_samples(machine: Machine, samples: list[dict], now: datetime) -> list[Metric]:
+    """Save the samples pushed by a machine and queue their incident checks.
+
+    Samples with a timestamp already saved are skipped, so agents sending
+    timestamps may retry a push safely, samples without one are taken at
+    ``now``. Samples are saved oldest first in one batch, like a poll
+    cycle's, and the machine is not polled for POLL_MAX_INTERVAL. Buckets
+    already rolled up are rolled up again for late samples, see
+    rollup_late_metrics. A push also ends the failed polls of the machine.
+    Returns the metrics saved.
+    """
+    from monitor.tasks import rollup_late_metrics_task, run_batch_checks_task
+
+    timestamps = [sample["timestamp"] for sample in samples if "timestamp" in sample]
+    seen = set()
+    if timestamps:
+        seen = set(
+            Metric.objects.filter(
+                machine=machine,
+                timestamp__gte=min(timestamps),
+                timestamp__lte=max(timestamps),
+            ).values_list("timestamp", flat=True)
+        )
+    new = []
+    for sample in sorted(samples, key=lambda sample: sample.get("timestamp", now)):
+        if "timestamp" in sample:
+            if sample["timestamp"] in seen:
+                continue
+            seen.add(sample["timestamp"])
+        new.append((machine, sample))
+
+    metrics = save_metrics(new) if new else []
+    if metrics:
+        run_batch_checks_task.delay([metric.id for metric in metrics])
+        # No watermark can be past the last bucket closed ROLLUP_DELAY ago.
+        rolled_up = bucket_start(now - timedelta(seconds=settings.ROLLUP_DELAY), "1m")
+        if metrics[0].timestamp < rolled_up:
+            rollup_late_metrics_task.delay(
+                machine.id, metrics[0].timestamp.isoformat(), metrics[-1].timestamp.isoformat()
+            )
+
+    # A machine that pushes is only polled again once it stops pushing.
+    machine.next_poll_at = now + timedelta(seconds=settings.POLL_MAX_INTERVAL)
+    Machine.objects.filter(id=machine.id).update(
+        next_poll_at=machine.next_poll_at, consecutive_failures=0
+    )
+    if machine.consecutive_failures:
+        machine.consecutive_failures = 0
+        evaluate_reachability([(machine, 0)])
+    schedule = get_schedule()
+    if schedule is not None:
+        schedule.add([machine])
+    return metrics
@@ -0,0 +1,176 @@
+import logging
+import time
+from collections.abc import Callable
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Min, Model, Q, QuerySet
+from django.utils import timezone
+
+from monitor.models import Incident, Metric, MetricRollup, RollupWatermark
+from monitor.partitions import drop_partitions_before, is_partitioned, partition_lock
+from monitor.signals import incidents_deleted
+
+logger = logging.getLogger(__name__)
+
+# Called with the model, rows deleted so far and the last id reached.
+Progress = Callable[[type[Model], int, int], None]
+
+
+def purge_chunks(
+    model: type[Model],
+    expired: Q,
+    time_field: str,
+    cutoff: datetime,
+    chunk_size: int,
+    sleep: float,
+    deadline: float | None = None,
+    progress: Progress | None = None,
+) -> int:
+    """Delete the expired rows of a table one primary key range at a time.
+
+    Ids grow with time, so the table is walked from its oldest id and each
+    DELETE only touches ``chunk_size`` consecutive ids, which keeps locks
+    and binlog events small. The walk stops at the first chunk starting
+    after the cutoff, or at ``deadline`` (a time.monotonic() value). Each
+    chunk commits on its own, and ``sleep`` seconds pass between chunks so
+    that replicas and other writers keep up. Returns the rows deleted.
+    """
+    deleted = 0
+    last_id = 0
+    while deadline is None or time.monotonic() < deadline:
+        rows = list(
+            model.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", time_field)[:chunk_size]
+        )
+        if not rows or rows[0][1] >= cutoff:
+            break
+
+        chunk = model.objects.filter(expired, id__gte=rows[0][0], id__lte=rows[-1][0])
+        deleted += delete_chunk(model, chunk)
+        last_id = rows[-1][0]
+        if progress:
+            progress(model, deleted, last_id)
+        time.sleep(sleep)
+    return deleted
+
+
+def delete_chunk(model: type[Model], chunk: QuerySet) -> int:
+    """Delete the rows of ``chunk`` with a single query, return how many there were.
+
+    Incidents have post_delete receivers, which would make Django load
+    and signal every deleted row, so they are deleted without signals and
+    their receivers' work is done once for the whole chunk.
+    """
+    if model is not Incident:
+        count, _ = chunk.delete()
+        return count
+    keys = list(chunk.values_list("machine_id", "type").distinct())
+    count = chunk._raw_delete(chunk.db)
+    if count:
+        incidents_deleted(keys, count)
+    return count
+
+
+def metric_cutoff(now: datetime, days: int) -> datetime | None:
+    """Time before which raw metrics expire, None if they are kept forever.
+
+    Metrics are kept until every rollup resolution has been computed past
+    them, so that purging never loses data the rollups still need.
+    """
+    if not days:
+        return None
+    cutoff = now - timedelta(days=days)
+    rolled_up = RollupWatermark.objects.aggregate(position=Min("position"))["position"]
+    if rolled_up is not None:
+        cutoff = min(cutoff, rolled_up)
+    return cutoff
+
+
+def purge_expired(
+    now: datetime | None = None,
+    metric_days: int | None = None,
+    incident_days: int | None = None,
+    minute_rollup_days: int | None = None,
+    chunk_size: int | None = None,
+    sleep: float | None = None,
+    time_limit: float | None = None,
+    progress: Progress | None = None,
+) -> dict[str, int]:
+    """Enforce the retention of raw metrics, resolved incidents and minute rollups.
+
+    Arguments default to the METRIC_RETENTION_DAYS, INCIDENT_RETENTION_DAYS,
+    MINUTE_ROLLUP_RETENTION_DAYS and PURGE_* settings, a retention of 0
+    days keeps rows forever. Hourly and daily rollups are never purged,
+    they are not computed from minute ones. When the metric table is
+    partitioned, its expired partitions are dropped instead, rows newer
+    than the oldest kept partition's start are then kept a little longer
+    than their retention. Metrics are skipped while the table is being
+    partitioned, see partition_lock. Returns the rows deleted per table,
+    estimated for dropped partitions.
+    """
+    now = now or timezone.now()
+    metric_days = settings.METRIC_RETENTION_DAYS if metric_days is None else metric_days
+    incident_days = (
+        settings.INCIDENT_RETENTION_DAYS if incident_days is None else incident_days
+    )
+    minute_rollup_days = (
+        settings.MINUTE_ROLLUP_RETENTION_DAYS
+        if minute_rollup_days is None
+        else minute_rollup_days
+    )
+    chunk_size = chunk_size or settings.PURGE_CHUNK_SIZE
+    sleep = settings.PURGE_SLEEP if sleep is None else sleep
+    deadline = time.monotonic() + time_limit if time_limit else None
+
+    deleted = {"metrics": 0, "incidents": 0, "rollups": 0}
+    cutoff = metric_cutoff(now, metric_days)
+    # Not while the table is being partitioned, rows already copied would stay.
+    with partition_lock(timeout=0) as locked:
+        if cutoff and not locked:
+            logger.warning("The metric table is being partitioned, metrics are not purged")
+        elif cutoff and is_partitioned():
+            deleted["metrics"] = drop_partitions_before(cutoff)
+        elif cutoff:
+            deleted["metrics"] = purge_chunks(
+                Metric,
+                Q(timestamp__lt=cutoff),
+                "timestamp",
+                cutoff,
+                chunk_size,
+                sleep,
+                deadline,
+                progress,
+            )
+    if incident_days:
+        cutoff = now - timedelta(days=incident_days)
+        # Resolved before the cutoff, so also started before it.
+        deleted["incidents"] = purge_chunks(
+            Incident,
+            Q(end_time__lt=cutoff),
+            "start_time",
+            cutoff,
+            chunk_size,
+            sleep,
+            deadline,
+            progress,
+        )
+    if minute_rollup_days:
+        cutoff = now - timedelta(days=minute_rollup_days)
+        # Rollups are written once their bucket ends, so ids grow with buckets.
+        deleted["rollups"] = purge_chunks(
+            MetricRollup,
+            Q(resolution="1m", bucket__lt=cutoff),
+            "bucket",
+            cutoff,
+            chunk_size,
+            sleep,
+            deadline,
+            progress,
+        )
+    logger.info(
+        f"Purged {deleted['metrics']} metrics, {deleted['incidents']} resolved incidents "
+        f"and {deleted['rollups']} minute rollups"
+    )
+    return deleted
@@ -0,0 +1,169 @@
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from monitor.models import Machine, Metric, MetricRollup, RollupWatermark
+
+RESOLUTIONS = {
+    "1m": timedelta(minutes=1),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+
+FIELDS = ("cpu", "mem", "disk")
+
+AGGREGATES = [
+    f"{field}_{aggregate}" for field in FIELDS for aggregate in ("min", "max", "avg", "p95")
+]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    """Start of the bucket holding timestamp, buckets being aligned on UTC."""
+    size = RESOLUTIONS[resolution]
+    return EPOCH + (timestamp - EPOCH) // size * size
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(machine_id: int, resolution: str, bucket: datetime, rows) -> MetricRollup:
+    """Build the rollup of ``(cpu, mem, disk)`` rows of one bucket."""
+    rollup = MetricRollup(
+        machine_id=machine_id, resolution=resolution, bucket=bucket, samples=len(rows)
+    )
+    for i, field in enumerate(FIELDS):
+        values = sorted(row[i] for row in rows)
+        setattr(rollup, f"{field}_min", values[0])
+        setattr(rollup, f"{field}_max", values[-1])
+        setattr(rollup, f"{field}_avg", sum(values) / len(values))
+        setattr(rollup, f"{field}_p95", percentile(values, 95))
+    return rollup
+
+
+def rollup_range(
+    resolution: str, start: datetime, end: datetime, machine_ids: list[int] | None = None
+) -> int:
+    """Roll up the metrics of ``[start, end)`` and return the number of rollups written.
+
+    Buckets are recomputed from raw rows and upserted, so rolling up a
+    range again gives the same rows. Machines, all of them unless
+    ``machine_ids`` are given, are read a chunk at a time through the
+    (machine, timestamp) index to bound memory.
+    """
+    if machine_ids is None:
+        machine_ids = list(Machine.objects.order_by("id").values_list("id", flat=True))
+    chunk = settings.ROLLUP_MACHINE_CHUNK
+    # MySQL upserts on any unique key and does not take the fields.
+    unique_fields = (
+        ["machine", "resolution", "bucket"]
+        if connection.features.supports_update_conflicts_with_target
+        else None
+    )
+
+    written = 0
+    for i in range(0, len(machine_ids), chunk):
+        buckets = defaultdict(list)
+        rows = Metric.objects.filter(
+            machine_id__in=machine_ids[i : i + chunk],
+            timestamp__gte=start,
+            timestamp__lt=end,
+        ).values_list("machine_id", "timestamp", *FIELDS)
+        for machine_id, timestamp, *values in rows.iterator(chunk_size=5000):
+            buckets[(machine_id, bucket_start(timestamp, resolution))].append(values)
+
+        rollups = [
+            summarize(machine_id, resolution, bucket, bucket_rows)
+            for (machine_id, bucket), bucket_rows in buckets.items()
+        ]
+        MetricRollup.objects.bulk_create(
+            rollups,
+            batch_size=settings.INGEST_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=["samples", *AGGREGATES],
+        )
+        written += len(rollups)
+    return written
+
+
+def lock_watermark(resolution: str) -> RollupWatermark | None:
+    """Lock the watermark of a resolution, starting it at the oldest metric."""
+    watermark = (
+        RollupWatermark.objects.select_for_update().filter(resolution=resolution).first()
+    )
+    if watermark is None:
+        first = Metric.objects.order_by("id").values_list("timestamp", flat=True).first()
+        if first is None:
+            return None
+        RollupWatermark.objects.get_or_create(
+            resolution=resolution, defaults={"position": bucket_start(first, resolution)}
+        )
+        watermark = RollupWatermark.objects.select_for_update().get(resolution=resolution)
+    return watermark
+
+
+def rollup_metrics(now: datetime | None = None) -> dict[str, int]:
+    """Roll up every bucket closed since the watermark of each resolution.
+
+    A bucket is rolled up once ROLLUP_DELAY seconds have passed since it
+    ended, so late inserts still land in it. Work is done ROLLUP_STEP at a
+    time, each step committing its rollups together with the watermark,
+    so an interrupted run resumes where it stopped. The watermark row is
+    locked meanwhile, so concurrent runs do not repeat each other's work.
+    Returns the number of rollups written per resolution.
+    """
+    now = now or timezone.now()
+    step_size = timedelta(seconds=settings.ROLLUP_STEP)
+    written = {}
+
+    for resolution, size in RESOLUTIONS.items():
+        written[resolution] = 0
+        end = bucket_start(now - timedelta(seconds=settings.ROLLUP_DELAY), resolution)
+        step = max(step_size // size, 1) * size
+
+        for _ in range(settings.ROLLUP_MAX_STEPS):
+            with transaction.atomic():
+                watermark = lock_watermark(resolution)
+                if watermark is None or watermark.position >= end:
+                    break
+
+                step_end = min(watermark.position + step, end)
+                written[resolution] += rollup_range(resolution, watermark.position, step_end)
+                watermark.position = step_end
+                watermark.save(update_fields=["position"])
+
+    return written
+
+
+
+def rollup_late_metrics(machine_id: int, oldest: datetime, newest: datetime) -> int:
+    """Roll up again the buckets of a machine's metrics saved behind the watermarks.
+
+    Pushed samples may be up to INGEST_MAX_SAMPLE_AGE old, while
+    rollup_metrics only rolls up buckets past each watermark. The buckets
+    of ``[oldest, newest]`` a watermark already passed are recomputed for
+    the machine, under the watermark's lock so that a concurrent run that
+    missed the new rows has committed its position. Returns the number of
+    rollups written.
+    """
+    written = 0
+    for resolution, size in RESOLUTIONS.items():
+        with transaction.atomic():
+            watermark = (
+                RollupWatermark.objects.select_for_update().filter(resolution=resolution).first()
+            )
+            if watermark is None or watermark.position <= oldest:
+                continue
+            end = min(bucket_start(newest, resolution) + size, watermark.position)
+            written += rollup_range(
+                resolution, bucket_start(oldest, resolution), end, [machine_id]
+            )
+    return written
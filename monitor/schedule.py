@@ -0,0 +1,333 @@
+import random
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from monitor.incident import METRIC_FIELDS, evaluate_reachability
+from monitor.ingest import POLL_STATUS_FIELDS, upsert_statuses
+from monitor.models import THRESHOLDS, Incident, Machine, MachineStatus
+from monitor.payload import PayloadError
+from monitor.shards import get_ring
+
+
+class RedisSchedule:
+    """Index of the next poll times kept in one Redis sorted set per shard.
+
+    The database keeps the schedule, Redis only spares the pollers from
+    querying and locking the machine table on every tick. Claims are
+    atomic, so concurrent pollers never get the same machine. The index is
+    rebuilt from the database by ``sync``, at most every
+    POLL_SCHEDULE_SYNC seconds, which also picks up deleted machines and a
+    flushed Redis.
+    """
+
+    PREFIX = "poll-schedule"
+    SYNCED_KEY = "poll-schedule-synced"
+
+    # KEYS[1]: shard key. ARGV: now, limit, claimed until.
+    CLAIM = """
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, id in ipairs(ids) do
+        redis.call('ZADD', KEYS[1], ARGV[3], id)
+    end
+    return ids
+    """
+
+    def __init__(self, url: str, sync_interval: int):
+        import redis
+
+        self.sync_interval = sync_interval
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._claim = self.client.register_script(self.CLAIM)
+
+    def _key(self, shard: int) -> str:
+        return f"{self.PREFIX}:{shard}"
+
+    def add(self, machines: list[Machine], only_new: bool = False):
+        """Index the next poll of machines, ``only_new`` keeps indexed ones as they are."""
+        ring = get_ring()
+        shards: dict[int, dict[str, float]] = {}
+        for machine in machines:
+            shards.setdefault(ring.shard_for(machine.id), {})[str(machine.id)] = (
+                machine.next_poll_at.timestamp()
+            )
+        pipeline = self.client.pipeline(transaction=False)
+        for shard, members in shards.items():
+            pipeline.zadd(self._key(shard), members, nx=only_new)
+        pipeline.execute()
+
+    def claim(self, now: datetime, shard: int | None = None) -> list[Machine]:
+        shards = range(get_ring().shards) if shard is None else [shard]
+        until = (now + timedelta(seconds=settings.POLL_CLAIM_TIMEOUT)).timestamp()
+        ids = []
+        for shard in shards:
+            limit = settings.POLL_TICK_LIMIT - len(ids)
+            if limit <= 0:
+                break
+            ids += self._claim(
+                keys=[self._key(shard)], args=[now.timestamp(), limit, until]
+            )
+        if not ids:
+            return []
+
+        machines = Machine.objects.in_bulk([int(id_) for id_ in ids])
+        deleted = [id_ for id_ in ids if int(id_) not in machines]
+        if deleted:
+            self.remove(deleted)
+        return [machines[int(id_)] for id_ in ids if int(id_) in machines]
+
+    def remove(self, ids):
+        ring = get_ring()
+        pipeline = self.client.pipeline(transaction=False)
+        for id_ in ids:
+            pipeline.zrem(self._key(ring.shard_for(int(id_))), id_)
+        pipeline.execute()
+
+    def sync(self, force: bool = False) -> bool:
+        """Rebuild the index from the database unless done less than POLL_SCHEDULE_SYNC ago.
+
+        Machines already indexed keep their score, which may be a pending
+        claim. Returns whether the index was rebuilt.
+        """
+        if not force and not self.client.set(
+            self.SYNCED_KEY, 1, nx=True, ex=self.sync_interval
+        ):
+            return False
+
+        ring = get_ring()
+        machines = list(
+            Machine.objects.filter(next_poll_at__isnull=False).only("next_poll_at")
+        )
+        self.add(machines, only_new=True)
+
+        wanted = {str(machine.id) for machine in machines}
+        for key in self.client.scan_iter(f"{self.PREFIX}:*"):
+            shard = int(key.rsplit(":", 1)[1])
+            if shard >= ring.shards:
+                # Left over from a larger POLL_SHARDS.
+                self.client.delete(key)
+                continue
+            stale = set(self.client.zrange(key, 0, -1)) - wanted
+            if stale:
+                self.client.zrem(key, *stale)
+        return True
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.PREFIX}:*"):
+            self.client.delete(key)
+        self.client.delete(self.SYNCED_KEY)
+
+
+_schedule = None
+
+
+def get_schedule() -> RedisSchedule | None:
+    """Return the Redis schedule index configured by POLL_SCHEDULE_URL, if any."""
+    global _schedule
+    if _schedule is None and settings.POLL_SCHEDULE_URL:
+        _schedule = RedisSchedule(settings.POLL_SCHEDULE_URL, settings.POLL_SCHEDULE_SYNC)
+    return _schedule
+
+
+def next_interval(previous: int | None, sample: dict | None, incident_open: bool) -> int:
+    """Seconds until a machine is polled again, before jitter.
+
+    Machines over a threshold or with an open incident are polled every
+    POLL_MIN_INTERVAL. Machines within POLL_NEAR_THRESHOLD points of a
+    threshold have their interval halved, and stable ones have it grown by
+    half, up to POLL_MAX_INTERVAL. A failed fetch keeps the interval.
+    """
+    previous = previous or settings.POLL_INTERVAL
+    if sample is None:
+        return previous
+
+    margins = [
+        float(sample[field]) - THRESHOLDS[type_]["value"]
+        for type_, field in METRIC_FIELDS.items()
+    ]
+    if incident_open or max(margins) > 0:
+        interval = settings.POLL_MIN_INTERVAL
+    elif max(margins) > -settings.POLL_NEAR_THRESHOLD:
+        interval = previous // 2
+    else:
+        interval = previous * 3 // 2
+    return max(settings.POLL_MIN_INTERVAL, min(interval, settings.POLL_MAX_INTERVAL))
+
+
+def failure_backoff(failures: int) -> int:
+    """Seconds until a machine whose last ``failures`` polls failed is polled again.
+
+    The first failures are retried after POLL_MIN_INTERVAL to confirm the
+    outage. From POLL_BREAKER_THRESHOLD failures in a row the breaker is
+    open: the delay starts at POLL_INTERVAL and doubles with each failure,
+    up to POLL_BREAKER_MAX_BACKOFF, so dead hosts stop taking poll slots
+    from live ones.
+    """
+    threshold = settings.POLL_BREAKER_THRESHOLD
+    if failures < threshold:
+        return settings.POLL_MIN_INTERVAL
+    exponent = min(failures - threshold, 32)
+    return min(settings.POLL_INTERVAL * 2**exponent, settings.POLL_BREAKER_MAX_BACKOFF)
+
+
+def jittered(seconds: float) -> timedelta:
+    """Spread polls by up to POLL_JITTER of their interval either way."""
+    jitter = settings.POLL_JITTER
+    return timedelta(seconds=seconds * random.uniform(1 - jitter, 1 + jitter))
+
+
+_assigned_shards: int | None = None
+
+
+def assign_shards() -> int:
+    """Store the poll shard of machines that have none, or all of them once per ring size.
+
+    The shard is kept on the machine so that a shard task finds its due
+    machines through the (poll_shard, next_poll_at) index. The first call
+    of a process, and the first after POLL_SHARDS changed, recomputes the
+    shard of every machine, later ones only assign new machines. Returns
+    the number of machines whose shard changed.
+    """
+    global _assigned_shards
+    ring = get_ring()
+    machines = Machine.objects.all()
+    if _assigned_shards == ring.shards:
+        machines = machines.filter(poll_shard__isnull=True)
+    changed = []
+    for id_, shard in machines.values_list("id", "poll_shard").iterator(chunk_size=5000):
+        if shard != ring.shard_for(id_):
+            changed.append(Machine(id=id_, poll_shard=ring.shard_for(id_)))
+    Machine.objects.bulk_update(changed, ["poll_shard"], batch_size=settings.INGEST_BATCH_SIZE)
+    _assigned_shards = ring.shards
+    return len(changed)
+
+
+def schedule_new_machines(now: datetime | None = None) -> int:
+    """Give machines never scheduled a random first poll within POLL_INTERVAL.
+
+    This spreads a new fleet's polls instead of polling it all at once.
+    New machines are also given their shard, see assign_shards. Returns
+    the number of machines scheduled.
+    """
+    now = now or timezone.now()
+    assign_shards()
+    with transaction.atomic():
+        unscheduled = list(
+            Machine.objects.select_for_update(skip_locked=True).filter(
+                next_poll_at__isnull=True
+            )
+        )
+        for machine in unscheduled:
+            machine.next_poll_at = now + timedelta(
+                seconds=random.uniform(0, settings.POLL_INTERVAL)
+            )
+        Machine.objects.bulk_update(unscheduled, ["next_poll_at"], batch_size=1000)
+
+    schedule = get_schedule()
+    if schedule is not None:
+        if not schedule.sync():
+            schedule.add(unscheduled, only_new=True)
+    return len(unscheduled)
+
+
+def claim_due_machines(
+    now: datetime | None = None, shard: int | None = None
+) -> list[Machine]:
+    """Return the due machines of a shard, or of the fleet, and push back their next poll.
+
+    Claimed machines become due again after POLL_CLAIM_TIMEOUT unless the
+    poll reschedules them first, so a poll lost with its worker is retried
+    then, not at the next tick. A shard's machines are those assigned to
+    it by assign_shards, machines without a shard yet are left for the
+    next tick. Rows are locked with SKIP LOCKED and checked to be due again under the
+    lock, so concurrent claims never return the same machine. With
+    POLL_SCHEDULE_URL set, due machines are claimed from the Redis index
+    instead.
+    """
+    now = now or timezone.now()
+    schedule = get_schedule()
+    if schedule is not None:
+        return schedule.claim(now, shard)
+
+    due = Machine.objects.filter(next_poll_at__lte=now).order_by("next_poll_at")
+    if shard is not None:
+        due = due.filter(poll_shard=shard)
+    ids = list(due.values_list("id", flat=True)[: settings.POLL_TICK_LIMIT])
+    if not ids:
+        return []
+
+    with transaction.atomic():
+        claimed = list(
+            Machine.objects.select_for_update(skip_locked=True).filter(
+                id__in=ids, next_poll_at__lte=now
+            )
+        )
+        Machine.objects.filter(id__in=[machine.id for machine in claimed]).update(
+            next_poll_at=now + timedelta(seconds=settings.POLL_CLAIM_TIMEOUT)
+        )
+    return claimed
+
+
+def reschedule(
+    results: list[tuple[Machine, dict | PayloadError | None]], now: datetime | None = None
+):
+    """Set the next poll of polled machines from their latest sample.
+
+    Failed polls, a None sample, are counted per machine and back the
+    machine off, see failure_backoff, and open or close its UNREACHABLE
+    incident. A machine whose agent answered with an invalid payload, a
+    PayloadError, is reachable: it keeps its interval and does not count
+    as failed. The outcome of the poll is kept in the machine's status.
+    """
+    if not results:
+        return
+    now = now or timezone.now()
+    machine_ids = {machine.id for machine, _ in results}
+    with_incidents = set(
+        Incident.objects.filter(
+            machine_id__in=machine_ids, type__in=METRIC_FIELDS, end_time__isnull=True
+        )
+        .values_list("machine_id", flat=True)
+        .distinct()
+    )
+
+    machines, reachability = [], []
+    for machine, sample in results:
+        failed_before = machine.consecutive_failures
+        machine.poll_interval = next_interval(
+            machine.poll_interval,
+            sample if isinstance(sample, dict) else None,
+            machine.id in with_incidents,
+        )
+        if sample is None:
+            machine.consecutive_failures += 1
+            delay = failure_backoff(machine.consecutive_failures)
+        else:
+            machine.consecutive_failures = 0
+            delay = machine.poll_interval
+        machine.next_poll_at = now + jittered(delay)
+        machines.append(machine)
+        # Only machines that failed now or before can open or close an incident.
+        if failed_before or machine.consecutive_failures:
+            reachability.append((machine, machine.consecutive_failures))
+    Machine.objects.bulk_update(
+        machines,
+        ["poll_interval", "next_poll_at", "consecutive_failures"],
+        batch_size=settings.INGEST_BATCH_SIZE,
+    )
+    upsert_statuses(
+        [
+            MachineStatus(
+                machine_id=machine.id, polled_at=now, poll_ok=isinstance(sample, dict)
+            )
+            for machine, sample in results
+        ],
+        POLL_STATUS_FIELDS,
+    )
+    evaluate_reachability(reachability)
+    schedule = get_schedule()
+    if schedule is not None:
+        schedule.add(machines)
+
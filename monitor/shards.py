@@ -0,0 +1,43 @@
+import bisect
+import hashlib
+from functools import lru_cache
+
+from django.conf import settings
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring assigning machines to poll shards.
+
+    Each shard owns ``replicas`` points on the ring and a machine belongs
+    to the shard owning the first point after its hash. Changing the
+    number of shards only moves the machines of the points that changed
+    hands, about 1/shards of the fleet.
+    """
+
+    def __init__(self, shards: int, replicas: int = 64):
+        self.shards = shards
+        points = sorted(
+            (hash_key(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, machine_id: int) -> int:
+        i = bisect.bisect(self._hashes, hash_key(f"machine-{machine_id}"))
+        return self._owners[i % len(self._owners)]
+
+
+@lru_cache
+def _ring(shards: int) -> HashRing:
+    return HashRing(shards)
+
+
+def get_ring() -> HashRing:
+    """Return the ring of POLL_SHARDS shards."""
+    return _ring(settings.POLL_SHARDS)
@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from monitor.cache import invalidate
+from monitor.events import opened_event, publish, resolved_event
+from monitor.models import DeleteGeneration, Incident, Machine
+from monitor.state import get_store
+
+
+def invalidate_incident_state(keys):
+    get_store().invalidate(keys)
+    # Again once committed, in case a reader cached the old rows meanwhile.
+    transaction.on_commit(lambda: get_store().invalidate(keys))
+
+
+def incidents_deleted(keys, count: int):
+    """Invalidate what depended on ``count`` deleted incidents of ``keys``.
+
+    Called once per bulk delete, such as each chunk of a purge, which
+    skips the per-row post_delete receivers below.
+    """
+    invalidate_incident_state(keys)
+    invalidate("incidents")
+    DeleteGeneration.bump(Incident._meta.db_table, count)
+
+
+@receiver(post_save, sender=Incident)
+def invalidate_saved_incident(sender, instance, **kwargs):
+    """Drop the cached state of incidents written outside the incident engine.
+
+    The engine itself writes with bulk queries, which send no signals.
+    """
+    invalidate_incident_state([(instance.machine_id, instance.type)])
+    invalidate("incidents")
+
+
+@receiver(post_save, sender=Incident)
+def publish_incident_event(sender, instance, created, **kwargs):
+    """Publish incidents opened or resolved outside the incident engine."""
+    if created:
+        publish([opened_event(instance)])
+    elif instance.end_time:
+        publish(
+            [
+                resolved_event(
+                    instance.id, instance.machine.name, instance.type, instance.end_time
+                )
+            ]
+        )
+
+
+@receiver(post_delete, sender=Incident)
+def invalidate_deleted_incident(sender, instance, **kwargs):
+    incidents_deleted([(instance.machine_id, instance.type)], 1)
+
+
+@receiver([post_save, post_delete], sender=Machine)
+def invalidate_machine_responses(sender, instance, **kwargs):
+    invalidate("machines")
@@ -0,0 +1,352 @@
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+
+# (machine_id, incident type)
+StateKey = tuple[int, str]
+# (ids of the open incidents, start time of the latest incident)
+StateEntry = tuple[tuple[int, ...], datetime | None]
+# Claimed keys have a version but no entry until the claim is committed.
+PENDING = None
+# Seconds a key stays pending, should its claimer die before writing it.
+PENDING_TTL = 30
+
+EMPTY_ENTRY: StateEntry = ((), None)
+
+
+class StateConflict(Exception):
+    """Raised when another worker changed incident state we were about to write."""
+
+    def __init__(self, keys):
+        super().__init__(f"Incident state changed concurrently for {len(keys)} keys")
+        self.keys = keys
+
+
+class StatePending(StateConflict):
+    """Raised when populating keys claimed by another worker, until it writes them.
+
+    The database rows behind a pending key may not be committed yet, so
+    the caller retries once they are instead of caching what it read.
+    """
+
+    def __str__(self):
+        return f"Incident state pending for {len(self.keys)} keys"
+
+
+class UncachedStateStore:
+    """Keeps no incident state, so it is read from the database at every evaluation.
+
+    Used when neither a Redis URL nor INCIDENT_STATE_LOCAL is set: state
+    kept in the memory of one Celery worker process is not updated by
+    the others. Windows are reloaded from the database at every
+    evaluation for the same reason.
+    """
+
+    def get_many(self, keys) -> dict[StateKey, tuple[str, StateEntry]]:
+        return {}
+
+    def populate(self, entries) -> dict[StateKey, tuple[str, StateEntry]]:
+        return {key: ("", entry) for key, entry in entries.items()}
+
+    def claim(self, versions) -> dict[StateKey, str]:
+        return {key: "" for key in versions}
+
+    def compare_and_set(self, changes) -> None:
+        pass
+
+    def invalidate(self, keys) -> None:
+        pass
+
+    def count_evaluations(self, machine_ids) -> dict[int, int]:
+        # Never one more than the count of the previous evaluation.
+        return {machine_id: 0 for machine_id in machine_ids}
+
+    def clear(self) -> None:
+        pass
+
+
+class LocalStateStore:
+    """Incident state held in the memory of the current process.
+
+    Only authoritative when a single process evaluates incidents, use the
+    Redis store when several Celery workers do.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: dict[StateKey, tuple[str, StateEntry, float]] = {}
+        self._evaluations: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _current(self, key):
+        item = self._entries.get(key)
+        if item is None or item[2] < time.monotonic():
+            return None
+        return item
+
+    def get_many(self, keys) -> dict[StateKey, tuple[str, StateEntry]]:
+        with self._lock:
+            found = {}
+            for key in keys:
+                item = self._current(key)
+                if item is not None and item[1] is not PENDING:
+                    found[key] = item[:2]
+            return found
+
+    def populate(self, entries) -> dict[StateKey, tuple[str, StateEntry]]:
+        """Store entries whose keys are absent and return the current state of all keys.
+
+        Pending keys are left to their claimer and StatePending is raised
+        for them once the other keys are stored.
+        """
+        with self._lock:
+            expires = time.monotonic() + self.ttl
+            current, pending = {}, []
+            for key, entry in entries.items():
+                item = self._current(key)
+                if item is None:
+                    item = self._entries[key] = (uuid.uuid4().hex, entry, expires)
+                elif item[1] is PENDING:
+                    pending.append(key)
+                    continue
+                current[key] = item[:2]
+            if pending:
+                raise StatePending(pending)
+            return current
+
+    def claim(self, versions) -> dict[StateKey, str]:
+        """Mark keys pending if none of them changed since they were read.
+
+        ``versions`` maps keys to the version read. Pending keys read as
+        absent and cannot be populated, so readers wait for the state about
+        to change instead of trusting it, for PENDING_TTL seconds at most.
+        Either every key is claimed and their new versions returned, for
+        compare_and_set once the changes are committed, or StateConflict
+        is raised.
+        """
+        with self._lock:
+            self._check(versions)
+            expires = time.monotonic() + min(self.ttl, PENDING_TTL)
+            claimed = {key: uuid.uuid4().hex for key in versions}
+            for key, version in claimed.items():
+                self._entries[key] = (version, PENDING, expires)
+            return claimed
+
+    def _check(self, versions):
+        conflicts = [
+            key
+            for key, version in versions.items()
+            if (self._current(key) or (None,))[0] != version
+        ]
+        if conflicts:
+            raise StateConflict(conflicts)
+
+    def compare_and_set(self, changes) -> None:
+        """Replace entries if none of them changed since they were read.
+
+        ``changes`` maps keys to ``(expected_version, new_entry)``. Either
+        every entry is written or, if any version differs, none is and
+        StateConflict is raised.
+        """
+        with self._lock:
+            self._check({key: version for key, (version, _) in changes.items()})
+            expires = time.monotonic() + self.ttl
+            for key, (_, entry) in changes.items():
+                self._entries[key] = (uuid.uuid4().hex, entry, expires)
+
+    def invalidate(self, keys) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def count_evaluations(self, machine_ids) -> dict[int, int]:
+        """Count one more evaluation of each machine, return the new counts."""
+        with self._lock:
+            for machine_id in machine_ids:
+                self._evaluations[machine_id] = self._evaluations.get(machine_id, 0) + 1
+            return {machine_id: self._evaluations[machine_id] for machine_id in machine_ids}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._evaluations.clear()
+
+
+class RedisStateStore:
+    """Incident state shared by every worker through Redis.
+
+    Each key is a hash holding a version token and the JSON encoded entry.
+    Writes go through Lua scripts so that checking versions and writing is
+    atomic across workers.
+    """
+
+    PREFIX = "incident-state"
+
+    # Pending keys, with a version but no entry, are left as they are and
+    # returned as nil.
+    POPULATE = """
+    local result = {}
+    for i, key in ipairs(KEYS) do
+        if redis.call('HEXISTS', key, 'v') == 1 and redis.call('HEXISTS', key, 'd') == 0 then
+            result[i] = false
+        else
+            redis.call('HSETNX', key, 'v', ARGV[2 * i - 1])
+            redis.call('HSETNX', key, 'd', ARGV[2 * i])
+            redis.call('EXPIRE', key, ARGV[#ARGV], 'NX')
+            result[i] = redis.call('HMGET', key, 'v', 'd')
+        end
+    end
+    return result
+    """
+
+    COMPARE_AND_SET = """
+    local conflicts = {}
+    for i, key in ipairs(KEYS) do
+        if (redis.call('HGET', key, 'v') or '') ~= ARGV[3 * i - 2] then
+            table.insert(conflicts, i)
+        end
+    end
+    if #conflicts > 0 then
+        return conflicts
+    end
+    for i, key in ipairs(KEYS) do
+        redis.call('HSET', key, 'v', ARGV[3 * i - 1], 'd', ARGV[3 * i])
+        redis.call('EXPIRE', key, ARGV[#ARGV])
+    end
+    return conflicts
+    """
+
+    CLAIM = """
+    local conflicts = {}
+    for i, key in ipairs(KEYS) do
+        if (redis.call('HGET', key, 'v') or '') ~= ARGV[2 * i - 1] then
+            table.insert(conflicts, i)
+        end
+    end
+    if #conflicts > 0 then
+        return conflicts
+    end
+    for i, key in ipairs(KEYS) do
+        redis.call('HSET', key, 'v', ARGV[2 * i])
+        redis.call('HDEL', key, 'd')
+        redis.call('EXPIRE', key, ARGV[#ARGV])
+    end
+    return conflicts
+    """
+
+    def __init__(self, url: str, ttl: float):
+        import redis
+
+        self.ttl = int(ttl)
+        self.client = redis.Redis.from_url(url)
+        self._populate = self.client.register_script(self.POPULATE)
+        self._claim = self.client.register_script(self.CLAIM)
+        self._compare_and_set = self.client.register_script(self.COMPARE_AND_SET)
+
+    def _key(self, key: StateKey) -> str:
+        return f"{self.PREFIX}:{key[0]}:{key[1]}"
+
+    @staticmethod
+    def _dump(entry: StateEntry) -> str:
+        open_ids, last_start = entry
+        return json.dumps([open_ids, last_start.timestamp() if last_start else None])
+
+    @staticmethod
+    def _load(data: bytes) -> StateEntry:
+        open_ids, last_start = json.loads(data)
+        if last_start is not None:
+            last_start = datetime.fromtimestamp(last_start, dt_timezone.utc)
+        return tuple(open_ids), last_start
+
+    def get_many(self, keys) -> dict[StateKey, tuple[str, StateEntry]]:
+        keys = list(keys)
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hmget(self._key(key), "v", "d")
+        found = {}
+        for key, (version, data) in zip(keys, pipeline.execute()):
+            if version is not None and data is not None:
+                found[key] = (version.decode(), self._load(data))
+        return found
+
+    def populate(self, entries) -> dict[StateKey, tuple[str, StateEntry]]:
+        if not entries:
+            return {}
+        keys = list(entries)
+        args = []
+        for key in keys:
+            args += [uuid.uuid4().hex, self._dump(entries[key])]
+        rows = self._populate(keys=[self._key(key) for key in keys], args=[*args, self.ttl])
+        pending = [key for key, row in zip(keys, rows) if row is None]
+        if pending:
+            raise StatePending(pending)
+        return {
+            key: (version.decode(), self._load(data))
+            for key, (version, data) in zip(keys, rows)
+        }
+
+    def claim(self, versions) -> dict[StateKey, str]:
+        if not versions:
+            return {}
+        keys = list(versions)
+        claimed = {key: uuid.uuid4().hex for key in keys}
+        args = []
+        for key in keys:
+            args += [versions[key] or "", claimed[key]]
+        conflicts = self._claim(
+            keys=[self._key(key) for key in keys], args=[*args, min(self.ttl, PENDING_TTL)]
+        )
+        if conflicts:
+            raise StateConflict([keys[i - 1] for i in conflicts])
+        return claimed
+
+    def compare_and_set(self, changes) -> None:
+        if not changes:
+            return
+        keys = list(changes)
+        args = []
+        for key in keys:
+            version, entry = changes[key]
+            args += [version or "", uuid.uuid4().hex, self._dump(entry)]
+        conflicts = self._compare_and_set(
+            keys=[self._key(key) for key in keys], args=[*args, self.ttl]
+        )
+        if conflicts:
+            raise StateConflict([keys[i - 1] for i in conflicts])
+
+    def invalidate(self, keys) -> None:
+        keys = [self._key(key) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def count_evaluations(self, machine_ids) -> dict[int, int]:
+        machine_ids = list(machine_ids)
+        pipeline = self.client.pipeline(transaction=False)
+        for machine_id in machine_ids:
+            pipeline.incr(f"{self.PREFIX}:evaluations:{machine_id}")
+            pipeline.expire(f"{self.PREFIX}:evaluations:{machine_id}", self.ttl)
+        return dict(zip(machine_ids, pipeline.execute()[::2]))
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(f"{self.PREFIX}:*"):
+            self.client.delete(key)
+
+
+_store = None
+
+
+def get_store():
+    """Return the incident state store configured by INCIDENT_STATE_URL/INCIDENT_STATE_LOCAL."""
+    global _store
+    if _store is None:
+        if settings.INCIDENT_STATE_URL:
+            _store = RedisStateStore(settings.INCIDENT_STATE_URL, settings.INCIDENT_STATE_TTL)
+        elif settings.INCIDENT_STATE_LOCAL:
+            _store = LocalStateStore(settings.INCIDENT_STATE_TTL)
+        else:
+            _store = UncachedStateStore()
+    return _store
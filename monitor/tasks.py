@@ -1,19 +1,57 @@
 import asyncio
 import logging
+from datetime import datetime
 
 from celery import shared_task
+from celery.signals import worker_process_init
+from django.conf import settings
 
-from monitor.incident import check_cpu, check_disk, check_mem
+from monitor.incident import (
+    check_cpu,
+    check_disk,
+    check_mem,
+    evaluate_metrics,
+    warm_incident_state,
+)
 from monitor.models import Metric
-from monitor.poll import poll_machines
+from monitor.partitions import create_future_partitions
+from monitor.poll import poll_due_machines, poll_machines
+from monitor.retention import purge_expired
+from monitor.rollup import rollup_late_metrics, rollup_metrics
+from monitor.schedule import schedule_new_machines
 
 logger = logging.getLogger(__name__)
 
 
+@worker_process_init.connect
+def warm_incident_state_on_start(**kwargs):
+    try:
+        warm_incident_state()
+    except Exception as e:
+        logger.error(f"Failed to warm incident state: {e}", exc_info=True)
+
+
 @shared_task
 def poll_machines_task():
     asyncio.run(poll_machines())
 
+
+@shared_task
+def dispatch_polls_task():
+    """Start one poll task per shard, spread over the available workers."""
+    try:
+        schedule_new_machines()
+    except Exception as e:
+        logger.error(f"Failed to schedule new machines: {e}", exc_info=True)
+    for shard in range(settings.POLL_SHARDS):
+        # A shard still queued at the next tick is dispatched again then.
+        poll_shard_task.apply_async(args=[shard], expires=settings.POLL_TICK)
+
+
+@shared_task
+def poll_shard_task(shard):
+    asyncio.run(poll_due_machines(shard=shard))
+
 @shared_task
 def run_checks_task(metric_id):
     try:
@@ -27,3 +65,64 @@ def run_checks_task(metric_id):
         logger.error(
             f"Error in run_checks_task for metric_id {metric_id}: {e}", exc_info=True
         )
+
+
+@shared_task
+def run_batch_checks_task(metric_ids):
+    try:
+        metrics = list(Metric.objects.filter(id__in=metric_ids).select_related("machine"))
+        opened, closed = evaluate_metrics(metrics)
+        logger.info(
+            f"Checked {len(metrics)} metrics: "
+            f"{len(opened)} incidents opened, {len(closed)} closed"
+        )
+
+    except Exception as e:
+        logger.error(
+            f"Error in run_batch_checks_task for {len(metric_ids)} metrics: {e}",
+            exc_info=True,
+        )
+
+
+@shared_task
+def rollup_metrics_task():
+    try:
+        written = rollup_metrics()
+        logger.info(
+            "Rolled up metrics: "
+            + ", ".join(f"{count} {resolution}" for resolution, count in written.items())
+        )
+
+    except Exception as e:
+        logger.error(f"Error in rollup_metrics_task: {e}", exc_info=True)
+
+
+@shared_task
+def rollup_late_metrics_task(machine_id, oldest, newest):
+    try:
+        written = rollup_late_metrics(
+            machine_id, datetime.fromisoformat(oldest), datetime.fromisoformat(newest)
+        )
+        if written:
+            logger.info(f"Rolled up {written} buckets again for machine {machine_id}")
+
+    except Exception as e:
+        logger.error(f"Error in rollup_late_metrics_task: {e}", exc_info=True)
+
+
+@shared_task
+def purge_expired_task():
+    try:
+        purge_expired(time_limit=settings.PURGE_TIME_LIMIT)
+
+    except Exception as e:
+        logger.error(f"Error in purge_expired_task: {e}", exc_info=True)
+
+
+@shared_task
+def create_partitions_task():
+    try:
+        create_future_partitions()
+
+    except Exception as e:
+        logger.error(f"Error in create_partitions_task: {e}", exc_info=True)
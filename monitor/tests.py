@@ -1,10 +1,82 @@
-from unittest.mock import AsyncMock, Mock, patch
+import asyncio
+import gzip
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock, PropertyMock, patch
 
+import httpx
 import pytest
-from asgiref.sync import sync_to_async
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.test import AsyncRequestFactory, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from monitor.models import Incident, Machine, Metric
-from monitor.poll import fetch_metrics, poll_machines
+from monitor.cache import CachedResponse, LocalResponseCache, cache_response, get_cache
+from monitor.events import EventHub, LocalEventBroker, get_broker
+from monitor.incident import (
+    check_cpu,
+    check_disk,
+    check_mem,
+    evaluate_metrics,
+    evaluate_reachability,
+    warm_incident_state,
+)
+from monitor.history import RAW_MAX_RANGE
+from monitor.ingest import MetricWriter, save_metrics
+from monitor.models import (
+    DeleteGeneration,
+    Incident,
+    Machine,
+    MachineStatus,
+    Metric,
+    MetricRollup,
+    RollupWatermark,
+)
+from monitor.partitions import (
+    create_future_partitions,
+    drop_partitions_before,
+    partition_plan,
+)
+from monitor.payload import PayloadError, orjson, parse_payload
+from monitor.poll import fetch_metrics, poll_machines, read_body, stream_samples
+from monitor.poller import Poller
+from monitor.push import issue_token
+from monitor.schedule import (
+    assign_shards,
+    claim_due_machines,
+    failure_backoff,
+    next_interval,
+    reschedule,
+    schedule_new_machines,
+)
+from monitor.shards import HashRing
+from monitor.retention import purge_expired
+from monitor.rollup import (
+    AGGREGATES,
+    bucket_start,
+    rollup_metrics,
+    rollup_range,
+)
+from monitor.state import (
+    LocalStateStore,
+    RedisStateStore,
+    StateConflict,
+    StatePending,
+    get_store,
+)
+from monitor.views import api_incidents_stream
+import monitor.window
+from monitor.window import SlidingWindow, clear_windows
 
 
 @pytest.fixture(autouse=True)
@@ -12,6 +84,14 @@ def enable_db_access_for_all_tests(db):
     pass
 
 
+@pytest.fixture(autouse=True)
+def clear_incident_state(monkeypatch, settings):
+    monkeypatch.setattr("monitor.state._store", LocalStateStore(ttl=60))
+    clear_windows()
+    settings.RESPONSE_CACHE_LOCAL = True
+    get_cache().clear()
+
+
 @pytest.fixture(autouse=True)
 def clear_db(db):
     yield
@@ -20,24 +100,41 @@ def clear_db(db):
     Incident.objects.all().delete()
 
 
+def agent_response(payload):
+    """Make a stream() side effect answering every request with payload."""
+
+    @asynccontextmanager
+    async def stream(method, url):
+        response = Mock()
+        response.headers = {}
+        response.raise_for_status = Mock(return_value=None)
+
+        async def aiter_bytes():
+            yield json.dumps(payload).encode()
+
+        response.aiter_bytes = aiter_bytes
+        yield response
+
+    return stream
+
+
 @pytest.mark.asyncio
 @patch("monitor.poll.httpx.AsyncClient")
 async def test_fetch_metrics_success(mock_client):
 
-    mock_response = AsyncMock()
-    mock_response.json = AsyncMock(
-        return_value={
-            "cpu": "45.2",
-            "mem": "67.8%",
-            "disk": "23.1%",
-            "uptime": "5 days, 3 hours",
-        }
-    )
-    mock_response.raise_for_status = Mock(return_value=None)
     mock_client_instance = AsyncMock()
     mock_client_instance.__aenter__.return_value = mock_client_instance
     mock_client_instance.__aexit__.return_value = None
-    mock_client_instance.get.return_value = mock_response
+    mock_client_instance.stream = Mock(
+        side_effect=agent_response(
+            {
+                "cpu": "45.2",
+                "mem": "67.8%",
+                "disk": "23.1%",
+                "uptime": "5 days, 3 hours",
+            }
+        )
+    )
     mock_client.return_value = mock_client_instance
 
     machine = await sync_to_async(Machine.objects.create)(
@@ -65,7 +162,7 @@ async def test_fetch_metrics_failed(mock_client):
     mock_client_instance = AsyncMock()
     mock_client_instance.__aenter__.return_value = mock_client_instance
     mock_client_instance.__aexit__.return_value = None
-    mock_client_instance.get.side_effect = Exception("Connection failed")
+    mock_client_instance.stream = Mock(side_effect=Exception("Connection failed"))
     mock_client.return_value = mock_client_instance
 
     result = await fetch_metrics(machine)
@@ -75,33 +172,30 @@ async def test_fetch_metrics_failed(mock_client):
 
 @pytest.mark.asyncio
 @patch("monitor.poll.httpx.AsyncClient")
-@patch("monitor.tasks.run_checks_task")
+@patch("monitor.tasks.run_batch_checks_task")
 async def test_incident_created_on_high_cpu(mock_run_checks_task, mock_client):
     machine = await sync_to_async(Machine.objects.create)(
         name="Test Server 3", url="http://test-server-3.com/metrics"
     )
-    mock_response = AsyncMock()
-    mock_response.json = AsyncMock(
-        return_value={
-            "cpu": "99.0",
-            "mem": "10%",
-            "disk": "10%",
-            "uptime": "1d",
-        }
-    )
-    mock_response.raise_for_status = Mock(return_value=None)
     mock_client_instance = AsyncMock()
     mock_client_instance.__aenter__.return_value = mock_client_instance
     mock_client_instance.__aexit__.return_value = mock_client_instance
-    mock_client_instance.get.return_value = mock_response
+    mock_client_instance.stream = Mock(
+        side_effect=agent_response(
+            {
+                "cpu": "99.0",
+                "mem": "10%",
+                "disk": "10%",
+                "uptime": "1d",
+            }
+        )
+    )
     mock_client.return_value = mock_client_instance
 
     await poll_machines()
 
     metric = await sync_to_async(Metric.objects.get)(machine=machine)
 
-    from monitor.incident import check_cpu
-
     await sync_to_async(check_cpu)(metric)
 
     # Check that an incident was created for high CPU
@@ -109,3 +203,1941 @@ async def test_incident_created_on_high_cpu(mock_run_checks_task, mock_client):
         machine=machine, type="CPU", end_time__isnull=True
     )
     assert await sync_to_async(incident_exists.exists)()
+
+
+@pytest.mark.asyncio
+@patch("monitor.poll.httpx.AsyncClient")
+@patch("monitor.tasks.run_batch_checks_task")
+async def test_poll_machines_shares_one_client(mock_run_checks_task, mock_client, settings):
+    settings.POLL_MAX_CONNECTIONS = 100
+    settings.POLL_POOL_SIZE = 100
+    for i in range(3):
+        await sync_to_async(Machine.objects.create)(
+            name=f"Server {i}", url=f"http://server-{i}.com/metrics"
+        )
+    mock_client_instance = AsyncMock()
+    mock_client_instance.stream = Mock(
+        side_effect=agent_response(
+            {"cpu": "10", "mem": "10%", "disk": "10%", "uptime": "1d"}
+        )
+    )
+    mock_client.return_value = mock_client_instance
+
+    machines = await sync_to_async(Machine.objects.count)()
+
+    await poll_machines()
+
+    assert mock_client.call_count == 1
+    assert mock_client_instance.stream.call_count == machines
+    mock_client_instance.aclose.assert_awaited_once()
+
+
+class SlowAgentClient:
+    """Fake poll client that answers after a per-URL delay."""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.in_flight = 0
+        self.peak = 0
+
+    @asynccontextmanager
+    async def stream(self, method, url):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(url, 0.01))
+        finally:
+            self.in_flight -= 1
+        async with agent_response(
+            {"cpu": "10", "mem": "10%", "disk": "10%", "uptime": "1d"}
+        )(method, url) as response:
+            yield response
+
+
+@pytest.mark.asyncio
+@patch("monitor.tasks.run_batch_checks_task")
+async def test_poll_machines_checks_batches_while_polling(mock_run_checks_task, settings):
+    settings.INGEST_BATCH_SIZE = 1
+    machines = [
+        await sync_to_async(Machine.objects.create)(
+            name=f"Batch {i}", url=f"http://batch-{i}.com/metrics"
+        )
+        for i in range(2)
+    ]
+    client = SlowAgentClient({machines[1].url: 0.5})
+    in_flight = []
+    mock_run_checks_task.delay.side_effect = lambda ids: in_flight.append(client.in_flight)
+
+    await poll_machines(client, machines)
+
+    # The fast machine is checked while the slow one is still being fetched.
+    assert in_flight == [1, 0]
+    dispatched = [call.args[0] for call in mock_run_checks_task.delay.call_args_list]
+    assert len(dispatched) == 2 and all(len(ids) == 1 for ids in dispatched)
+
+
+@pytest.mark.asyncio
+async def test_stream_samples_caps_concurrency():
+    machines = [
+        Machine(id=i, name=f"Server {i}", url=f"http://server-{i}.com/metrics")
+        for i in range(20)
+    ]
+    client = SlowAgentClient({})
+
+    results = [
+        result async for result in stream_samples(client, machines, concurrency=4)
+    ]
+
+    assert len(results) == 20
+    assert client.peak == 4
+    assert all(sample is not None for _, sample, _ in results)
+
+
+@pytest.mark.asyncio
+async def test_stream_samples_slow_host_hits_deadline():
+    slow = Machine(id=1, name="Slow", url="http://slow.com/metrics")
+    fast = Machine(id=2, name="Fast", url="http://fast.com/metrics")
+    client = SlowAgentClient({slow.url: 5})
+
+    results = [
+        result
+        async for result in stream_samples(
+            client, [slow, fast], concurrency=2, deadline=0.1
+        )
+    ]
+
+    assert [machine for machine, _, _ in results] == [fast, slow]
+    assert results[0][1] is not None
+    assert results[1][1] is None
+    assert results[1][2] < 1
+
+
+@pytest.mark.parametrize("value", [45, 45.0, "45", "45.0", "45%", " 45.0 % "])
+def test_parse_payload_percent_formats(value):
+    body = json.dumps({"cpu": value, "mem": value, "disk": value, "uptime": " 1d "})
+    assert parse_payload(body.encode()) == {
+        "cpu": 45.0,
+        "mem": 45.0,
+        "disk": 45.0,
+        "uptime": "1d",
+    }
+
+
+def test_parse_payload_clamps_percentages_over_100():
+    body = b'{"cpu": 100.4, "mem": "101%", "disk": 100, "uptime": "1d"}'
+    assert parse_payload(body) == {"cpu": 100.0, "mem": 100.0, "disk": 100.0, "uptime": "1d"}
+
+
+@pytest.mark.parametrize(
+    "body, error",
+    [
+        (b"not json", "invalid JSON"),
+        (b"[]", "expected an object"),
+        (b'{"cpu": 1, "mem": 1, "disk": 1}', "missing uptime"),
+        (b'{"cpu": "NaN", "mem": 1, "disk": 1, "uptime": "1d"}', "cpu: not a percentage"),
+        (b'{"cpu": 1, "mem": "-1%", "disk": 1, "uptime": "1d"}', "mem: out of range"),
+        (b'{"cpu": 1, "mem": 1, "disk": true, "uptime": "1d"}', "disk: not a percentage"),
+        (b'{"cpu": 1, "mem": 1, "disk": 1, "uptime": 5}', "uptime: not an uptime"),
+    ],
+)
+def test_parse_payload_rejects_invalid(body, error):
+    with pytest.raises(PayloadError, match=error):
+        parse_payload(body)
+
+
+@pytest.mark.asyncio
+async def test_read_body_caps_response_size():
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=b"x" * 1000)
+        )
+    )
+    async with client:
+        assert len(await read_body(client, "http://agent/metrics", 1000)) == 1000
+        with pytest.raises(PayloadError, match="over 999"):
+            await read_body(client, "http://agent/metrics", 999)
+
+
+SAMPLE = {"cpu": 10.0, "mem": 20.0, "disk": 30.0, "uptime": "1d"}
+
+
+def test_save_metrics_bulk_inserts(django_assert_max_num_queries, settings):
+    settings.INGEST_BATCH_SIZE = 500
+    machines = [
+        Machine.objects.create(name=f"Bulk {i}", url=f"http://bulk-{i}.com/metrics")
+        for i in range(50)
+    ]
+
+    # The metrics insert and the latest samples upsert.
+    with django_assert_max_num_queries(4):
+        metrics = save_metrics([(machine, SAMPLE) for machine in machines])
+
+    assert all(metric.id for metric in metrics)
+    assert Metric.objects.filter(id__in=[metric.id for metric in metrics]).count() == 50
+    assert MachineStatus.objects.filter(machine__in=machines, cpu=10.0).count() == 50
+
+
+def test_save_metrics_keeps_the_latest_sample():
+    machine = Machine.objects.create(name="Latest", url="http://latest.com/metrics")
+    now = timezone.now()
+    save_metrics([(machine, {**SAMPLE, "cpu": 1.0})])
+    # A late push of older samples leaves the latest one alone.
+    save_metrics([(machine, {**SAMPLE, "cpu": 2.0, "timestamp": now - timedelta(hours=1)})])
+    assert MachineStatus.objects.get(machine=machine).cpu == 1.0
+
+    save_metrics(
+        [
+            (machine, {**SAMPLE, "cpu": 4.0, "timestamp": now + timedelta(seconds=2)}),
+            (machine, {**SAMPLE, "cpu": 3.0, "timestamp": now + timedelta(seconds=1)}),
+        ]
+    )
+    status = MachineStatus.objects.get(machine=machine)
+    assert (status.cpu, status.sampled_at) == (4.0, now + timedelta(seconds=2))
+
+
+def test_save_metrics_reads_back_ids_without_returning():
+    first = Machine.objects.create(name="First", url="http://first.com/metrics")
+    second = Machine.objects.create(name="Second", url="http://second.com/metrics")
+    samples = [
+        (first, {**SAMPLE, "cpu": 1.0}),
+        (second, {**SAMPLE, "cpu": 2.0}),
+        (first, {**SAMPLE, "cpu": 3.0}),
+        # Pushed by its agent.
+        (second, {**SAMPLE, "cpu": 4.0, "timestamp": timezone.now() - timedelta(minutes=5)}),
+    ]
+
+    with patch.object(
+        type(connection.features),
+        "can_return_rows_from_bulk_insert",
+        new_callable=PropertyMock,
+        return_value=False,
+    ):
+        metrics = save_metrics(samples)
+
+    for metric in metrics:
+        saved = Metric.objects.get(id=metric.id)
+        assert (saved.machine_id, saved.cpu) == (metric.machine_id, metric.cpu)
+
+
+@pytest.mark.asyncio
+async def test_metric_writer_flushes_on_size_and_exit():
+    machine = await sync_to_async(Machine.objects.create)(
+        name="Writer", url="http://writer.com/metrics"
+    )
+    batches = []
+
+    async with MetricWriter(batch_size=2, flush_interval=60, on_flush=batches.append) as writer:
+        for _ in range(5):
+            await writer.add(machine, SAMPLE)
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert writer.saved == 5
+
+
+@pytest.mark.asyncio
+async def test_metric_writer_flushes_on_time():
+    machine = await sync_to_async(Machine.objects.create)(
+        name="Timer", url="http://timer.com/metrics"
+    )
+    batches = []
+
+    async with MetricWriter(
+        batch_size=100, flush_interval=0.05, on_flush=batches.append
+    ) as writer:
+        await writer.add(machine, SAMPLE)
+        await asyncio.sleep(0.2)
+        assert [len(batch) for batch in batches] == [1]
+
+
+def incident_snapshot(preexisting_ids):
+    """Incidents as comparable tuples, ignoring the ids of new rows."""
+    return sorted(
+        (
+            incident.machine_id,
+            incident.type,
+            incident.value,
+            incident.end_time is None,
+            incident.id if incident.id in preexisting_ids else None,
+        )
+        for incident in Incident.objects.all()
+    )
+
+
+def test_evaluate_metrics_matches_per_metric_checks():
+    rng = random.Random(42)
+    now = timezone.now()
+    machines = [
+        Machine.objects.create(name=f"Eval {i}", url=f"http://eval-{i}.com/metrics")
+        for i in range(30)
+    ]
+    for machine in machines:
+        for type_ in ("CPU", "MEM", "DISK"):
+            roll = rng.random()
+            if roll < 0.25:
+                Incident.objects.create(machine=machine, type=type_, value=99)
+            elif roll < 0.5:
+                Incident.objects.create(
+                    machine=machine,
+                    type=type_,
+                    value=99,
+                    start_time=now - timedelta(minutes=rng.choice([10, 60, 200])),
+                    end_time=now - timedelta(minutes=5),
+                )
+    preexisting_ids = set(Incident.objects.values_list("id", flat=True))
+
+    for round_ in range(10):
+        for machine in machines:
+            Metric.objects.create(
+                machine=machine,
+                cpu=rng.choice([50, 90]),
+                mem=rng.choice([50, 95, 95, 95]),
+                disk=rng.choice([50, 97, 97, 97, 97]),
+                uptime="1d",
+                timestamp=now - timedelta(minutes=15 * (9 - round_)),
+            )
+    metrics = list(Metric.objects.select_related("machine").order_by("id"))
+
+    with transaction.atomic():
+        for metric in metrics:
+            check_cpu(metric)
+            check_mem(metric)
+            check_disk(metric)
+        expected = incident_snapshot(preexisting_ids)
+        transaction.set_rollback(True)
+    assert {"MEM", "DISK"} <= {type_ for _, type_, _, _, id_ in expected if id_ is None}
+
+    clear_windows()
+    evaluate_metrics(metrics)
+
+    assert incident_snapshot(preexisting_ids) == expected
+
+
+def test_evaluate_metrics_query_count_is_constant(django_assert_max_num_queries):
+    machines = [
+        Machine.objects.create(name=f"Count {i}", url=f"http://count-{i}.com/metrics")
+        for i in range(50)
+    ]
+    for machine in machines[:25]:
+        Incident.objects.create(machine=machine, type="CPU", value=99)
+    metrics = [
+        Metric.objects.create(
+            machine=machine, cpu=50 if i < 25 else 95, mem=10, disk=10, uptime="1d"
+        )
+        for i, machine in enumerate(machines)
+    ]
+
+    with django_assert_max_num_queries(5):
+        opened, closed = evaluate_metrics(metrics)
+
+    assert len(opened) == 25
+    assert len(closed) == 25
+
+
+def test_evaluate_metrics_healthy_cached_machines_cost_no_queries(
+    django_assert_num_queries,
+):
+    machines = [
+        Machine.objects.create(name=f"Calm {i}", url=f"http://calm-{i}.com/metrics")
+        for i in range(10)
+    ]
+    metrics = [
+        Metric.objects.create(machine=machine, cpu=10, mem=10, disk=10, uptime="1d")
+        for machine in machines
+    ]
+    warm_incident_state()
+
+    with django_assert_num_queries(0):
+        assert evaluate_metrics(metrics) == ([], [])
+
+
+def test_evaluate_metrics_uses_cached_open_incident():
+    machine = Machine.objects.create(name="Cached", url="http://cached.com/metrics")
+    high = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+    low = Metric.objects.create(machine=machine, cpu=10, mem=10, disk=10, uptime="1d")
+
+    [incident], _ = evaluate_metrics([high])
+    assert evaluate_metrics([high]) == ([], [])
+    assert evaluate_metrics([low]) == ([], [incident.id])
+
+    incident.refresh_from_db()
+    assert incident.end_time is not None
+
+
+def test_incident_written_outside_engine_invalidates_state():
+    machine = Machine.objects.create(name="Outside", url="http://outside.com/metrics")
+    metric = Metric.objects.create(machine=machine, cpu=10, mem=10, disk=10, uptime="1d")
+    warm_incident_state()
+
+    incident = Incident.objects.create(machine=machine, type="CPU", value=99)
+
+    assert (machine.id, "CPU") not in get_store().get_many([(machine.id, "CPU")])
+    assert evaluate_metrics([metric]) == ([], [incident.id])
+
+
+@pytest.fixture(params=["local", "redis"])
+def state_store(request):
+    if request.param == "local":
+        yield LocalStateStore(ttl=60)
+        return
+    # The Lua scripts need a Redis server, pointed to by TEST_REDIS_URL.
+    if not os.environ.get("TEST_REDIS_URL"):
+        pytest.skip("TEST_REDIS_URL is not set")
+    store = RedisStateStore(os.environ["TEST_REDIS_URL"], ttl=60)
+    store.clear()
+    yield store
+    store.clear()
+
+
+def test_state_store_compare_and_set(state_store):
+    store = state_store
+    key = (1, "CPU")
+    [(version, _)] = store.populate({key: ((), None)}).values()
+
+    store.compare_and_set({key: (version, ((5,), None))})
+
+    with pytest.raises(StateConflict) as conflict:
+        store.compare_and_set({key: (version, ((6,), None)), (2, "CPU"): (None, ((), None))})
+    assert conflict.value.keys == [key]
+    assert store.get_many([key, (2, "CPU")])[key][1] == ((5,), None)
+    assert (2, "CPU") not in store.get_many([(2, "CPU")])
+
+
+def test_state_store_populate_keeps_stored_entries(state_store):
+    store = state_store
+    key = (1, "CPU")
+    [(version, _)] = store.populate({key: ((5,), None)}).values()
+
+    assert store.populate({key: ((), None), (2, "CPU"): ((6,), None)}) == {
+        key: (version, ((5,), None)),
+        (2, "CPU"): (store.get_many([(2, "CPU")])[(2, "CPU")][0], ((6,), None)),
+    }
+
+
+def test_state_store_claim(state_store):
+    store = state_store
+    key = (1, "CPU")
+    [(version, _)] = store.populate({key: ((), None)}).values()
+
+    claimed = store.claim({key: version})
+    # Pending until the claim is committed, and never populated meanwhile.
+    assert store.get_many([key]) == {}
+    with pytest.raises(StatePending) as pending:
+        store.populate({key: ((), None), (2, "CPU"): ((), None)})
+    assert pending.value.keys == [key]
+    assert (2, "CPU") in store.get_many([(2, "CPU")])
+    with pytest.raises(StateConflict):
+        store.claim({key: version})
+
+    store.compare_and_set({key: (claimed[key], ((5,), None))})
+    assert store.get_many([key])[key][1] == ((5,), None)
+
+
+def test_evaluate_metrics_waits_for_pending_state(monkeypatch):
+    machine = Machine.objects.create(name="Pending", url="http://pending.com/metrics")
+    metric = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+    key = (machine.id, "CPU")
+    store = get_store()
+    [(version, _)] = store.populate({key: ((), None)}).values()
+    # Another worker opens an incident, its transaction is not committed yet.
+    claimed = store.claim({key: version})
+    [other] = Incident.objects.bulk_create([Incident(machine=machine, type="CPU", value=95)])
+    waits = []
+
+    def other_worker_commits(seconds):
+        waits.append(seconds)
+        store.compare_and_set({key: (claimed[key], ((other.id,), other.start_time))})
+
+    monkeypatch.setattr("monitor.incident.time.sleep", other_worker_commits)
+
+    # Evaluated once the state is written, so the open incident is not opened again.
+    assert evaluate_metrics([metric]) == ([], [])
+    assert len(waits) == 1
+    assert Incident.objects.filter(machine=machine, type="CPU").count() == 1
+
+
+def test_incident_state_stored_only_once_committed(django_capture_on_commit_callbacks):
+    machine = Machine.objects.create(name="Committed", url="http://committed.com/metrics")
+    metric = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+    key = (machine.id, "CPU")
+
+    with transaction.atomic():
+        evaluate_metrics([metric])
+        transaction.set_rollback(True)
+    assert key not in get_store().get_many([key])
+
+    with django_capture_on_commit_callbacks(execute=True):
+        [incident], _ = evaluate_metrics([metric])
+    assert get_store().get_many([key])[key][1][0] == (incident.id,)
+
+
+def test_incident_state_read_from_database_without_shared_store(monkeypatch, settings):
+    settings.INCIDENT_STATE_URL = None
+    settings.INCIDENT_STATE_LOCAL = False
+    monkeypatch.setattr("monitor.state._store", None)
+    machine = Machine.objects.create(name="Uncached", url="http://uncached.com/metrics")
+    metric = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+
+    [incident], _ = evaluate_metrics([metric])
+    # Written by another worker process, which sends no signal here.
+    Incident.objects.filter(id=incident.id).update(end_time=timezone.now())
+
+    assert get_store().get_many([(machine.id, "CPU")]) == {}
+    [reopened], _ = evaluate_metrics([metric])
+    assert reopened.id != incident.id
+
+
+def test_evaluate_metrics_retries_from_database_on_conflict():
+    machine = Machine.objects.create(name="Racy", url="http://racy.com/metrics")
+    metric = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+    warm_incident_state()
+    store = get_store()
+    real_get_many = store.get_many
+
+    def other_worker_opens_after_read(keys):
+        # Another worker opens the incident between our read and our write.
+        store.get_many = real_get_many
+        state = real_get_many(keys)
+        key = (machine.id, "CPU")
+        [other] = Incident.objects.bulk_create(
+            [Incident(machine=machine, type="CPU", value=95)]
+        )
+        store.compare_and_set({key: (state[key][0], ((other.id,), other.start_time))})
+        return state
+
+    store.get_many = other_worker_opens_after_read
+    try:
+        assert evaluate_metrics([metric]) == ([], [])
+    finally:
+        store.get_many = real_get_many
+
+    assert Incident.objects.filter(machine=machine, type="CPU").count() == 1
+
+
+def test_sliding_window_requires_whole_duration():
+    start = timezone.now()
+    window = SlidingWindow(timedelta(minutes=30), threshold=90)
+
+    for minutes, value in [(0, 95), (15, 95)]:
+        window.push(minutes + 1, start + timedelta(minutes=minutes), value)
+    assert not window.sustained(start + timedelta(minutes=15))
+
+    window.push(31, start + timedelta(minutes=30), 95)
+    assert window.sustained(start + timedelta(minutes=30))
+
+    window.push(46, start + timedelta(minutes=45), 50)
+    window.push(61, start + timedelta(minutes=60), 95)
+    assert not window.sustained(start + timedelta(minutes=60))
+
+    # The sample at minute 45 still stands for the window start.
+    window.push(76, start + timedelta(minutes=75), 95)
+    assert not window.sustained(start + timedelta(minutes=75))
+    window.push(91, start + timedelta(minutes=90), 95)
+    assert window.sustained(start + timedelta(minutes=90))
+    assert len(window.samples) == 3
+
+
+def test_sliding_window_breach_ratio(settings):
+    settings.INCIDENT_WINDOW_BREACH_RATIO = 0.6
+    start = timezone.now()
+    window = SlidingWindow(timedelta(minutes=30), threshold=90)
+
+    for minutes, value in [(0, 95), (10, 50), (20, 95), (30, 95)]:
+        window.push(minutes + 1, start + timedelta(minutes=minutes), value)
+
+    assert window.sustained(start + timedelta(minutes=30))
+    settings.INCIDENT_WINDOW_BREACH_RATIO = 0.8
+    assert not window.sustained(start + timedelta(minutes=30))
+
+
+def test_evaluate_metrics_opens_mem_incident_only_when_sustained():
+    machine = Machine.objects.create(name="Sustained", url="http://sustained.com/metrics")
+    now = timezone.now()
+
+    def metric_at(minutes_ago, mem):
+        return Metric.objects.select_related("machine").get(
+            id=Metric.objects.create(
+                machine=machine,
+                cpu=10,
+                mem=mem,
+                disk=10,
+                uptime="1d",
+                timestamp=now - timedelta(minutes=minutes_ago),
+            ).id
+        )
+
+    assert evaluate_metrics([metric_at(30, 95)]) == ([], [])
+    assert evaluate_metrics([metric_at(15, 95)]) == ([], [])
+    [incident], _ = evaluate_metrics([metric_at(0, 95)])
+    assert incident.type == "MEM"
+
+
+def test_evaluate_metrics_loads_window_history_once(django_assert_num_queries):
+    machine = Machine.objects.create(name="Fresh", url="http://fresh.com/metrics")
+    now = timezone.now()
+    for minutes_ago in (45, 30, 15):
+        Metric.objects.create(
+            machine=machine,
+            cpu=10,
+            mem=95,
+            disk=10,
+            uptime="1d",
+            timestamp=now - timedelta(minutes=minutes_ago),
+        )
+    metric = Metric.objects.create(machine=machine, cpu=10, mem=95, disk=10, uptime="1d")
+    metric = Metric.objects.select_related("machine").get(id=metric.id)
+
+    # Window history, incident state, savepoint, insert, release.
+    with django_assert_num_queries(5):
+        [incident], _ = evaluate_metrics([metric])
+    assert incident.type == "MEM"
+
+
+def test_sliding_window_orders_samples_by_timestamp():
+    start = timezone.now()
+    window = SlidingWindow(timedelta(minutes=30), threshold=90)
+
+    window.push(1, start, 95)
+    window.push(2, start + timedelta(minutes=30), 95)
+    # Pushed by an agent after the poll at minute 30, taken before it.
+    window.push(3, start + timedelta(minutes=15), 50)
+    window.push(3, start + timedelta(minutes=15), 50)
+
+    assert [metric_id for _, metric_id, _ in window.samples] == [1, 3, 2]
+    assert not window.sustained(start + timedelta(minutes=30))
+
+
+def test_evaluate_metrics_reloads_windows_evaluated_by_another_process(monkeypatch):
+    machine = Machine.objects.create(name="Shared", url="http://shared.com/metrics")
+    now = timezone.now()
+
+    def metric_at(minutes_ago, mem):
+        return Metric.objects.select_related("machine").get(
+            id=Metric.objects.create(
+                machine=machine,
+                cpu=10,
+                mem=mem,
+                disk=10,
+                uptime="1d",
+                timestamp=now - timedelta(minutes=minutes_ago),
+            ).id
+        )
+
+    # Process A sees MEM over the threshold...
+    for minutes_ago in (45, 35):
+        assert evaluate_metrics([metric_at(minutes_ago, 95)]) == ([], [])
+
+    # ...then process B, with windows of its own, sees it recover...
+    a_windows, a_evaluations = dict(monitor.window._windows), dict(monitor.window._evaluations)
+    clear_windows()
+    for minutes_ago in (20, 10):
+        assert evaluate_metrics([metric_at(minutes_ago, 50)]) == ([], [])
+
+    # ...so A must not open an incident from its stale window.
+    monkeypatch.setattr(monitor.window, "_windows", a_windows)
+    monkeypatch.setattr(monitor.window, "_evaluations", a_evaluations)
+    assert evaluate_metrics([metric_at(0, 95)]) == ([], [])
+    assert not Incident.objects.filter(machine=machine).exists()
+
+
+@pytest.fixture
+def indexed_rows():
+    machines = [
+        Machine.objects.create(name=f"Plan {i}", url=f"http://plan-{i}.com/metrics")
+        for i in range(20)
+    ]
+    for machine in machines:
+        Metric.objects.bulk_create(
+            Metric(machine=machine, cpu=10, mem=10, disk=10, uptime="1d") for _ in range(20)
+        )
+        Incident.objects.bulk_create(
+            Incident(machine=machine, type=type_, value=99, end_time=timezone.now())
+            for type_ in ("CPU", "MEM", "DISK")
+        )
+    return machines
+
+
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (
+            lambda machine: Incident.objects.filter(
+                machine=machine, type="CPU", end_time__isnull=True
+            ),
+            "incident_mach_type_end_idx",
+        ),
+        (
+            lambda machine: Incident.objects.filter(
+                machine=machine, type="MEM", start_time__gte=timezone.now()
+            ),
+            "incident_mach_type_start_idx",
+        ),
+        (
+            lambda machine: Incident.objects.order_by("-start_time")[:50],
+            "incident_start_time_idx",
+        ),
+        (
+            lambda machine: Metric.objects.filter(
+                machine=machine, timestamp__gte=timezone.now()
+            ),
+            "metric_mach_timestamp_idx",
+        ),
+    ],
+)
+def test_hot_queries_use_indexes(indexed_rows, query, index):
+    assert index in query(indexed_rows[0]).explain()
+
+
+def test_api_incidents_keyset_pagination(client):
+    machine = Machine.objects.create(name="Paged", url="http://paged.com/metrics")
+    start = timezone.now()
+    for i in range(7):
+        # Pairs of incidents share a start time to exercise the id tie-break.
+        Incident.objects.create(
+            machine=machine,
+            type="CPU",
+            value=90 + i,
+            start_time=start - timedelta(minutes=i // 2),
+        )
+
+    ids, cursor = [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = streamed_json(client.get("/api/incidents/", params))
+        assert len(page["results"]) <= 3
+        ids += [incident["id"] for incident in page["results"]]
+        cursor = page["next"]
+        if cursor is None:
+            break
+
+    expected = Incident.objects.order_by("-start_time", "-id").values_list("id", flat=True)
+    assert ids == list(expected)
+
+
+def test_api_incidents_filters(client):
+    first = Machine.objects.create(name="Filter 1", url="http://filter-1.com/metrics")
+    second = Machine.objects.create(name="Filter 2", url="http://filter-2.com/metrics")
+    now = timezone.now()
+    active = Incident.objects.create(machine=first, type="CPU", value=90)
+    resolved = Incident.objects.create(
+        machine=first, type="MEM", value=95, start_time=now - timedelta(days=2), end_time=now
+    )
+    other = Incident.objects.create(machine=second, type="CPU", value=99)
+
+    def ids(**params):
+        response = client.get("/api/incidents/", params)
+        assert response.status_code == 200
+        found = {incident["id"] for incident in streamed_json(response)["results"]}
+        return found & {active.id, resolved.id, other.id}
+
+    assert ids(machine=first.id) == {active.id, resolved.id}
+    assert ids(machine="Filter 2") == {other.id}
+    assert ids(type="CPU") == {active.id, other.id}
+    assert ids(status="active") == {active.id, other.id}
+    assert ids(status="resolved") == {resolved.id}
+    assert ids(since=(now - timedelta(days=1)).isoformat()) == {active.id, other.id}
+    assert ids(until=(now - timedelta(days=1)).isoformat()) == {resolved.id}
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"limit": 0},
+        {"limit": "many"},
+        {"type": "GPU"},
+        {"status": "open"},
+        {"since": "yesterday"},
+        {"cursor": "nope"},
+    ],
+)
+def test_api_incidents_rejects_bad_parameters(client, params):
+    assert client.get("/api/incidents/", params).status_code == 400
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_api_incidents_streams_chunks_like_to_dict(client, encoder):
+    machine = Machine.objects.create(name="Chunked", url="http://chunked.com/metrics")
+    start = timezone.now()
+    for i in range(5):
+        Incident.objects.create(
+            machine=machine,
+            type="MEM",
+            value=90.5 + i,
+            start_time=start - timedelta(minutes=i),
+            end_time=start if i % 2 else None,
+        )
+    expected = [
+        incident.to_dict()
+        for incident in Incident.objects.filter(machine=machine).order_by("-start_time")
+    ]
+
+    with (
+        patch("monitor.views.INCIDENTS_CHUNK_SIZE", 2),
+        patch("monitor.payload.orjson", None if encoder == "json" else orjson),
+    ):
+        params = {"machine": machine.id, "limit": 4}
+        response = client.get("/api/incidents/", params)
+        chunks = streamed_chunks(response)
+        page = json.loads(b"".join(chunks))
+        rest = streamed_json(client.get("/api/incidents/", {**params, "cursor": page["next"]}))
+    # The opening, two chunks of two incidents and the closing.
+    assert len(chunks) == 4
+    assert page["results"] == expected[:4]
+    assert rest == {"results": expected[4:], "next": None}
+
+
+def test_api_incidents_conditional_get(client, django_assert_num_queries, settings):
+    # Without the response cache, which answers these requests itself.
+    settings.RESPONSE_CACHE_TTL = 0
+    machine = Machine.objects.create(name="Etag", url="http://etag.com/metrics")
+    incident = Incident.objects.create(machine=machine, type="CPU", value=90)
+
+    response = client.get("/api/incidents/")
+    etag = response["ETag"]
+    assert response.status_code == 200
+    assert response["Last-Modified"]
+
+    with django_assert_num_queries(1):
+        response = client.get("/api/incidents/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    assert client.get("/api/incidents/", {"limit": 5})["ETag"] != etag
+
+    incident.end_time = timezone.now()
+    incident.save()
+    response = client.get("/api/incidents/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response["ETag"]
+
+    # Older than the next incident, so deleting it, as purges do, changes
+    # neither the latest id nor the latest times.
+    now = timezone.now()
+    purged = Incident.objects.create(
+        machine=machine,
+        type="DISK",
+        value=99,
+        start_time=now - timedelta(days=400),
+        end_time=now - timedelta(days=399),
+    )
+    Incident.objects.create(machine=machine, type="MEM", value=95)
+    response = client.get("/api/incidents/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response["ETag"]
+
+    purged.delete()
+    response = client.get("/api/incidents/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    response = client.get(
+        "/api/incidents/", headers={"If-Modified-Since": response["Last-Modified"]}
+    )
+    assert response.status_code == 304
+
+
+def test_api_ingest_saves_pushed_samples(client, settings):
+    machine = Machine.objects.create(name="Pusher", url="http://pusher.com/metrics")
+    for _ in range(settings.POLL_BREAKER_THRESHOLD):
+        reschedule([(machine, None)])
+    headers = {"Authorization": f"Bearer {issue_token(machine)}"}
+    now = timezone.now()
+    samples = [
+        {"cpu": 99, "mem": "10%", "disk": "10.0", "uptime": "1d", "timestamp": ts}
+        for ts in [now.timestamp() - 60, (now - timedelta(seconds=30)).isoformat()]
+    ]
+
+    response = client.post(
+        "/api/ingest/", samples, content_type="application/json", headers=headers
+    )
+    assert response.status_code == 202
+    assert response.json() == {"received": 2, "saved": 2}
+    metrics = Metric.objects.filter(machine=machine).order_by("timestamp")
+    assert [metric.timestamp.timestamp() for metric in metrics] == pytest.approx(
+        [now.timestamp() - 60, now.timestamp() - 30]
+    )
+    # Checked like polled metrics.
+    assert Incident.objects.filter(machine=machine, type="CPU").exists()
+    machine.refresh_from_db()
+    assert machine.next_poll_at > now
+    # Pushing agents are reachable again.
+    assert machine.consecutive_failures == 0
+    assert not Incident.objects.filter(
+        machine=machine, type="UNREACHABLE", end_time__isnull=True
+    ).exists()
+
+    # A retried push is not saved twice, gzip'd NDJSON works too.
+    body = gzip.compress(b"\n".join(json.dumps(sample).encode() for sample in samples))
+    response = client.post(
+        "/api/ingest/",
+        body,
+        content_type="application/x-ndjson",
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
+    assert response.json() == {"received": 2, "saved": 0}
+
+
+def test_api_ingest_rolls_up_late_samples_again(client):
+    RollupWatermark.objects.all().delete()
+    machine = Machine.objects.create(name="Late", url="http://late.com/metrics")
+    headers = {"Authorization": f"Bearer {issue_token(machine)}"}
+    now = timezone.now()
+    late = now - timedelta(hours=3)
+    for resolution in ("1m", "1h"):
+        RollupWatermark.objects.create(
+            resolution=resolution, position=bucket_start(now, resolution)
+        )
+    # Not rolled up yet, left to rollup_metrics.
+    RollupWatermark.objects.create(resolution="1d", position=bucket_start(late, "1d"))
+
+    sample = {"cpu": 50, "mem": "10%", "disk": "10.0", "uptime": "1d"}
+    response = client.post(
+        "/api/ingest/",
+        [{**sample, "timestamp": late.isoformat()}, sample],
+        content_type="application/json",
+        headers=headers,
+    )
+    assert response.json() == {"received": 2, "saved": 2}
+    rollups = MetricRollup.objects.filter(machine=machine)
+    assert sorted(rollups.values_list("resolution", "bucket", "samples")) == [
+        ("1h", bucket_start(late, "1h"), 1),
+        ("1m", bucket_start(late, "1m"), 1),
+    ]
+
+
+def test_api_ingest_rejects_bad_pushes(client, settings):
+    machine = Machine.objects.create(name="Pusher", url="http://pusher.com/metrics")
+    headers = {"Authorization": f"Bearer {issue_token(machine)}"}
+    sample = {"cpu": 10, "mem": 10, "disk": 10, "uptime": "1d"}
+
+    def push(body, **extra):
+        return client.post(
+            "/api/ingest/",
+            body,
+            content_type="application/json",
+            headers={**headers, **extra},
+        )
+
+    assert push(sample, Authorization="Bearer wrong").status_code == 401
+    response = push([sample, {**sample, "cpu": "high"}])
+    assert response.status_code == 400
+    assert response.json()["error"].startswith("sample 1: cpu:")
+    assert push({**sample, "timestamp": 0}).status_code == 400
+    settings.INGEST_MAX_BODY_BYTES = 1000
+    bomb = gzip.compress(b" " * 100000)
+    assert push(bomb, **{"Content-Encoding": "gzip"}).status_code == 413
+    assert not Metric.objects.filter(machine=machine).exists()
+
+
+def test_local_event_broker_backlog():
+    broker = LocalEventBroker(backlog=2)
+    assert broker.backlog("0") == []
+
+    broker.publish([{"action": "opened", "n": 1}, {"action": "opened", "n": 2}])
+    assert broker.latest_id() == "2"
+    assert broker.backlog("1") == [("2", {"action": "opened", "n": 2})]
+
+    broker.publish([{"action": "opened", "n": 3}])
+    # Event 2 is gone, so a client that last saw event 0 missed it.
+    assert broker.backlog("0") is None
+    assert broker.backlog("1") == [
+        ("2", {"action": "opened", "n": 2}),
+        ("3", {"action": "opened", "n": 3}),
+    ]
+    # An id from before a restart.
+    assert broker.backlog("10") is None
+    assert broker.read("1", timeout=0) == broker.backlog("1")
+
+
+def test_evaluate_metrics_publishes_events_on_commit(django_capture_on_commit_callbacks):
+    machine = Machine.objects.create(name="Events", url="http://events.com/metrics")
+    high = Metric.objects.create(machine=machine, cpu=99, mem=10, disk=10, uptime="1d")
+    low = Metric.objects.create(machine=machine, cpu=10, mem=10, disk=10, uptime="1d")
+    broker = get_broker()
+
+    after = broker.latest_id()
+    with django_capture_on_commit_callbacks(execute=True):
+        [incident], _ = evaluate_metrics([high])
+    assert broker.backlog(after) == [
+        (broker.latest_id(), {"action": "opened", "incident": incident.to_dict()})
+    ]
+
+    after = broker.latest_id()
+    with django_capture_on_commit_callbacks(execute=True):
+        evaluate_metrics([low])
+    [(_, event)] = broker.backlog(after)
+    assert event["action"] == "resolved"
+    assert event["incident"]["id"] == incident.id
+    assert event["incident"]["machine"] == "Events"
+
+
+@pytest.mark.asyncio
+async def test_event_hub_streams_and_resumes():
+    broker = LocalEventBroker(backlog=2)
+    hub = EventHub(broker)
+
+    stream = hub.stream()
+    # Subscribed once ready, so an event published right after is streamed.
+    assert await anext(stream) == ("0", {"action": "ready"})
+    first = asyncio.ensure_future(anext(stream))
+    broker.publish([{"action": "opened", "n": 1}])
+    assert await asyncio.wait_for(first, 5) == ("1", {"action": "opened", "n": 1})
+    await stream.aclose()
+
+    broker.publish([{"action": "opened", "n": 2}])
+    resumed = hub.stream(last_event_id="1")
+    assert await anext(resumed) == ("2", {"action": "opened", "n": 2})
+    await resumed.aclose()
+
+    broker.publish([{"action": "opened", "n": 3}, {"action": "opened", "n": 4}])
+    stale = hub.stream(last_event_id="1")
+    assert await anext(stale) == ("4", {"action": "reset"})
+    await stale.aclose()
+    assert not hub.subscribers
+
+
+@pytest.mark.asyncio
+async def test_api_incidents_stream_costs_no_queries():
+    broker = get_broker()
+    broker.publish([{"action": "opened", "incident": {"id": 1}}])
+    request = AsyncRequestFactory().get(
+        "/api/incidents/stream/", headers={"Last-Event-ID": str(int(broker.latest_id()) - 1)}
+    )
+
+    # Patched on the class, so queries from any thread are seen.
+    with patch("django.db.backends.utils.CursorWrapper.execute") as execute:
+        response = await api_incidents_stream(request)
+        messages = aiter(response.streaming_content)
+        assert await anext(messages) == b"retry: 3000\n\n"
+        message = await anext(messages)
+        await messages.aclose()
+
+    assert response["Content-Type"] == "text/event-stream"
+    assert message == (
+        f"id: {broker.latest_id()}\nevent: opened\ndata: {{\"id\": 1}}\n\n".encode()
+    )
+    execute.assert_not_called()
+
+
+def test_rollup_metrics_aggregates_and_resumes():
+    machine = Machine.objects.create(name="Rollup", url="http://rollup.com/metrics")
+    day = bucket_start(timezone.now(), "1d") - timedelta(days=2)
+    for resolution in ("1m", "1h", "1d"):
+        RollupWatermark.objects.create(resolution=resolution, position=day)
+
+    def add(offset, cpu):
+        Metric.objects.create(
+            machine=machine, cpu=cpu, mem=50, disk=70, uptime="1d", timestamp=day + offset
+        )
+
+    add(timedelta(hours=10, seconds=10), 10)
+    add(timedelta(hours=10, seconds=40), 30)
+    add(timedelta(hours=10, minutes=1), 20)
+    add(timedelta(hours=11, minutes=30), 40)
+
+    rollup_metrics(now=day + timedelta(days=1, minutes=10))
+    rollups = MetricRollup.objects.filter(machine=machine)
+
+    minute = rollups.get(resolution="1m", bucket=day + timedelta(hours=10))
+    assert (minute.samples, minute.cpu_min, minute.cpu_max) == (2, 10, 30)
+    assert (minute.cpu_avg, minute.cpu_p95, minute.mem_avg) == (20, 30, 50)
+    hour = rollups.get(resolution="1h", bucket=day + timedelta(hours=10))
+    assert (hour.samples, hour.cpu_avg) == (3, 20)
+    whole_day = rollups.get(resolution="1d", bucket=day)
+    assert (whole_day.samples, whole_day.cpu_max, whole_day.disk_p95) == (4, 40, 70)
+
+    # Rolling a range up again rewrites the same rows.
+    snapshot = list(rollups.order_by("id").values())
+    rollup_range("1h", day, day + timedelta(days=1))
+    assert list(rollups.order_by("id").values()) == snapshot
+
+    # The next run starts from the watermark.
+    add(timedelta(days=1, minutes=15), 90)
+    rollup_metrics(now=day + timedelta(days=1, minutes=20))
+    assert rollups.get(resolution="1m", bucket=day + timedelta(days=1, minutes=15)).cpu_max == 90
+    assert not rollups.filter(resolution="1d", bucket=day + timedelta(days=1)).exists()
+    assert RollupWatermark.objects.get(resolution="1d").position == day + timedelta(days=1)
+
+
+def test_api_machines_lists_the_fleet_state(client, django_assert_num_queries):
+    up = Machine.objects.create(name="Up", url="http://up.com/metrics")
+    down = Machine.objects.create(name="Down", url="http://down.com/metrics")
+    new = Machine.objects.create(name="New", url="http://new.com/metrics")
+    save_metrics([(up, {**SAMPLE, "cpu": 99.0})])
+    reschedule([(up, {**SAMPLE, "cpu": 99.0}), (down, None)])
+    Incident.objects.create(machine=up, type="CPU", value=99)
+    Incident.objects.create(machine=up, type="DISK", value=99, end_time=timezone.now())
+
+    with django_assert_num_queries(2):
+        response = client.get("/api/machines/")
+    assert response.status_code == 200
+    machines = {machine["name"]: machine for machine in response.json()["results"]}
+
+    assert machines["Up"]["cpu"] == 99.0 and machines["Up"]["uptime"] == "1d"
+    assert machines["Up"]["poll_ok"] is True
+    assert machines["Up"]["open_incidents"] == {
+        "CPU": 1,
+        "MEM": 0,
+        "DISK": 0,
+        "UNREACHABLE": 0,
+    }
+    assert machines["Down"]["cpu"] is None and machines["Down"]["sampled_at"] is None
+    assert machines["Down"]["poll_ok"] is False
+    assert machines["Down"]["consecutive_failures"] == 1
+    assert machines["New"]["polled_at"] is None and machines["New"]["poll_ok"] is None
+    assert machines["New"]["id"] == new.id and machines["Down"]["id"] == down.id
+
+
+def test_api_incidents_cached_until_incidents_change(client, django_assert_num_queries, settings):
+    machine = Machine.objects.create(name="Cached", url="http://cached.com/metrics")
+    Incident.objects.create(machine=machine, type="CPU", value=90)
+
+    response = client.get("/api/incidents/")
+    assert response["X-Cache"] == "miss"
+    # Streamed, and cached once sent whole.
+    body = b"".join(streamed_chunks(response))
+    with django_assert_num_queries(0):
+        cached = client.get("/api/incidents/")
+        not_modified = client.get("/api/incidents/", headers={"If-None-Match": cached["ETag"]})
+    assert cached["X-Cache"] == "hit" and cached.content == body
+    assert cached["ETag"] == response["ETag"]
+    assert not_modified.status_code == 304
+    assert client.get("/api/incidents/", {"limit": 5})["X-Cache"] == "miss"
+
+    Incident.objects.create(machine=machine, type="MEM", value=95)
+    response = client.get("/api/incidents/")
+    assert response["X-Cache"] == "miss"
+    assert {incident["type"] for incident in streamed_json(response)["results"]} >= {
+        "CPU",
+        "MEM",
+    }
+
+    # The engine writes with bulk queries, which send no signals.
+    evaluate_reachability([(machine, settings.POLL_BREAKER_THRESHOLD)])
+    response = client.get("/api/incidents/", {"type": "UNREACHABLE"})
+    assert [incident["machine"] for incident in streamed_json(response)["results"]] == [
+        "Cached"
+    ]
+    assert client.get("/api/incidents/")["X-Cache"] == "miss"
+
+    stats = client.get("/api/cache/").json()
+    assert stats["views"]["api_incidents"]["hit"] == 2
+    assert stats["invalidations"]["incidents"] >= 2
+
+
+def test_api_machines_shows_samples_once_cached_entry_expires(client, monkeypatch, settings):
+    machine = Machine.objects.create(name="Sampled", url="http://sampled.com/metrics")
+    assert client.get("/api/machines/")["X-Cache"] == "miss"
+    assert client.get("/api/machines/")["X-Cache"] == "hit"
+
+    # Samples are saved on every poll and do not invalidate the entry...
+    save_metrics([(machine, {**SAMPLE, "cpu": 42.0})])
+    assert client.get("/api/machines/")["X-Cache"] == "hit"
+
+    # ...which expires after RESPONSE_CACHE_STATUS_TTL.
+    later = time.monotonic() + settings.RESPONSE_CACHE_STATUS_TTL + 1
+    monkeypatch.setattr("monitor.cache.time", SimpleNamespace(monotonic=lambda: later))
+    response = client.get("/api/machines/")
+    assert response["X-Cache"] == "miss"
+    assert {m["name"]: m["cpu"] for m in response.json()["results"]}["Sampled"] == 42.0
+
+    Machine.objects.create(name="Added", url="http://added.com/metrics")
+    assert client.get("/api/machines/")["X-Cache"] == "miss"
+
+
+def test_responses_not_cached_in_memory_unless_local(client, settings):
+    settings.RESPONSE_CACHE_LOCAL = False
+    Machine.objects.create(name="Uncached", url="http://uncached.com/metrics")
+
+    for _ in range(2):
+        assert not client.get("/api/machines/").has_header("X-Cache")
+
+
+def test_response_cache_unlock_needs_the_lock_token():
+    cache = LocalResponseCache(ttl=60, lock_timeout=0, max_bytes=100)
+    expired = cache.lock("key")
+    # The lock expired and another request took it.
+    taken = cache.lock("key")
+    assert taken is not None
+
+    cache.unlock("key", expired)
+    assert cache._computing["key"][1] == taken
+    cache.unlock("key", taken)
+    assert "key" not in cache._computing
+
+
+def test_api_incidents_streams_large_pages_uncached(client, settings):
+    settings.RESPONSE_CACHE_MAX_ENTRY_BYTES = 1000
+    machine = Machine.objects.create(name="Large", url="http://large.com/metrics")
+    Incident.objects.bulk_create(
+        Incident(machine=machine, type="CPU", value=90) for _ in range(50)
+    )
+
+    for _ in range(2):
+        response = client.get("/api/incidents/", {"limit": 50})
+        assert response["X-Cache"] == "miss"
+        assert len(streamed_json(response)["results"]) == 50
+    response = client.get("/api/incidents/", {"limit": 1})
+    assert response["X-Cache"] == "miss"
+    streamed_chunks(response)
+    assert client.get("/api/incidents/", {"limit": 1})["X-Cache"] == "hit"
+
+
+def test_local_response_cache_is_bounded_by_bytes():
+    cache = LocalResponseCache(ttl=60, lock_timeout=1, max_bytes=10)
+    cache.set("a", CachedResponse(b"aaaa", {}))
+    cache.set("b", CachedResponse(b"bbbb", {}))
+    assert cache.get("a") is not None
+    cache.set("c", CachedResponse(b"cccc", {}))
+    # b was the least recently used.
+    assert cache.get("b") is None
+    assert cache.get("a").body == b"aaaa" and cache.get("c").body == b"cccc"
+    cache.set("d", CachedResponse(b"d" * 11, {}))
+    assert cache.get("d") is None and cache.get("a") is not None
+
+
+def test_cache_response_computes_concurrent_misses_once():
+    calls = []
+
+    @cache_response("slow")
+    def slow_view(request):
+        calls.append(request)
+        time.sleep(0.2)
+        return JsonResponse({"calls": len(calls)})
+
+    request_factory = RequestFactory()
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(
+            pool.map(lambda _: slow_view(request_factory.get("/slow/")), range(8))
+        )
+    assert len(calls) == 1
+    assert {json.loads(response.content)["calls"] for response in responses} == {1}
+    assert sorted(response["X-Cache"] for response in responses) == ["coalesced"] * 7 + [
+        "miss"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cache_response_computes_concurrent_async_misses_once():
+    calls = []
+
+    @cache_response("slow")
+    async def slow_view(request):
+        calls.append(request)
+        await asyncio.sleep(0.2)
+
+        async def chunks():
+            yield b'{"calls":'
+            yield b"%d}" % len(calls)
+
+        return StreamingHttpResponse(chunks(), content_type="application/json")
+
+    async def fetch():
+        response = await slow_view(AsyncRequestFactory().get("/slow/"))
+        if response.streaming:
+            body = b"".join([chunk async for chunk in response])
+        else:
+            body = response.content
+        return response["X-Cache"], json.loads(body)
+
+    results = await asyncio.gather(*(fetch() for _ in range(8)))
+    assert len(calls) == 1
+    assert sorted(results, key=str) == [("coalesced", {"calls": 1})] * 7 + [
+        ("miss", {"calls": 1})
+    ]
+
+
+def test_cache_response_waiters_compute_uncacheable_responses(settings):
+    settings.RESPONSE_CACHE_LOCK_TIMEOUT = 5
+    calls = []
+
+    @cache_response("slow")
+    def failing_view(request):
+        calls.append(request)
+        time.sleep(0.2)
+        return JsonResponse({"error": "unavailable"}, status=503)
+
+    request_factory = RequestFactory()
+    started = time.monotonic()
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(
+            pool.map(lambda _: failing_view(request_factory.get("/failing/")), range(8))
+        )
+    # The waiters computed theirs once the first request released the lock.
+    assert time.monotonic() - started < 1
+    assert len(calls) == 8
+    assert {response.status_code for response in responses} == {503}
+
+
+@pytest.mark.asyncio
+async def test_cache_response_waiters_compute_oversized_responses(settings):
+    settings.RESPONSE_CACHE_LOCK_TIMEOUT = 5
+    settings.RESPONSE_CACHE_MAX_ENTRY_BYTES = 10
+    calls = []
+
+    @cache_response("slow")
+    async def large_view(request):
+        calls.append(request)
+
+        async def chunks():
+            await asyncio.sleep(0.2)
+            yield b"x" * 20
+
+        return StreamingHttpResponse(chunks())
+
+    async def fetch():
+        response = await large_view(AsyncRequestFactory().get("/large/"))
+        return b"".join([chunk async for chunk in response])
+
+    started = time.monotonic()
+    bodies = await asyncio.gather(*(fetch() for _ in range(8)))
+    assert time.monotonic() - started < 1
+    assert len(calls) == 8
+    assert bodies == [b"x" * 20] * 8
+
+
+@pytest.mark.asyncio
+async def test_api_views_serve_asynchronously(async_client):
+    machine = await Machine.objects.acreate(name="Async", url="http://async.com/metrics")
+    await Incident.objects.acreate(machine=machine, type="CPU", value=91)
+
+    response = await async_client.get("/api/incidents/", {"machine": machine.id})
+    assert response.is_async
+    page = json.loads(b"".join([chunk async for chunk in response.streaming_content]))
+    assert [incident["machine"] for incident in page["results"]] == ["Async"]
+
+    response = await async_client.get("/api/machines/")
+    assert "Async" in {machine["name"] for machine in response.json()["results"]}
+
+
+def streamed_chunks(response) -> list[bytes]:
+    if not response.is_async:
+        return list(response.streaming_content)
+
+    async def collect():
+        return [chunk async for chunk in response.streaming_content]
+
+    return async_to_sync(collect)()
+
+
+def streamed_json(response):
+    if not response.streaming:
+        return response.json()
+    return json.loads(b"".join(streamed_chunks(response)))
+
+
+def test_api_metrics_downsamples_raw_metrics(client):
+    machine = Machine.objects.create(name="History", url="http://history.com/metrics")
+    until = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+    Metric.objects.bulk_create(
+        Metric(
+            machine=machine,
+            cpu=minute % 10,
+            mem=50,
+            disk=minute,
+            uptime="1d",
+            timestamp=until - timedelta(minutes=120 - minute),
+        )
+        for minute in range(120)
+    )
+
+    params = {
+        "machine": "History",
+        "since": (until - timedelta(hours=2)).isoformat(),
+        "until": until.isoformat(),
+        "points": 12,
+    }
+    response = client.get("/api/metrics/", params)
+    assert response.status_code == 200
+    data = streamed_json(response)
+    # Nothing is rolled up, so the whole range is read from raw metrics.
+    assert (data["step"], data["source"]) == (600, "1m")
+    [series] = data["series"]
+    assert series["machine"] == machine.id and series["name"] == "History"
+    assert len(series["t"]) == 12
+    assert sum(series["samples"]) == 120
+    assert series["t"][0] == (until - timedelta(hours=2)).timestamp()
+    assert (series["cpu_min"][0], series["cpu_avg"][0], series["cpu_max"][0]) == (0, 4.5, 9)
+    assert (series["disk_min"][-1], series["disk_max"][-1]) == (110, 119)
+
+
+def test_api_metrics_long_range_reads_rollups_and_unrolled_tail(
+    client, django_assert_max_num_queries
+):
+    machine = Machine.objects.create(name="Busy", url="http://busy.com/metrics")
+    other = Machine.objects.create(name="Quiet", url="http://quiet.com/metrics")
+    until = datetime(2026, 10, 18, 12, 30, tzinfo=dt_timezone.utc)
+    since = until - timedelta(days=30)
+    last_rollup = until - timedelta(hours=1, minutes=30)
+    MetricRollup.objects.bulk_create(
+        MetricRollup(
+            machine=machine,
+            resolution="1h",
+            bucket=last_rollup - timedelta(hours=hour),
+            samples=60,
+            **{aggregate: 10 for aggregate in AGGREGATES},
+        )
+        for hour in range(24 * 30)
+    )
+    Metric.objects.bulk_create(
+        Metric(machine=m, cpu=cpu, mem=10, disk=10, uptime="1d", timestamp=timestamp)
+        for m, cpu, timestamp in [
+            # Counted in the last rollup already.
+            (machine, 50, last_rollup + timedelta(minutes=30)),
+            # Not rolled up yet.
+            (machine, 90, until - timedelta(minutes=1)),
+            # No rollups at all, nor a watermark.
+            (other, 10, since + timedelta(days=1)),
+        ]
+    )
+
+    params = {
+        "machine": [machine.id, "Quiet"],
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+    }
+    # Machines, rollups, watermark and raw tail.
+    with django_assert_max_num_queries(4):
+        data = streamed_json(client.get("/api/metrics/", params))
+    assert data["source"] == "1h"
+    busy, quiet = data["series"]
+    # Buckets are aligned on the epoch, so one more may start in the range.
+    assert len(busy["t"]) <= 501
+    assert sum(busy["samples"]) == 24 * 30 * 60 + 1
+    assert sorted(set(busy["cpu_max"])) == [10, 90]
+    # Not read from raw metrics further back than RAW_MAX_RANGE.
+    assert quiet["samples"] == []
+    assert quiet["gaps"] == [
+        [int(since.timestamp()), int((until - RAW_MAX_RANGE).timestamp())]
+    ]
+
+
+def test_api_metrics_reports_missing_rollups_as_gaps(client):
+    machine = Machine.objects.create(name="Patchy", url="http://patchy.com/metrics")
+    until = datetime(2026, 10, 18, 12, 30, tzinfo=dt_timezone.utc)
+    since = until - timedelta(days=30)
+    first = bucket_start(since, "1h")
+    rolled_up = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+    RollupWatermark.objects.update_or_create(resolution="1h", defaults={"position": rolled_up})
+    # Rollups of the first 10 days only, the next ones are missing.
+    MetricRollup.objects.bulk_create(
+        MetricRollup(
+            machine=machine,
+            resolution="1h",
+            bucket=first + timedelta(hours=hour),
+            samples=60,
+            **{aggregate: 10 for aggregate in AGGREGATES},
+        )
+        for hour in range(24 * 10)
+    )
+    Metric.objects.bulk_create(
+        Metric(machine=machine, cpu=cpu, mem=10, disk=10, uptime="1d", timestamp=timestamp)
+        for cpu, timestamp in [
+            # Behind the watermark without a rollup, not read back from raw metrics.
+            (77, first + timedelta(days=15)),
+            # In the bucket before the watermark and after it.
+            (50, rolled_up - timedelta(minutes=30)),
+            (90, until - timedelta(minutes=10)),
+        ]
+    )
+
+    data = streamed_json(
+        client.get(
+            "/api/metrics/",
+            {"machine": machine.id, "since": since.isoformat(), "until": until.isoformat()},
+        )
+    )
+    [series] = data["series"]
+    assert sum(series["samples"]) == 24 * 10 * 60 + 2
+    assert sorted(set(series["cpu_max"])) == [10, 90]
+    assert series["gaps"] == [
+        [
+            int((first + timedelta(days=10)).timestamp()),
+            int((rolled_up - timedelta(hours=1)).timestamp()),
+        ]
+    ]
+
+
+def test_api_metrics_long_range_steps_are_at_least_a_minute(client):
+    machine = Machine.objects.create(name="Dense", url="http://dense.com/metrics")
+    until = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+    since = until - timedelta(hours=30)
+    Metric.objects.bulk_create(
+        Metric(machine=machine, cpu=10, mem=10, disk=10, uptime="1d", timestamp=timestamp)
+        for timestamp in [since + timedelta(minutes=1), until - timedelta(minutes=1)]
+    )
+
+    data = streamed_json(
+        client.get(
+            "/api/metrics/",
+            {
+                "machine": machine.id,
+                "since": since.isoformat(),
+                "until": until.isoformat(),
+                "points": 2000,
+            },
+        )
+    )
+    # 54 second steps would be built from raw metrics over the whole range.
+    assert (data["step"], data["source"]) == (60, "1m")
+    [series] = data["series"]
+    assert series["samples"] == [1]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"machine": []},
+        {"machine": "999999"},
+        {"machine": "Nope"},
+        {"points": "0"},
+        {"points": "5000"},
+        {"since": "2026-10-18T12:00:00", "until": "2026-10-18T11:00:00"},
+        {"since": "yesterday"},
+    ],
+)
+def test_api_metrics_rejects_bad_parameters(client, params):
+    Machine.objects.create(name="One", url="http://one.com/metrics")
+    assert client.get("/api/metrics/", {"machine": "One", **params}).status_code == 400
+
+
+def test_purge_expired_deletes_old_rows_in_chunks():
+    # Ids must grow with time, so no rows left over by other tests.
+    Metric.objects.all().delete()
+    Incident.objects.all().delete()
+    MetricRollup.objects.all().delete()
+    machine = Machine.objects.create(name="Purge", url="http://purge.com/metrics")
+    now = timezone.now()
+
+    def add(days):
+        return Metric.objects.create(
+            machine=machine,
+            cpu=1,
+            mem=1,
+            disk=1,
+            uptime="1d",
+            timestamp=now - timedelta(days=days),
+        )
+
+    expired = [add(days) for days in (50, 45, 40, 35, 32)]
+    unrolled = add(31)
+    kept = add(1)
+    def add_rollup(resolution, days):
+        return MetricRollup.objects.create(
+            machine=machine,
+            resolution=resolution,
+            bucket=now - timedelta(days=days),
+            samples=1,
+            **dict.fromkeys(AGGREGATES, 1),
+        )
+
+    rollup = add_rollup("1d", 50)
+    add_rollup("1m", 8)
+    minute = add_rollup("1m", 6)
+    RollupWatermark.objects.create(
+        resolution="1d", position=now - timedelta(days=31, hours=1)
+    )
+    old_resolved = Incident.objects.create(
+        machine=machine,
+        type="CPU",
+        value=90,
+        start_time=now - timedelta(days=400),
+        end_time=now - timedelta(days=399),
+    )
+    old_open = Incident.objects.create(
+        machine=machine, type="MEM", value=95, start_time=now - timedelta(days=400)
+    )
+    progress = []
+
+    deleted = purge_expired(
+        now=now,
+        metric_days=30,
+        incident_days=365,
+        minute_rollup_days=7,
+        chunk_size=2,
+        sleep=0,
+        progress=lambda model, count, last_id: progress.append((model, count)),
+    )
+
+    assert deleted == {"metrics": 5, "incidents": 1, "rollups": 1}
+    assert not Metric.objects.filter(id__in=[metric.id for metric in expired]).exists()
+    # Not rolled up yet, so kept past its retention.
+    assert Metric.objects.filter(id__in=[unrolled.id, kept.id]).count() == 2
+    # Only minute rollups expire.
+    assert set(MetricRollup.objects.values_list("id", flat=True)) == {rollup.id, minute.id}
+    assert not Incident.objects.filter(id=old_resolved.id).exists()
+    assert Incident.objects.filter(id=old_open.id).exists()
+    assert progress[:3] == [(Metric, 2), (Metric, 4), (Metric, 5)]
+
+
+def test_purge_expired_deletes_incidents_a_chunk_at_a_time():
+    Incident.objects.all().delete()
+    DeleteGeneration.objects.all().delete()
+    machine = Machine.objects.create(name="Purge", url="http://purge.com/metrics")
+    now = timezone.now()
+    Incident.objects.bulk_create(
+        Incident(
+            machine=machine,
+            type="CPU",
+            value=90,
+            start_time=now - timedelta(days=400),
+            end_time=now - timedelta(days=399),
+        )
+        for _ in range(6)
+    )
+
+    with CaptureQueriesContext(connection) as queries:
+        deleted = purge_expired(
+            now=now, metric_days=0, incident_days=365, chunk_size=3, sleep=0
+        )
+
+    assert deleted["incidents"] == 6
+    statements = [query["sql"].split()[0] for query in queries.captured_queries]
+    # One DELETE and one DeleteGeneration bump per chunk, not per incident.
+    assert statements.count("DELETE") == 2
+    assert statements.count("UPDATE") == 2
+    assert DeleteGeneration.objects.get(table=Incident._meta.db_table).deletes == 6
+
+
+def test_partition_plan():
+    assert partition_plan(date(2026, 10, 17), date(2026, 10, 18), "daily") == [
+        ("p20261017", date(2026, 10, 18)),
+        ("p20261018", date(2026, 10, 19)),
+    ]
+    # Weeks start on Monday.
+    assert partition_plan(date(2026, 10, 17), date(2026, 10, 20), "weekly") == [
+        ("p20261012", date(2026, 10, 19)),
+        ("p20261019", date(2026, 10, 26)),
+    ]
+
+
+@patch("monitor.partitions.connection")
+@patch("monitor.partitions.existing_partitions")
+def test_partition_maintenance_statements(existing_partitions, mock_connection):
+    existing_partitions.return_value = [
+        ("p20261016", datetime(2026, 10, 17), 1000),
+        ("p20261017", datetime(2026, 10, 18), 2000),
+        ("pmax", None, 0),
+    ]
+    execute = mock_connection.cursor.return_value.__enter__.return_value.execute
+
+    created = create_future_partitions("daily", ahead=1, today=date(2026, 10, 18))
+    assert created == ["p20261018", "p20261019"]
+    execute.assert_called_once_with(
+        "ALTER TABLE monitor_metric REORGANIZE PARTITION pmax INTO ("
+        "PARTITION p20261018 VALUES LESS THAN ('2026-10-19 00:00:00'), "
+        "PARTITION p20261019 VALUES LESS THAN ('2026-10-20 00:00:00'), "
+        "PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+    )
+
+    execute.reset_mock()
+    cutoff = datetime(2026, 10, 17, 12, tzinfo=dt_timezone.utc)
+    assert drop_partitions_before(cutoff) == 1000
+    execute.assert_called_once_with("ALTER TABLE monitor_metric DROP PARTITION p20261016")
+
+
+@patch("monitor.partitions.connection")
+@patch("monitor.partitions.existing_partitions")
+def test_future_partitions_follow_a_changed_period(existing_partitions, mock_connection):
+    # Daily partitions up to Wednesday 2026-10-21, now weekly.
+    existing_partitions.return_value = [
+        ("p20261020", datetime(2026, 10, 21), 1000),
+        ("pmax", None, 0),
+    ]
+    execute = mock_connection.cursor.return_value.__enter__.return_value.execute
+
+    created = create_future_partitions("weekly", ahead=1, today=date(2026, 10, 21))
+    assert created == ["p20261021", "p20261026"]
+    execute.assert_called_once_with(
+        "ALTER TABLE monitor_metric REORGANIZE PARTITION pmax INTO ("
+        "PARTITION p20261021 VALUES LESS THAN ('2026-10-26 00:00:00'), "
+        "PARTITION p20261026 VALUES LESS THAN ('2026-11-02 00:00:00'), "
+        "PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+    )
+
+    existing_partitions.return_value = [("p20261020", datetime(2026, 10, 21), 1000)]
+    with pytest.raises(RuntimeError):
+        create_future_partitions("weekly", ahead=1, today=date(2026, 10, 21))
+
+
+def test_purge_expired_skips_metrics_while_partitioning():
+    machine = Machine.objects.create(name="Busy", url="http://busy.com/metrics")
+    metric = Metric.objects.create(
+        machine=machine,
+        cpu=1,
+        mem=1,
+        disk=1,
+        uptime="1d",
+        timestamp=timezone.now() - timedelta(days=60),
+    )
+
+    @contextmanager
+    def taken(timeout=-1):
+        yield False
+
+    with patch("monitor.retention.partition_lock", taken):
+        deleted = purge_expired(metric_days=30, incident_days=0, sleep=0)
+    assert deleted["metrics"] == 0
+    assert Metric.objects.filter(id=metric.id).exists()
+
+
+@pytest.mark.parametrize(
+    "previous, sample, incident_open, interval",
+    [
+        (900, {"cpu": 90, "mem": 10, "disk": 10}, False, 60),
+        (900, {"cpu": 10, "mem": 10, "disk": 10}, True, 60),
+        (900, {"cpu": 80, "mem": 10, "disk": 10}, False, 450),
+        (100, {"cpu": 10, "mem": 85, "disk": 10}, False, 60),
+        (900, {"cpu": 10, "mem": 10, "disk": 10}, False, 1350),
+        (1500, {"cpu": 10, "mem": 10, "disk": 10}, False, 1800),
+        (None, {"cpu": 10, "mem": 10, "disk": 10}, False, 1350),
+        (450, None, False, 450),
+    ],
+)
+def test_next_interval(previous, sample, incident_open, interval):
+    assert next_interval(previous, sample, incident_open) == interval
+
+
+def test_claim_due_machines_and_reschedule(settings):
+    settings.POLL_JITTER = 0
+    now = timezone.now()
+    due = Machine.objects.create(
+        name="Due", url="http://due.com/metrics", next_poll_at=now - timedelta(seconds=1)
+    )
+    later = Machine.objects.create(
+        name="Later", url="http://later.com/metrics", next_poll_at=now + timedelta(hours=1)
+    )
+    new = Machine.objects.create(name="New", url="http://new.com/metrics")
+
+    claimed = claim_due_machines(now)
+    assert due in claimed and later not in claimed and new not in claimed
+    # Spread within one interval instead of being polled at once.
+    schedule_new_machines(now)
+    new.refresh_from_db()
+    assert now <= new.next_poll_at <= now + timedelta(seconds=settings.POLL_INTERVAL)
+    # Claimed until rescheduled, so a second tick does not poll it again.
+    assert due not in claim_due_machines(now)
+
+    Incident.objects.create(machine=due, type="DISK", value=99)
+    reschedule([(due, {"cpu": 10, "mem": 10, "disk": 10})], now)
+    due.refresh_from_db()
+    assert due.poll_interval == settings.POLL_MIN_INTERVAL
+    assert due.next_poll_at == now + timedelta(seconds=settings.POLL_MIN_INTERVAL)
+
+
+@pytest.mark.parametrize(
+    "failures, backoff",
+    [(1, 60), (2, 60), (3, 900), (4, 1800), (7, 14400), (8, 21600), (99, 21600)],
+)
+def test_failure_backoff(failures, backoff):
+    assert failure_backoff(failures) == backoff
+
+
+def test_reschedule_backs_off_unreachable_machines(settings):
+    settings.POLL_JITTER = 0
+    now = timezone.now()
+    machine = Machine.objects.create(
+        name="Dark", url="http://dark.com/metrics", poll_interval=450
+    )
+
+    for failures in range(1, 5):
+        reschedule([(machine, None)], now)
+        machine.refresh_from_db()
+        assert machine.consecutive_failures == failures
+        assert machine.next_poll_at == now + timedelta(seconds=failure_backoff(failures))
+    # The interval is kept for when the machine answers again.
+    assert machine.poll_interval == 450
+    [incident] = Incident.objects.filter(machine=machine, type="UNREACHABLE")
+    assert incident.value == settings.POLL_BREAKER_THRESHOLD
+    assert incident.end_time is None
+
+    reschedule([(machine, {"cpu": 10, "mem": 10, "disk": 10})], now)
+    machine.refresh_from_db()
+    incident.refresh_from_db()
+    assert machine.consecutive_failures == 0
+    assert machine.next_poll_at == now + timedelta(seconds=675)
+    assert incident.end_time is not None
+
+
+def test_reschedule_keeps_invalid_payloads_apart_from_failures(settings):
+    settings.POLL_JITTER = 0
+    now = timezone.now()
+    machine = Machine.objects.create(
+        name="Garbled", url="http://garbled.com/metrics", poll_interval=450
+    )
+
+    for _ in range(settings.POLL_BREAKER_THRESHOLD + 1):
+        reschedule([(machine, PayloadError("cpu: out of range: -1"))], now)
+    machine.refresh_from_db()
+    # The agent answers, so it is neither backed off nor unreachable.
+    assert machine.consecutive_failures == 0
+    assert machine.next_poll_at == now + timedelta(seconds=450)
+    assert not Incident.objects.filter(machine=machine, type="UNREACHABLE").exists()
+    assert MachineStatus.objects.get(machine=machine).poll_ok is False
+
+
+@pytest.mark.asyncio
+async def test_stream_samples_probes_failing_machines(settings):
+    settings.POLL_PROBE_TIMEOUT = 0.05
+    machines = [
+        Machine(id=i, name=f"Slow {i}", url=f"http://slow-{i}.com/metrics")
+        for i in range(2)
+    ]
+    machines[1].consecutive_failures = 2
+    client = SlowAgentClient({machine.url: 0.2 for machine in machines})
+
+    results = {
+        machine.id: sample
+        async for machine, sample, _ in stream_samples(client, machines, deadline=1.0)
+    }
+    assert results[0] is not None
+    assert results[1] is None
+
+
+def test_hash_ring_is_balanced_and_stable():
+    ring = HashRing(8)
+    shards = [ring.shard_for(machine_id) for machine_id in range(10000)]
+    assert min(shards.count(shard) for shard in range(8)) > 10000 / 8 / 2
+
+    # A ninth shard only takes machines over, about 1/9 of them.
+    grown = HashRing(9)
+    moved = [i for i in range(10000) if grown.shard_for(i) != shards[i]]
+    assert all(grown.shard_for(i) == 8 for i in moved)
+    assert len(moved) < 10000 / 9 * 1.5
+
+
+def test_claim_due_machines_by_shard(settings):
+    settings.POLL_SHARDS = 4
+    now = timezone.now()
+    machines = [
+        Machine.objects.create(
+            name=f"Shard {i}",
+            url=f"http://shard-{i}.com/metrics",
+            next_poll_at=now - timedelta(minutes=1),
+        )
+        for i in range(40)
+    ]
+    schedule_new_machines(now)
+
+    claimed = [claim_due_machines(now, shard) for shard in range(4)]
+    # No machine is polled twice, even by overlapping tasks of a shard.
+    assert claim_due_machines(now, 0) == []
+    # Machines whose poll was lost with its worker are claimed again.
+    later = now + timedelta(seconds=settings.POLL_CLAIM_TIMEOUT)
+    assert {machine.id for machine in claim_due_machines(later, 0)} >= {
+        machine.id for machine in claimed[0]
+    }
+    claimed_ids = [machine.id for shard in claimed for machine in shard]
+    ours = {machine.id for machine in machines}
+    assert sorted(set(claimed_ids) & ours) == sorted(ours)
+    assert len(claimed_ids) == len(set(claimed_ids))
+    assert all(
+        HashRing(4).shard_for(machine.id) == shard
+        for shard, shard_machines in enumerate(claimed)
+        for machine in shard_machines
+    )
+
+
+def test_assign_shards_follows_the_ring(settings, django_assert_num_queries):
+    settings.POLL_SHARDS = 4
+    assign_shards()
+    machines = [
+        Machine.objects.create(name=f"Ring {i}", url=f"http://ring-{i}.com/metrics")
+        for i in range(20)
+    ]
+    ids = [machine.id for machine in machines]
+
+    assert assign_shards() == 20
+    # Only machines without a shard are read once the ring is assigned.
+    with django_assert_num_queries(1):
+        assert assign_shards() == 0
+
+    settings.POLL_SHARDS = 5
+    assign_shards()
+    shards = dict(Machine.objects.filter(id__in=ids).values_list("id", "poll_shard"))
+    assert shards == {id_: HashRing(5).shard_for(id_) for id_ in ids}
+
+
+@pytest.mark.asyncio
+@patch("monitor.poll.httpx.AsyncClient")
+async def test_poller_reuses_its_client_between_cycles(mock_client, settings):
+    settings.POLL_MAX_CONNECTIONS = 100
+    settings.POLL_POOL_SIZE = 100
+    settings.POLL_JITTER = 0
+    now = timezone.now()
+    machines = [
+        await sync_to_async(Machine.objects.create)(
+            name=f"Poller {i}",
+            url=f"http://poller-{i}.com/metrics",
+            next_poll_at=now - timedelta(seconds=1),
+        )
+        for i in range(3)
+    ]
+    mock_client_instance = AsyncMock()
+    mock_client_instance.stream = Mock(
+        side_effect=agent_response(
+            {"cpu": 99, "mem": "10%", "disk": "10%", "uptime": "1d"}
+        )
+    )
+    mock_client.return_value = mock_client_instance
+
+    poller = Poller(tick=0.01)
+    # The second cycle finds nothing due, the machines were rescheduled.
+    await poller.run(cycles=2)
+
+    assert poller.cycles == 2
+    assert mock_client.call_count == 1
+    mock_client_instance.aclose.assert_awaited_once()
+    assert {call.args[1] for call in mock_client_instance.stream.call_args_list} == {
+        machine.url for machine in machines
+    }
+    ids = [machine.id for machine in machines]
+    assert await sync_to_async(Metric.objects.filter(machine_id__in=ids).count)() == 3
+    # Evaluated by the poller itself, so the next poll comes sooner.
+    assert await sync_to_async(
+        Incident.objects.filter(machine_id__in=ids, type="CPU").count
+    )() == 3
+    for machine in await sync_to_async(list)(Machine.objects.filter(id__in=ids)):
+        assert machine.poll_interval == settings.POLL_MIN_INTERVAL
+        assert machine.next_poll_at > now
+
+
+def test_benchmark_cycle_reports_json(tmp_path):
+    path = tmp_path / "cycle.json"
+    throwaway = []
+
+    @contextmanager
+    def throwaway_database():
+        # The test database is one already, empty it like a new one. From
+        # another thread, outside the test's transaction, like the cycles.
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(lambda: Machine.objects.all().delete()).result()
+        throwaway.append(True)
+        yield
+
+    with patch("monitor.benchmarks.cycle.throwaway_database", throwaway_database):
+        call_command(
+        "benchmark",
+            "--scenario=cycle",
+            "--machines=20",
+            "--cycles=2",
+            "--failure-rate=0.5",
+            "--distribution=uniform",
+            "--latency=0.001",
+            f"--json={path}",
+            stdout=StringIO(),
+        )
+    assert throwaway == [True]
+
+    report = json.loads(path.read_text())
+    assert report["fleet"] == {
+        "latency": 0.001,
+        "distribution": "uniform",
+        "failure_rate": 0.5,
+    }
+    [result] = report["results"]
+    assert result["machines"] == 20
+    assert len(result["cycles"]) == 2
+    for cycle in result["cycles"]:
+        assert cycle["polled"] == 20
+        assert 0 < cycle["failed"] < 20
+        assert cycle["queries"] > 0
+    # The fleet's machines are removed afterwards.
+    assert not Machine.objects.exists()
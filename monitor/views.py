@@ -1,12 +1,42 @@
+import asyncio
+import binascii
+import hashlib
 import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.db.models import Count, F, Q, Subquery
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_GET, require_http_methods
 
-from .models import Incident
+from .cache import cache_response, get_cache
+from .events import get_hub
+from .history import downsample
+from .models import DeleteGeneration, Incident, Machine
+from .payload import PayloadError, PayloadTooLarge, dumps
+from .push import authenticate_machine, decompress, ingest_samples, parse_push
+
+INCIDENTS_PAGE_SIZE = 50
+INCIDENTS_MAX_PAGE_SIZE = 10000
+# Incidents read and encoded at a time when streaming a page.
+INCIDENTS_CHUNK_SIZE = 1000
+# Columns of a listed incident, and the keys they are listed under.
+INCIDENT_COLUMNS = ("id", "machine__name", "type", "value", "start_time", "end_time")
+INCIDENT_KEYS = ("id", "machine", "type", "value", "start_time", "end_time")
+METRICS_POINTS = 500
+METRICS_MAX_POINTS = 2000
+METRICS_MAX_MACHINES = 50
 
 
 @csrf_exempt
@@ -76,33 +106,390 @@ def api_logout(request):
     return JsonResponse({"message": "Logout successful"})
 
 
-def api_incidents(request):
-    """API endpoint to get all incidents."""
+def encode_cursor(start_time, id_):
+    """Opaque cursor pointing after the incident with this start time and id."""
+    return urlsafe_b64encode(f"{start_time.isoformat()}|{id_}".encode()).decode()
+
+
+def decode_cursor(cursor):
     try:
-        # Simplified query to debug
-        incidents = (
-            Incident.objects.all().order_by("-start_time").select_related("machine")
+        start_time, id_ = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return parse_query_datetime(start_time), int(id_)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+def parse_query_datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid datetime: {value}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def filter_incidents(incidents, params):
+    """Apply the machine, type, status and time range filters of a request."""
+    if machine := params.get("machine"):
+        if machine.isdigit():
+            incidents = incidents.filter(machine_id=int(machine))
+        else:
+            incidents = incidents.filter(machine__name=machine)
+    if type_ := params.get("type"):
+        if type_ not in dict(Incident.INCIDENT_TYPES):
+            raise ValueError(f"Invalid type: {type_}")
+        incidents = incidents.filter(type=type_)
+    if status := params.get("status"):
+        if status not in ("active", "resolved"):
+            raise ValueError(f"Invalid status: {status}")
+        incidents = incidents.filter(end_time__isnull=status == "active")
+    if since := params.get("since"):
+        incidents = incidents.filter(start_time__gte=parse_query_datetime(since))
+    if until := params.get("until"):
+        incidents = incidents.filter(start_time__lt=parse_query_datetime(until))
+    return incidents
+
+
+async def incidents_version():
+    """Latest id, start and end time of any incident, and count of deletes.
+
+    Changes whenever an incident is opened, resolved or deleted, purges
+    included. Each value is the first entry of an index or a primary key
+    lookup, read by one query with scalar subqueries, which every backend
+    answers without scanning the table.
+    """
+    latest_start = Incident.objects.order_by("-start_time").values("start_time")[:1]
+    latest_end = (
+        Incident.objects.filter(end_time__isnull=False)
+        .order_by("-end_time")
+        .values("end_time")[:1]
+    )
+    deletes = DeleteGeneration.objects.filter(table=Incident._meta.db_table)
+    return (
+        await Incident.objects.annotate(
+            max_start=Subquery(latest_start),
+            max_end=Subquery(latest_end),
+            deletes=Subquery(deletes.values("deletes")[:1]),
+            deleted_at=Subquery(deletes.values("deleted_at")[:1]),
         )
-        incidents_data = []
-
-        for incident in incidents:
-            incidents_data.append(
-                {
-                    "id": incident.id,
-                    "machine": incident.machine.name,
-                    "type": incident.type,
-                    "value": incident.value,
-                    "start_time": incident.start_time.isoformat(),
-                    "end_time": incident.end_time.isoformat()
-                    if incident.end_time
-                    else None,
-                }
+        .order_by("-id")
+        .values("id", "max_start", "max_end", "deletes", "deleted_at")
+        .afirst()
+    ) or dict.fromkeys(["id", "max_start", "max_end", "deletes", "deleted_at"])
+
+
+def incidents_etag(request, version):
+    token = "|".join(
+        [
+            str(version["id"]),
+            str(version["max_start"] and version["max_start"].timestamp()),
+            str(version["max_end"] and version["max_end"].timestamp()),
+            str(version["deletes"]),
+            request.GET.urlencode(),
+        ]
+    )
+    return hashlib.md5(token.encode()).hexdigest()
+
+
+def incidents_last_modified(version):
+    times = [
+        time
+        for time in (version["max_start"], version["max_end"], version["deleted_at"])
+        if time
+    ]
+    return max(times, default=None)
+
+
+@cache_response("incidents")
+async def api_incidents(request):
+    """API endpoint to get incidents, newest first, one page at a time.
+
+    Query parameters:
+    - limit: page size (default 50, at most 10000)
+    - cursor: the ``next`` value of the previous page
+    - machine: machine id or name
+    - type: CPU, MEM or DISK
+    - status: active or resolved
+    - since, until: ISO datetimes bounding the start time
+
+    Pages are fetched by keyset on (start_time, id), so any page costs the
+    same whatever the size of the table. Responses carry an ETag and
+    Last-Modified, and a request whose validator still matches is answered
+    with 304 without reading any incident rows. Pages are streamed, see
+    incident_chunks, and cached until an incident changes, see
+    monitor.cache.
+    """
+    version = await incidents_version()
+    etag = quote_etag(incidents_etag(request, version))
+    last_modified = incidents_last_modified(version)
+    last_modified = last_modified and int(last_modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = incidents_page(request)
+    if request.method in ("GET", "HEAD"):
+        response.headers.setdefault("ETag", etag)
+        if last_modified:
+            response.headers.setdefault("Last-Modified", http_date(last_modified))
+    return response
+
+
+def incidents_page(request):
+    """The page of incidents a request asks for, streamed, or a 400 response."""
+    try:
+        limit = int(request.GET.get("limit", INCIDENTS_PAGE_SIZE))
+        if not 1 <= limit <= INCIDENTS_MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {INCIDENTS_MAX_PAGE_SIZE}")
+
+        incidents = filter_incidents(Incident.objects.all(), request.GET)
+        if cursor := request.GET.get("cursor"):
+            start_time, id_ = decode_cursor(cursor)
+            incidents = incidents.filter(
+                Q(start_time__lt=start_time) | Q(start_time=start_time, id__lt=id_)
             )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    response = StreamingHttpResponse(
+        incident_chunks(incidents, limit), content_type="application/json"
+    )
+    # Cacheable, but always revalidated.
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+async def incident_chunks(incidents, limit):
+    """Encode a page of incidents as JSON, INCIDENTS_CHUNK_SIZE incidents at a time.
+
+    Incidents are read as tuples of INCIDENT_COLUMNS, joined with their
+    machine's name, and each chunk is encoded by one dumps call, so
+    neither model instances nor the whole page are held in memory.
+    Incidents are listed like Incident.to_dict, ``next`` follows them.
+    """
+    rows = (
+        incidents.order_by("-start_time", "-id")
+        .values_list(*INCIDENT_COLUMNS)[: limit + 1]
+        .iterator(chunk_size=INCIDENTS_CHUNK_SIZE)
+    )
+    # Chunks are read in a thread: QuerySet.aiterator would run the query
+    # of a values_list in the event loop, which Django refuses.
+    read = sync_to_async(list)
+    yield b'{"results":['
+    listed, last = 0, None
+    while chunk := await read(islice(rows, min(INCIDENTS_CHUNK_SIZE, limit - listed))):
+        yield (b"," if listed else b"") + dumps(
+            [dict(zip(INCIDENT_KEYS, row)) for row in chunk]
+        )[1:-1]
+        listed += len(chunk)
+        last = chunk[-1]
+    more = listed == limit and bool(await read(islice(rows, 1)))
+    # The start time and id of the last incident listed.
+    next_cursor = encode_cursor(last[4], last[0]) if more else None
+    yield b'],"next":' + dumps(next_cursor) + b"}"
+
+
+@require_GET
+@cache_response("incidents", "machines", ttl=settings.RESPONSE_CACHE_STATUS_TTL)
+async def api_machines(request):
+    """API endpoint for the current state of every machine.
+
+    Each machine comes with its latest sample, the outcome of its last
+    poll and its open incidents by type. They are read from MachineStatus
+    and the open incidents, two queries whose cost grows with the fleet,
+    never with the metric history. The response is cached until a
+    machine or an incident changes. Samples and poll outcomes are written
+    on every poll and would leave nothing to cache, so they only show up
+    once the entry expires, RESPONSE_CACHE_STATUS_TTL seconds at most.
+    """
+    open_incidents = defaultdict(dict)
+    counts = (
+        Incident.objects.filter(end_time__isnull=True)
+        .values("machine_id", "type")
+        .annotate(count=Count("id"))
+        .values_list("machine_id", "type", "count")
+        .order_by()
+    )
+    async for machine_id, type_, count in counts:
+        open_incidents[machine_id][type_] = count
+
+    status = {
+        field: F(f"status__{field}")
+        for field in ("cpu", "mem", "disk", "uptime", "sampled_at", "polled_at", "poll_ok")
+    }
+    results = [
+        machine
+        async for machine in Machine.objects.order_by("id").values(
+            "id", "name", "consecutive_failures", "next_poll_at", **status
+        )
+    ]
+    for machine in results:
+        for field in ("sampled_at", "polled_at", "next_poll_at"):
+            machine[field] = machine[field] and machine[field].isoformat()
+        machine["open_incidents"] = {
+            type_: open_incidents[machine["id"]].get(type_, 0)
+            for type_, _ in Incident.INCIDENT_TYPES
+        }
+    return JsonResponse({"results": results})
+
+
+@require_GET
+async def api_cache(request):
+    """API endpoint for the counters of the response cache.
+
+    Hits, misses and coalesced requests (misses served by another
+    request's computation) per cached view, and invalidations per
+    namespace, counted since the cache was last cleared.
+    """
+    views, invalidations = defaultdict(dict), {}
+    for name, count in (await asyncio.to_thread(get_cache().stats)).items():
+        prefix, _, outcome = name.partition(":")
+        if prefix == "invalidations":
+            invalidations[outcome] = count
+        else:
+            views[prefix][outcome] = count
+    for counts in views.values():
+        for outcome in ("hit", "miss", "coalesced"):
+            counts.setdefault(outcome, 0)
+        total = sum(counts.values())
+        counts["hit_rate"] = round((counts["hit"] + counts["coalesced"]) / total, 4)
+    return JsonResponse({"views": views, "invalidations": invalidations})
+
+
+async def resolve_machines(wanted: list[str]) -> dict[int, str]:
+    """Names of the machines given by id or name, by id in the order given."""
+    ids = [int(machine) for machine in wanted if machine.isdigit()]
+    names = [machine for machine in wanted if not machine.isdigit()]
+    found = {
+        id_: name
+        async for id_, name in Machine.objects.filter(
+            Q(id__in=ids) | Q(name__in=names)
+        ).values_list("id", "name")
+    }
+    by_name = {name: id_ for id_, name in found.items()}
+
+    machines = {}
+    for machine in wanted:
+        id_ = int(machine) if machine.isdigit() else by_name.get(machine)
+        if id_ not in found:
+            raise ValueError(f"Unknown machine: {machine}")
+        machines[id_] = found[id_]
+    return machines
+
+
+@require_GET
+async def api_metrics(request):
+    """API endpoint for the metric history of machines, downsampled for charts.
+
+    Query parameters:
+    - machine: machine id or name, repeated for several machines (at most 50)
+    - since, until: ISO datetimes bounding the range (default: the last day)
+    - points: buckets per series (default 500, at most 2000)
+
+    Each series is columnar: ``t`` holds the bucket starts in epoch
+    seconds and each other column (``samples``, ``cpu_min``, ``cpu_avg``,
+    ``cpu_max``, ...) one value per bucket, see monitor.history. Series
+    are streamed one machine at a time.
+    """
+    try:
+        until = request.GET.get("until")
+        until = parse_query_datetime(until) if until else timezone.now()
+        since = request.GET.get("since")
+        since = parse_query_datetime(since) if since else until - timedelta(days=1)
+        if since >= until:
+            raise ValueError("since must be before until")
+        points = int(request.GET.get("points", METRICS_POINTS))
+        if not 1 <= points <= METRICS_MAX_POINTS:
+            raise ValueError(f"points must be between 1 and {METRICS_MAX_POINTS}")
+
+        wanted = request.GET.getlist("machine")
+        if not 1 <= len(wanted) <= METRICS_MAX_MACHINES:
+            raise ValueError(f"Give between 1 and {METRICS_MAX_MACHINES} machines")
+        machines = await resolve_machines(wanted)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    step, source, series = await sync_to_async(downsample)(
+        list(machines), since, until, points
+    )
+
+    async def chunks():
+        header = {
+            "since": since.isoformat(),
+            "until": until.isoformat(),
+            "step": step,
+            "source": source,
+        }
+        yield dumps(header)[:-1] + b',"series":['
+        for i, (machine_id, name) in enumerate(machines.items()):
+            yield (b"," if i else b"") + dumps(
+                {"machine": machine_id, "name": name, **series[machine_id]}
+            )
+        yield b"]}"
+
+    return StreamingHttpResponse(chunks(), content_type="application/json")
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_ingest(request):
+    """API endpoint for agents pushing their own metrics.
+
+    The agent authenticates with its machine's token, see the push_token
+    command, as ``Authorization: Bearer <token>``. The body is one sample
+    or an array of samples as JSON, or NDJSON with ``Content-Type:
+    application/x-ndjson``, optionally gzip compressed. A sample is the
+    payload the agent serves to the poller, with an optional
+    ``timestamp`` (epoch seconds or ISO datetime). A request is accepted
+    or rejected as a whole.
+    """
+    machine = authenticate_machine(request.headers.get("Authorization", ""))
+    if machine is None:
+        return JsonResponse({"error": "Invalid token"}, status=401)
+
+    now = timezone.now()
+    try:
+        body = decompress(request.body, request.headers.get("Content-Encoding"))
+        samples = parse_push(body, request.content_type, now)
+    except PayloadTooLarge as e:
+        return JsonResponse({"error": str(e)}, status=413)
+    except PayloadError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    metrics = ingest_samples(machine, samples, now)
+    return JsonResponse({"received": len(samples), "saved": len(metrics)}, status=202)
+
+
+def format_event(event_id: str | None, event: dict | None) -> str:
+    """Format an incident event as a Server-Sent Events message."""
+    if event is None:
+        return ": keepalive\n\n"
+    data = json.dumps(event.get("incident", {}))
+    return f"id: {event_id}\nevent: {event['action']}\ndata: {data}\n\n"
+
+
+@require_GET
+async def api_incidents_stream(request):
+    """API endpoint streaming incidents as they open and resolve (Server-Sent Events).
+
+    Events are ``opened`` with the incident as listed by /api/incidents/,
+    ``resolved`` with its id, machine, type and end time, and ``reset``
+    when the events since ``Last-Event-ID`` (or the ``last_event_id``
+    query parameter) are no longer kept and the list must be reloaded. A
+    stream opened without either starts with ``ready``, after which the
+    list can be loaded without missing any change.
+
+    The stream never touches the database. It is only served properly by
+    an ASGI server, a WSGI server would buffer it forever.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
 
-        return JsonResponse(incidents_data, safe=False)
-    except Exception as e:
-        import traceback
+    async def messages():
+        # Reconnect quickly after the server closes the stream.
+        yield "retry: 3000\n\n"
+        async for event_id, event in get_hub().stream(last_event_id):
+            yield format_event(event_id, event)
 
-        print(f"Error in api_incidents: {e}")
-        traceback.print_exc()
-        return JsonResponse({"error": f"Server error: {str(e)}"}, status=500)
+    response = StreamingHttpResponse(messages(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop proxies from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,103 @@
+from bisect import insort
+from collections import deque
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from monitor.models import THRESHOLDS
+
+
+class SlidingWindow:
+    """Recent samples of one metric of one machine.
+
+    Keeps every sample of the last ``duration`` plus the latest sample
+    before it, which stands for the value at the start of the window.
+    Samples are ordered by timestamp, not id, since agents push samples
+    taken before ones already polled. The number of samples over the
+    threshold is maintained as samples come and go, so pushing a sample
+    and checking the window are O(1) amortised.
+    """
+
+    def __init__(self, duration: timedelta, threshold: float):
+        self.duration = duration
+        self.threshold = threshold
+        self.samples: deque[tuple[datetime, int, bool]] = deque()
+        self.ids: set[int] = set()
+        self.breaching = 0
+
+    def push(self, metric_id: int, timestamp: datetime, value: float):
+        """Add a sample, ignoring metrics the window has already seen."""
+        if metric_id in self.ids:
+            return
+        sample = (timestamp, metric_id, float(value) > self.threshold)
+        if self.samples and sample < self.samples[-1]:
+            insort(self.samples, sample)
+        else:
+            self.samples.append(sample)
+        self.ids.add(metric_id)
+        self.breaching += sample[2]
+        self._evict()
+
+    def extend(self, history: list[tuple[int, datetime, float]]):
+        """Add samples loaded from the database, in any order."""
+        for metric_id, timestamp, value in history:
+            self.push(metric_id, timestamp, value)
+
+    def covers(self, timestamp: datetime) -> bool:
+        """Whether the samples reach back to the start of the window ending at timestamp."""
+        return bool(self.samples) and self.samples[0][0] <= timestamp - self.duration
+
+    def sustained(self, timestamp: datetime) -> bool:
+        """Whether the threshold was exceeded for the whole window ending at timestamp.
+
+        At least INCIDENT_WINDOW_BREACH_RATIO of the samples must be over the
+        threshold, every one of them by default.
+        """
+        return (
+            self.covers(timestamp)
+            and self.breaching >= settings.INCIDENT_WINDOW_BREACH_RATIO * len(self.samples)
+        )
+
+    def _evict(self):
+        if not self.samples:
+            return
+        cutoff = self.samples[-1][0] - self.duration
+        while len(self.samples) > 1 and self.samples[1][0] <= cutoff:
+            _, metric_id, breaching = self.samples.popleft()
+            self.ids.discard(metric_id)
+            self.breaching -= breaching
+
+
+_windows: dict[tuple[int, str], SlidingWindow] = {}
+# Evaluation count of each machine when this process last evaluated it.
+_evaluations: dict[int, int] = {}
+
+
+def get_window(machine_id: int, type_: str) -> SlidingWindow:
+    """Return the window of a machine and incident type, kept in process memory."""
+    key = (machine_id, type_)
+    if key not in _windows:
+        _windows[key] = SlidingWindow(
+            timedelta(minutes=THRESHOLDS[type_]["duration"]), THRESHOLDS[type_]["value"]
+        )
+    return _windows[key]
+
+
+def sync_windows(evaluations: dict[int, int]):
+    """Drop the windows of machines another process evaluated since this one did.
+
+    ``evaluations`` maps machines to their evaluation count in the state
+    store, just incremented by this process. Unless the previous count
+    is this process' own, samples evaluated elsewhere are missing from
+    the windows, which are then reloaded from the database.
+    """
+    for machine_id, count in evaluations.items():
+        if _evaluations.get(machine_id) != count - 1:
+            for type_ in THRESHOLDS:
+                _windows.pop((machine_id, type_), None)
+        _evaluations[machine_id] = count
+
+
+def clear_windows():
+    _windows.clear()
+    _evaluations.clear()
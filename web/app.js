@@ -10,7 +10,16 @@ document.addEventListener("DOMContentLoaded", function () {
   const tabBtns = document.querySelectorAll(".tab-btn");
 
   let pollInterval = null;
+  let incidentsEtag = null;
+  let incidents = [];
+  let eventSource = null;
+  let lastEventId = null;
+  let streamRetry = null;
+  // One list per fetch in flight, of the events received meanwhile.
+  const eventsDuringFetch = new Set();
   const API_BASE = "http://localhost:8000";
+  const INCIDENTS_PAGE_SIZE = 50;
+  const STREAM_RETRY_MS = 30000;
 
   function showDashboard() {
     loginSection.style.display = "none";
@@ -25,8 +34,13 @@ document.addEventListener("DOMContentLoaded", function () {
   }
 
   function startPolling() {
-    fetchIncidents();
-    pollInterval = setInterval(fetchIncidents, 5000);
+    if (window.EventSource) {
+      // The list is fetched once the stream is ready, see openStream.
+      openStream();
+    } else {
+      fetchIncidents();
+      pollInterval = setInterval(fetchIncidents, 5000);
+    }
   }
 
   function stopPolling() {
@@ -34,25 +48,127 @@ document.addEventListener("DOMContentLoaded", function () {
       clearInterval(pollInterval);
       pollInterval = null;
     }
+    if (streamRetry) {
+      clearTimeout(streamRetry);
+      streamRetry = null;
+    }
+    if (eventSource) {
+      eventSource.close();
+      eventSource = null;
+    }
+    incidentsEtag = null;
+    lastEventId = null;
+  }
+
+  // Incidents are pushed as they open and resolve. The list is fetched
+  // only once the stream is subscribed, its ready event, and the events
+  // received during a fetch are applied again to the fetched page, so no
+  // change is lost in between. The browser reconnects by itself and
+  // resumes from the last event it received, and if the stream cannot be
+  // opened at all the dashboard polls until it can.
+  function openStream() {
+    const query = lastEventId
+      ? `?last_event_id=${encodeURIComponent(lastEventId)}`
+      : "";
+    eventSource = new EventSource(`${API_BASE}/api/incidents/stream/${query}`);
+
+    eventSource.addEventListener("open", function () {
+      if (pollInterval) {
+        clearInterval(pollInterval);
+        pollInterval = null;
+      }
+    });
+    eventSource.addEventListener("ready", function (e) {
+      lastEventId = e.lastEventId;
+      fetchIncidents();
+    });
+    eventSource.addEventListener("opened", receiveEvent);
+    eventSource.addEventListener("resolved", receiveEvent);
+    eventSource.addEventListener("reset", function (e) {
+      lastEventId = e.lastEventId;
+      fetchIncidents();
+    });
+    eventSource.addEventListener("error", function () {
+      if (eventSource.readyState !== EventSource.CLOSED) {
+        return;
+      }
+      console.error("Incident stream closed, falling back to polling");
+      eventSource = null;
+      if (!pollInterval) {
+        fetchIncidents();
+        pollInterval = setInterval(fetchIncidents, 5000);
+      }
+      streamRetry = setTimeout(function () {
+        streamRetry = null;
+        openStream();
+      }, STREAM_RETRY_MS);
+    });
+  }
+
+  function receiveEvent(e) {
+    lastEventId = e.lastEventId;
+    const event = { type: e.type, data: JSON.parse(e.data) };
+    eventsDuringFetch.forEach((events) => events.push(event));
+    if (applyEvent(event)) {
+      renderIncidents(incidents);
+    }
+  }
+
+  // Apply an opened or resolved event to the list, return whether it changed.
+  function applyEvent(event) {
+    if (event.type === "opened") {
+      if (incidents.some((known) => known.id === event.data.id)) {
+        return false;
+      }
+      incidents = [event.data, ...incidents].slice(0, INCIDENTS_PAGE_SIZE);
+      return true;
+    }
+    const incident = incidents.find((known) => known.id === event.data.id);
+    if (!incident) {
+      return false;
+    }
+    incident.end_time = event.data.end_time;
+    return true;
   }
 
   async function fetchIncidents() {
+    const events = [];
+    eventsDuringFetch.add(events);
     try {
       console.log("Fetching incidents...");
-      incidentsTableBody.innerHTML =
-        '<tr><td colspan="7" class="loading">Loading incidents...</td></tr>';
-      const response = await fetch(`${API_BASE}/api/incidents/`);
+      if (!incidentsEtag) {
+        incidentsTableBody.innerHTML =
+          '<tr><td colspan="7" class="loading">Loading incidents...</td></tr>';
+      }
+      // Only the newest page, older incidents are available through the cursor.
+      const response = await fetch(
+        `${API_BASE}/api/incidents/?limit=${INCIDENTS_PAGE_SIZE}`,
+        {
+          cache: "no-store",
+          headers: incidentsEtag ? { "If-None-Match": incidentsEtag } : {},
+        }
+      );
       console.log("Incidents response status:", response.status);
+      if (response.status === 304) {
+        return;
+      }
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
-      const incidents = await response.json();
-      console.log("Incidents fetched:", incidents.length);
+      const page = await response.json();
+      console.log("Incidents fetched:", page.results.length);
+      incidentsEtag = response.headers.get("ETag");
+      incidents = page.results;
+      // The page may have been read before these events happened.
+      events.forEach(applyEvent);
       renderIncidents(incidents);
     } catch (err) {
       console.error("Failed to fetch incidents:", err);
+      incidentsEtag = null;
       incidentsTableBody.innerHTML =
         '<tr><td colspan="7" class="loading">Error loading incidents. Please try again.</td></tr>';
+    } finally {
+      eventsDuringFetch.delete(events);
     }
   }
 
@@ -70,6 +186,14 @@ document.addEventListener("DOMContentLoaded", function () {
     }
   }
 
+  function formatValue(incident) {
+    // UNREACHABLE incidents hold the failed polls in a row, not a percentage.
+    if (incident.type === "UNREACHABLE") {
+      return `${incident.value} failed polls`;
+    }
+    return `${incident.value}%`;
+  }
+
   function renderIncidents(incidents) {
     incidentsTableBody.innerHTML = "";
 
@@ -85,7 +209,7 @@ document.addEventListener("DOMContentLoaded", function () {
         <td>${incident.id}</td>
         <td>${incident.machine}</td>
         <td>${incident.type}</td>
-        <td>${incident.value}%</td>
+        <td>${formatValue(incident)}</td>
         <td>${formatDate(incident.start_time)}</td>
         <td>${formatDate(incident.end_time)}</td>
         <td>${getStatusBadge(incident.end_time)}</td>